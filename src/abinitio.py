@@ -10,6 +10,7 @@ from builtins import zip
 from builtins import range
 import os
 import shutil
+import tempfile
 from forcebalance.nifty import col, eqcgmx, flat, floatornan, fqcgmx, invert_svd, kb, printcool, bohr2ang, warn_press_key, warn_once, pvec1d, commadash, uncommadash, isint
 import numpy as np
 from forcebalance.target import Target
@@ -126,6 +127,10 @@ class AbInitio(Target):
         ## Whether to do energy and force calculations for the whole trajectory, or to do
         ## one calculation per snapshot.
         self.set_option(tgt_opts,'all_at_once','all_at_once')
+        ## Memory budget (MB) for the energy / force parameter derivatives before they are stored on disk
+        self.set_option(tgt_opts,'jacobian_mem')
+        ## Whether to read the coordinates and reference data through the binary sidecar cache
+        self.set_option(tgt_opts,'read_cache')
         ## OpenMM-only option - whether to run the energies and forces internally.
         self.set_option(tgt_opts,'run_internal','run_internal')
         ## Whether we have virtual sites (set at the global option level)
@@ -191,9 +196,9 @@ class AbInitio(Target):
         ## Read in the trajectory file
         if hasattr(self, 'pdb') and self.pdb is not None:
             self.mol = Molecule(os.path.join(self.root,self.tgtdir,self.coords),
-                                top=(os.path.join(self.root,self.tgtdir,self.pdb)))
+                                top=(os.path.join(self.root,self.tgtdir,self.pdb)), cache=self.read_cache)
         else:
-            self.mol = Molecule(os.path.join(self.root,self.tgtdir,self.coords))
+            self.mol = Molecule(os.path.join(self.root,self.tgtdir,self.coords), cache=self.read_cache)
         ## Set the number of snapshots
         if self.ns != -1:
             self.mol = self.mol[:self.ns]
@@ -364,17 +369,24 @@ class AbInitio(Target):
 
         """
         # Parse the qdata.txt file
-        for line in open(os.path.join(self.root,self.qfnm)):
-            sline = line.split()
-            if len(sline) == 0: continue
-            elif sline[0] == 'ENERGY':
-                self.eqm.append(float(sline[1]))
-            elif sline[0] in ['FORCES', 'GRADIENT']:
-                self.fqm.append([float(i) for i in sline[1:]])
-            elif sline[0] == 'ESPXYZ':
-                self.espxyz.append([float(i) for i in sline[1:]])
-            elif sline[0] == 'ESPVAL':
-                self.espval.append([float(i) for i in sline[1:]])
+        if self.read_cache:
+            MQ = Molecule(os.path.join(self.root,self.qfnm), build_topology=False, cache=True)
+            self.eqm = list(MQ.Data.get('qm_energies', []))
+            self.fqm = [g.reshape(-1) for g in MQ.Data.get('qm_grads', [])]
+            self.espxyz = [x.reshape(-1) for x in MQ.Data.get('qm_espxyzs', [])]
+            self.espval = list(MQ.Data.get('qm_espvals', []))
+        else:
+            for line in open(os.path.join(self.root,self.qfnm)):
+                sline = line.split()
+                if len(sline) == 0: continue
+                elif sline[0] == 'ENERGY':
+                    self.eqm.append(float(sline[1]))
+                elif sline[0] in ['FORCES', 'GRADIENT']:
+                    self.fqm.append([float(i) for i in sline[1:]])
+                elif sline[0] == 'ESPXYZ':
+                    self.espxyz.append([float(i) for i in sline[1:]])
+                elif sline[0] == 'ESPVAL':
+                    self.espval.append([float(i) for i in sline[1:]])
 
         # Ensure that all lists are of length self.ns
         self.eqm = self.eqm[:self.ns]
@@ -523,9 +535,10 @@ class AbInitio(Target):
             logger.error("Target must contain an engine object\n")
             raise NotImplementedError
 
-    def energy_force_transform(self):
+    def energy_force_transform(self, M=None):
+        """ Select the fitted atoms and add net forces and torques; M (from the engine) is computed if not provided. """
         if self.force:
-            M = self.energy_force_all()
+            if M is None: M = self.energy_force_all()
             selct = [0] + list(itertools.chain(*[[1+3*i+j for j in range(3)] for i in self.fitatoms]))
             M = M[:, selct]
             if self.use_nft:
@@ -538,6 +551,8 @@ class AbInitio(Target):
                 return np.hstack((M, Nfts))
             else:
                 return M
+        elif M is not None:
+            return M.reshape(-1,1)
         else:
             return self.energy_all()
 
@@ -555,11 +570,64 @@ class AbInitio(Target):
             logger.error("Target must contain an engine object\n")
             raise NotImplementedError
 
+    def energy_force_jacobian(self, mvals, M_all):
+        """
+        Compute the derivatives of the (transformed) MM energies and forces
+        for all snapshots with respect to every parameter in pgrad.
+
+        Derivatives for parameters that the energy depends on linearly are
+        computed by the engine if it is able to (see linear_deriv).  Each
+        other parameter is displaced by +/- h, and the displaced parameter
+        sets are passed to the engine in batches (as many as fit in
+        jacobian_mem) so that it may evaluate them together.  Only the first
+        derivatives are kept, because the Gauss-Newton Hessian in
+        get_energy_force does not use the second derivatives, and only
+        the parameters in pgrad are stored.  The result has shape
+        (NS, len(pgrad), NCP1) so that get_energy_force can read one
+        snapshot slab at a time; if it is larger than jacobian_mem
+        (in MB), it is stored in a disk-backed array in the run directory
+        that is deleted once it goes out of scope.
+
+        @param[in] mvals Mathematical parameter values
+        @param[in] M_all MM energies and forces at mvals, shape (NS, NCP1)
+        @return dM_all Derivatives of M_all; dM_all[i, k] corresponds to parameter self.pgrad[k]
+        """
+        NS, NCP1 = M_all.shape
+        shape = (NS, len(self.pgrad), NCP1)
+        if 8 * np.prod(shape) > self.jacobian_mem * 1024**2:
+            dM_all = np.memmap(tempfile.TemporaryFile(dir=os.getcwd()), dtype=float, mode='w+', shape=shape)
+        else:
+            dM_all = np.zeros(shape)
+        linear = self.engine.linear_parameters(mvals, self.pgrad)
+        dM_linear = self.engine.linear_derivatives(linear, force=self.force)
+        for k, p in enumerate(self.pgrad):
+            if p in dM_linear:
+                dM_all[:,k,:] = self.energy_force_transform(dM_linear[p])
+        # Parameters for finite difference, in batches of displacements that fit in memory.
+        fdk = [k for k, p in enumerate(self.pgrad) if p not in dM_linear]
+        nbatch = max(1, int(self.jacobian_mem * 1024**2 / (16 * NS * NCP1)))
+        for b in range(0, len(fdk), nbatch):
+            mvals_list = []
+            for k in fdk[b:b+nbatch]:
+                for d in [-1, 1]:
+                    mvals_ = list(mvals)
+                    mvals_[self.pgrad[k]] += d*self.h
+                    mvals_list.append(mvals_)
+            if self.force:
+                Ms = self.engine.energy_force_multi(mvals_list)
+            else:
+                Ms = self.engine.energy_multi(mvals_list)
+            for n, k in enumerate(fdk[b:b+nbatch]):
+                dM_all[:,k,:] = (self.energy_force_transform(Ms[2*n+1]) - self.energy_force_transform(Ms[2*n]))/(2*self.h)
+        if self.energy_mode == 'qm_minimum':
+            dM_all[:,:,0] -= dM_all[self.smin,:,0]
+        return dM_all
+
     def energy_force_transform_one(self,i):
         if self.force:
-            M = self.energy_force_one(i)
-            selct = [0] + list(itertools.chain(*[[1+3*i+j for j in range(3)] for i in self.fitatoms]))
-            M = M[:, selct]
+            M = flat(self.energy_force_one(i))
+            selct = [0] + list(itertools.chain(*[[1+3*a+j for j in range(3)] for a in self.fitatoms]))
+            M = M[selct]
             if self.use_nft:
                 Fm  = M[1:]
                 Nft = self.compute_netforce_torque(self.mol.xyzs[i], Fm)
@@ -567,7 +635,7 @@ class AbInitio(Target):
             else:
                 return M
         else:
-            return self.energy_one()
+            return flat(self.energy_one(i))
 
     def get_energy_force(self, mvals, AGrad=False, AHess=False):
         """
@@ -690,9 +758,6 @@ class AbInitio(Target):
         # This saves time because we don't need to execute the external program
         # once per snapshot, but requires memory.
         M_all = np.zeros((NS,NCP1))
-        if AGrad and self.all_at_once:
-            dM_all = np.zeros((NS,NP,NCP1))
-            ddM_all = np.zeros((NS,NP,NCP1))
         #==============================================================#
         #             STEP 2: Loop through the snapshots.              #
         #==============================================================#
@@ -702,100 +767,140 @@ class AbInitio(Target):
             if self.energy_mode == 'qm_minimum':
                 M_all[:, 0] -= M_all[self.smin, 0]
             if AGrad or AHess:
-                def callM(mvals_):
-                    logger.debug("\r")
-                    pvals = self.FF.make(mvals_)
-                    return self.energy_force_transform()
-                for p in self.pgrad:
-                    dM_all[:,p,:], ddM_all[:,p,:] = f12d3p(fdwrap(callM, mvals, p), h = self.h, f0 = M_all)
-                    if self.energy_mode == 'qm_minimum':
-                        dM_all[:, p, 0] -= dM_all[self.smin, p, 0]
-                        ddM_all[:, p, 0] -= ddM_all[self.smin, p, 0]
+                # dM_all[i, k] is the derivative of snapshot i w/r.t. parameter self.pgrad[k]
+                dM_all = self.energy_force_jacobian(mvals, M_all)
         if self.force and not in_fd():
             self.maxfatom = -1
             self.maxfshot = -1
             self.maxdf = 0.0
-        for i in range(NS):
-            if i % 100 == 0:
-                logger.debug("\rIncrementing quantities for snapshot %i\r" % i)
-            # Build Boltzmann weights and increment partition function.
-            P   = self.boltz_wts[i]
-            Z  += P
-            # Load reference (QM) data
-            Q[0] = self.eqm[i]
+        if self.all_at_once:
+            #==============================================================#
+            #  STEP 2: Accumulate over all snapshots with array operations. #
+            #==============================================================#
+            P = np.array(self.boltz_wts, dtype=float)
+            Z = np.sum(P)
+            # Reference (QM) data for all snapshots
+            Q_all = np.zeros((NS,NCP1))
+            Q_all[:,0] = self.eqm
             if self.force:
-                Q[1:] = self.fref[i,:].copy()
-            QQ     = Q*Q
-            # Call the simulation software to get the MM quantities
-            # (or load from M_all array)
-            if self.all_at_once:
-                M = M_all[i]
-            else:
-                if i % 100 == 0:
-                    logger.debug("Shot %i\r" % i)
-                M = self.energy_force_transform_one(i)
-                M_all[i,:] = M.copy()
+                Q_all[:,1:] = self.fref
             # MM - QM difference
-            X     = M-Q
+            X_all = M_all-Q_all
             # For asymmetric fit, MM energies lower than QM are given a boost factor
-            boost = self.energy_asymmetry if X[0] < 0.0 else 1.0
+            boost = np.where(X_all[:,0] < 0.0, self.energy_asymmetry, 1.0)
             # Save information about forces
-            if self.force:
+            if self.force and not in_fd():
                 # Norm-squared of force differences for each atom
-                dfrc2 = norm2(M-Q, 1, nat)
-                if not in_fd() and np.max(dfrc2) > self.maxdf:
-                    self.maxdf = np.sqrt(np.max(dfrc2))
-                    self.maxfatom = np.argmax(dfrc2)
-                    self.maxfshot = i
-            # Increment the average quantities
-            # The [0] indicates that we are fitting the RMS force and not the RMSD
-            # (without the covariance, subtracting a mean force doesn't make sense.)
-            # The rest of the array is empty.
-            M0[0] += P*M[0]
-            Q0[0] += P*Q[0]
-            X0[0] += P*X[0]
-            # We store all elements of the mean-squared QM quantities.
-            QQ0 += P*QQ
+                dfrc2 = np.sum(X_all[:,1:1+3*nat].reshape(NS,nat,3)**2, axis=2)
+                # Scan in the same way as the per-snapshot loop so the indicators don't change.
+                for i in range(NS):
+                    if np.max(dfrc2[i]) > self.maxdf:
+                        self.maxdf = np.sqrt(np.max(dfrc2[i]))
+                        self.maxfatom = np.argmax(dfrc2[i])
+                        self.maxfshot = i
+            # Increment the average quantities (energies only, see below)
+            M0[0] = np.dot(P, M_all[:,0])
+            Q0[0] = np.dot(P, Q_all[:,0])
+            X0[0] = np.dot(P, X_all[:,0])
+            QQ0 = np.dot(P, Q_all*Q_all)
             # Increment the objective function.
-            Xi     = X**2
-            Xi[0] *= boost
-            # SPX contains the sum over snapshots
-            SPX += P * Xi
-            #==============================================================#
-            #      STEP 2a: Increment gradients and mean quantities.       #
-            #==============================================================#
-            for p in self.pgrad:
-                if not AGrad: continue
-                if self.all_at_once:
-                    M_p[p] = dM_all[i, p]
-                    M_pp[p] = ddM_all[i, p]
-                else:
+            Xi = X_all**2
+            Xi[:,0] *= boost
+            SPX = np.dot(P, Xi)
+            # Per-snapshot, per-component weights including the boost factor
+            W_all = np.outer(P, np.ones(NCP1))
+            W_all[:,0] *= boost
+            if AGrad:
+                pg = np.array(self.pgrad, dtype=int)
+                # Contract blocks of snapshots so that only one block of dM_all
+                # (which may be stored on disk) is in memory at a time.
+                blk = max(1, int(self.jacobian_mem * 1024**2 / (8 * max(1, len(pg)) * NCP1)))
+                for i0 in range(0, NS, blk):
+                    dM = np.array(dM_all[i0:i0+blk])
+                    W = W_all[i0:i0+blk]
+                    # SPX_p[p] = sum_i w_i * 2 * X_i * dM_i/dp
+                    SPX_p[pg] += np.einsum('ic,ikc->kc', 2*W*X_all[i0:i0+blk], dM)
+                    M0_p[pg,0] += np.dot(P[i0:i0+blk], dM[:,:,0])
+                    if not AHess: continue
+                    # Gauss-Newton Hessian: SPX_pq[p,q] = sum_i w_i * 2 * dM_i/dp * dM_i/dq,
+                    # computed as one matrix product per component.
+                    WdM = (W[:,np.newaxis,:]*dM).transpose(2,1,0)
+                    SPX_pq[np.ix_(pg,pg)] += 2*np.matmul(WdM, dM.transpose(2,0,1)).transpose(1,2,0)
+        else:
+            for i in range(NS):
+                if i % 100 == 0:
+                    logger.debug("\rIncrementing quantities for snapshot %i\r" % i)
+                # Build Boltzmann weights and increment partition function.
+                P   = self.boltz_wts[i]
+                Z  += P
+                # Load reference (QM) data
+                Q[0] = self.eqm[i]
+                if self.force:
+                    Q[1:] = self.fref[i,:].copy()
+                QQ     = Q*Q
+                # Call the simulation software to get the MM quantities
+                if i % 100 == 0:
+                    logger.debug("Shot %i\r" % i)
+                M = self.energy_force_transform_one(i)
+                M_all[i,:] = M.copy()
+                # MM - QM difference
+                X     = M-Q
+                # For asymmetric fit, MM energies lower than QM are given a boost factor
+                boost = self.energy_asymmetry if X[0] < 0.0 else 1.0
+                # Save information about forces
+                if self.force:
+                    # Norm-squared of force differences for each atom
+                    dfrc2 = norm2(M-Q, 1, nat)
+                    if not in_fd() and np.max(dfrc2) > self.maxdf:
+                        self.maxdf = np.sqrt(np.max(dfrc2))
+                        self.maxfatom = np.argmax(dfrc2)
+                        self.maxfshot = i
+                # Increment the average quantities
+                # The [0] indicates that we are fitting the RMS force and not the RMSD
+                # (without the covariance, subtracting a mean force doesn't make sense.)
+                # The rest of the array is empty.
+                M0[0] += P*M[0]
+                Q0[0] += P*Q[0]
+                X0[0] += P*X[0]
+                # We store all elements of the mean-squared QM quantities.
+                QQ0 += P*QQ
+                # Increment the objective function.
+                Xi     = X**2
+                Xi[0] *= boost
+                # SPX contains the sum over snapshots
+                SPX += P * Xi
+                #==============================================================#
+                #      STEP 2a: Increment gradients and mean quantities.       #
+                #==============================================================#
+                for p in self.pgrad:
+                    if not AGrad: continue
                     def callM(mvals_):
                         if i % 100 == 0:
                             logger.debug("\r")
                         pvals = self.FF.make(mvals_)
                         return self.energy_force_transform_one(i)
                     M_p[p],M_pp[p] = f12d3p(fdwrap(callM, mvals, p), h = self.h, f0 = M)
-                if all(M_p[p] == 0): continue
-                M0_p[p][0]  += P * M_p[p][0]
-                Xi_p        = 2 * X * M_p[p]
-                Xi_p[0]    *= boost
-                SPX_p[p] += P * Xi_p
-                if not AHess: continue
-                if self.all_at_once:
-                    M_pp[p] = ddM_all[i, p]
-                # This formula is more correct, but perhapsively convergence is slower.
-                #Xi_pq       = 2 * (M_p[p] * M_p[p] + X * M_pp[p])
-                # Gauss-Newton formula for approximate Hessian
-                Xi_pq       = 2 * (M_p[p] * M_p[p])
-                Xi_pq[0]   *= boost
-                SPX_pq[p,p] += P * Xi_pq
-                for q in range(p):
-                    if all(M_p[q] == 0): continue
-                    if q not in self.pgrad: continue
-                    Xi_pq          = 2 * M_p[p] * M_p[q]
-                    Xi_pq[0]      *= boost
-                    SPX_pq[p,q] += P * Xi_pq
+                    if all(M_p[p] == 0): continue
+                    M0_p[p][0]  += P * M_p[p][0]
+                    Xi_p        = 2 * X * M_p[p]
+                    Xi_p[0]    *= boost
+                    SPX_p[p] += P * Xi_p
+                    if not AHess: continue
+                    # This formula is more correct, but perhapsively convergence is slower.
+                    #Xi_pq       = 2 * (M_p[p] * M_p[p] + X * M_pp[p])
+                    # Gauss-Newton formula for approximate Hessian
+                    Xi_pq       = 2 * (M_p[p] * M_p[p])
+                    Xi_pq[0]   *= boost
+                    SPX_pq[p,p] += P * Xi_pq
+                    for q in range(p):
+                        if all(M_p[q] == 0): continue
+                        if q not in self.pgrad: continue
+                        Xi_pq          = 2 * M_p[p] * M_p[q]
+                        Xi_pq[0]      *= boost
+                        SPX_pq[p,q] += P * Xi_pq
+                # Restore the force field after the finite difference displacements for the next snapshot.
+                if AGrad and len(self.pgrad) > 0:
+                    self.FF.make(mvals)
 
         #==============================================================#
         #         STEP 2b: Write energies and forces to disk.          #
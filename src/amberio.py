@@ -14,6 +14,9 @@ from builtins import zip
 from builtins import range
 from builtins import object
 import os, sys, re
+import atexit
+import queue
+import threading
 import copy
 from re import match, sub, split, findall
 import networkx as nx
@@ -32,12 +35,22 @@ from scipy.io.netcdf import netcdf_file
 try:
     # Some functions require the Python API to sander "pysander"
     import sander
+    atexit.register(lambda: _sander_cleanup())
 except:
     pass
 
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
 
+## The sander API holds one system at a time; this records the engine that set it up and its parameters
+_sander_session = {'owner' : None, 'key' : None}
+
+def _sander_cleanup():
+    if sander.is_setup():
+        sander.cleanup()
+    _sander_session['owner'] = None
+    _sander_session['key'] = None
+
 # Boltzmann's constant
 kb_kcal = 0.0019872041
 
@@ -715,6 +728,8 @@ class PrmtopLoader(object):
                 format = format[index0+1:index1]
                 m = FORMAT_RE_PATTERN.search(format)
                 self._raw_format[self._flags[-1]] = (format, m.group(1), m.group(2), m.group(3), m.group(4))
+            elif line.startswith('%COMMENT'):
+                continue
             elif self._flags \
                  and 'TITLE'==self._flags[-1] \
                  and not self._raw_data['TITLE']:
@@ -731,6 +746,35 @@ class PrmtopLoader(object):
                         self._raw_data[flag].append(item.strip())
         fIn.close()
 
+    def write(self, outFilename):
+        """
+        Write the (possibly modified) contents to an AMBER prmtop file.
+
+        ARGUMENTS
+
+        outFilename (string) - Name of the prmtop file to be written
+        """
+        with wopen(outFilename) as f:
+            print('%%VERSION %s' % self._prmtopVersion, file=f)
+            for flag in self._flags:
+                (format, numItems, itemType,
+                 itemLength, itemPrecision) = self._getFormat(flag)
+                print('%%FLAG %s' % flag, file=f)
+                print('%%FORMAT(%s)' % format, file=f)
+                if flag == 'TITLE':
+                    print(self._raw_data['TITLE'], file=f)
+                    continue
+                items = self._raw_data[flag]
+                if itemType.lower() == 'a':
+                    items = [i.ljust(int(itemLength)) for i in items]
+                else:
+                    items = [i.rjust(int(itemLength)) for i in items]
+                n = int(numItems)
+                for i in range(0, len(items), n):
+                    print(''.join(items[i:i+n]).rstrip(), file=f)
+                if len(items) == 0:
+                    print('', file=f)
+
     def _getFormat(self, flag=None):
         if not flag:
             flag=self._flags[-1]
@@ -1089,6 +1133,393 @@ class PrmtopLoader(object):
         z=float(self._raw_data["BOX_DIMENSIONS"][3])
         return (beta, x, y, z)
 
+class PrmtopPatcher(object):
+    """
+    Update the parameters in a prmtop file made by tleap when the values
+    in the force field files change, so that tleap doesn't have to be called
+    again for each new set of parameter values.
+
+    The prmtop entries for each parameterized field in the frcmod and mol2
+    files are found by matching the AMBER atom types (for bonds, angles,
+    dihedrals and van der Waals parameters) or the residue and atom names
+    (for charges) of the interactions in the prmtop file.  Parameters that
+    can't be assigned to prmtop entries in this way are not supported, and
+    neither are prmtop types that tleap shares between interactions with
+    different parameters; a RuntimeError is raised in these cases, and
+    the caller should fall back to calling tleap.
+
+    The caller should check the patched prmtop against the output of tleap
+    (see compare) the first time that each field changes.
+    """
+    def __init__(self, prmtop, FF):
+        """
+        @param[in] prmtop PrmtopLoader object for the prmtop that tleap made from the current force field files
+        @param[in] FF Force field object
+        """
+        ## The prmtop made by tleap; this is never modified.
+        self.prmtop = prmtop
+        ## The force field object
+        self.FF = FF
+        ## Locations (file name, line number, field number) of the parameterized values in the force field files
+        self.fields = []
+        for pfield in FF.pfields:
+            if (pfield[1], pfield[2], pfield[3]) not in self.fields:
+                self.fields.append((pfield[1], pfield[2], pfield[3]))
+        pids = OrderedDict([((pfield[1], pfield[2], pfield[3]), pfield[0]) for pfield in FF.pfields])
+        ## Values of the fields in the force field files that the prmtop was made from
+        self.values0 = self.read_values()
+        ## Whether the updates for each field have been checked against tleap
+        self.checked = np.zeros(len(self.fields), dtype=bool)
+        raw = prmtop._raw_data
+        types = [t.strip() for t in raw['AMBER_ATOM_TYPE']]
+        # For each bonded prmtop type, the interactions that use it, written in terms of atom types.
+        bonded = defaultdict(set)
+        for ptrs, kind, n in [(raw['BONDS_INC_HYDROGEN'] + raw['BONDS_WITHOUT_HYDROGEN'], 'BONDS', 2),
+                              (raw['ANGLES_INC_HYDROGEN'] + raw['ANGLES_WITHOUT_HYDROGEN'], 'ANGLES', 3),
+                              (raw['DIHEDRALS_INC_HYDROGEN'] + raw['DIHEDRALS_WITHOUT_HYDROGEN'], 'DIHS', 4)]:
+            ptrs = np.array(ptrs, dtype=int).reshape(-1, n+1)
+            for row in ptrs:
+                atoms = tuple(types[abs(i)//3] for i in row[:n])
+                itype = row[n] - 1
+                if kind == 'DIHS':
+                    per = int(round(abs(float(raw['DIHEDRAL_PERIODICITY'][itype]))))
+                    kind_ = 'IDIHS' if row[3] < 0 else 'PDIHS%i' % per
+                    bonded[(kind_, itype)].add(atoms)
+                else:
+                    bonded[(kind, itype)].add(atoms)
+        # Parameter keys in the frcmod files, used to tell which parameter a dihedral comes from.
+        frcmod_keys = defaultdict(set)
+        parsed = []
+        for i, fld in enumerate(self.fields):
+            m = re.match('^(BONDS|ANGLES|PDIHS[0-9]|IDIHS|VDW)([KBST])/(.*)$', pids[fld])
+            if isinstance(FF.Readers[fld[0]], Mol2_Reader) and pids[fld].startswith('COUL'):
+                parsed.append(('COUL', None, None))
+            elif isinstance(FF.Readers[fld[0]], FrcMod_Reader) and m is not None:
+                atoms = tuple(a.strip() for a in m.group(3).split('-'))
+                parsed.append((m.group(1), m.group(2), atoms))
+                frcmod_keys[m.group(1)].add(atoms)
+            else:
+                raise RuntimeError("Updating the prmtop without tleap is not supported for parameter %s" % pids[fld])
+        def source(kind, atoms):
+            # The most specific frcmod key matching the interaction, or the atom types of the interaction if there is none.
+            best = None
+            for key in frcmod_keys[kind]:
+                if kind == 'IDIHS':
+                    # For impropers, the third atom is the central one; the others may come in any order.
+                    if key[2] not in ('X', atoms[2]): continue
+                    rest = [a for a in key[:2] + key[3:] if a != 'X']
+                    others = list(atoms[:2] + atoms[3:])
+                    if any(rest.count(a) > others.count(a) for a in rest): continue
+                elif not any(all(k in ('X', a) for k, a in zip(key, order)) for order in [atoms, atoms[::-1]]):
+                    continue
+                if best is None or key.count('X') < best.count('X'):
+                    best = key
+            if best is not None:
+                return best
+            return min(atoms, atoms[::-1]) if kind != 'IDIHS' else atoms
+        bonded_sources = OrderedDict([(k, set(source(k[0], a) for a in v)) for k, v in bonded.items()])
+        # Scaling factors from the units in the force field files to the prmtop.
+        deg = np.pi/180
+        flags = {'BONDS' : {'K' : ('BOND_FORCE_CONSTANT', 1.0), 'B' : ('BOND_EQUIL_VALUE', 1.0)},
+                 'ANGLES' : {'K' : ('ANGLE_FORCE_CONSTANT', 1.0), 'B' : ('ANGLE_EQUIL_VALUE', deg)},
+                 'DIHS' : {'K' : ('DIHEDRAL_FORCE_CONSTANT', 1.0), 'B' : ('DIHEDRAL_PHASE', deg)}}
+        ## Updates that are proportional to the field values: (field index, prmtop flag, entry indices, factor)
+        self.linear = []
+        ## Van der Waals parameters: (field index, nonbonded type indices, 'S' for R* or 'T' for epsilon)
+        self.vdw = []
+        atom_type_index = np.array(raw['ATOM_TYPE_INDEX'], dtype=int) - 1
+        for i, (kind, ptype, atoms) in enumerate(parsed):
+            fnm, ln, fld = self.fields[i]
+            if kind == 'COUL':
+                s = FF.ffdata[fnm][ln].split()
+                idx = [a for a in range(len(types)) if raw['ATOM_NAME'][a] == s[1] and
+                       self.prmtop.getResidueLabel(iAtom=a) == s[7]]
+                self.linear.append((i, 'CHARGE', np.array(idx, dtype=int), 18.2223))
+            elif kind == 'VDW':
+                nbtypes = sorted(set(atom_type_index[[a for a in range(len(types)) if types[a] == atoms[0]]]))
+                for t in nbtypes:
+                    if set(types[a] for a in np.where(atom_type_index == t)[0]) != set(atoms):
+                        raise RuntimeError("Atom type %s shares a nonbonded type with other atom types in the prmtop" % atoms[0])
+                self.vdw.append((i, np.array(nbtypes, dtype=int), ptype))
+            else:
+                itypes = []
+                for (kind_, itype), srcs in bonded_sources.items():
+                    if kind_ != kind or atoms not in srcs: continue
+                    if len(srcs) > 1:
+                        raise RuntimeError("The prmtop uses the same %s type for %s and other interactions" % (kind, '-'.join(atoms)))
+                    itypes.append(itype)
+                flag, factor = flags['DIHS' if 'DIHS' in kind else kind][ptype]
+                if kind.startswith('PDIHS') and ptype == 'K':
+                    # The force constant is divided by IDIVF, which comes before it in the frcmod file.
+                    factor /= float(FF.Readers[fnm].Split(FF.ffdata[fnm][ln])[fld-1])
+                self.linear.append((i, flag, np.array(itypes, dtype=int), factor))
+        # Nonbonded R* and epsilon for each nonbonded type, from the diagonal LJ coefficients.
+        ntypes = prmtop.getNumTypes()
+        ## Index of the LJ coefficients for each pair of nonbonded types
+        self.nbindex = np.array(raw['NONBONDED_PARM_INDEX'], dtype=int).reshape(ntypes, ntypes) - 1
+        diag = self.nbindex[np.arange(ntypes), np.arange(ntypes)]
+        acoef = np.array(raw['LENNARD_JONES_ACOEF'], dtype=float)[diag]
+        bcoef = np.array(raw['LENNARD_JONES_BCOEF'], dtype=float)[diag]
+        nz = (acoef > 0) & (bcoef > 0)
+        ## R* (half the LJ minimum distance) and epsilon of each nonbonded type
+        self.rstar = np.zeros(ntypes)
+        self.eps = np.zeros(ntypes)
+        self.rstar[nz] = 0.5*(2*acoef[nz]/bcoef[nz])**(1.0/6)
+        self.eps[nz] = bcoef[nz]**2/(4*acoef[nz])
+
+    def read_values(self):
+        """ Read the parameterized values from the force field files in the current directory. """
+        lines = {}
+        values = []
+        for fnm, ln, fld in self.fields:
+            if fnm not in lines:
+                with open(fnm) as f: lines[fnm] = f.readlines()
+            values.append(float(self.FF.Readers[fnm].Split(lines[fnm][ln])[fld]))
+        return np.array(values)
+
+    def patch(self, values):
+        """
+        Return a PrmtopLoader with the parameters for the given values
+        of the fields in the force field files.
+
+        @param[in] values Values of the fields, as returned by read_values()
+        @return PrmtopLoader object that may be written to a file
+        """
+        new = copy.copy(self.prmtop)
+        new._raw_data = dict(self.prmtop._raw_data)
+        changed = values != self.values0
+        def setflag(flag, idx, vals):
+            fmt = '%%%s.%sE' % new._raw_format[flag][3:5]
+            if new._raw_data[flag] is self.prmtop._raw_data[flag]:
+                new._raw_data[flag] = list(new._raw_data[flag])
+            for j, v in zip(idx, vals):
+                new._raw_data[flag][j] = fmt % v
+        for i, flag, idx, factor in self.linear:
+            if changed[i]:
+                setflag(flag, idx, [values[i]*factor]*len(idx))
+        vdw = [(i, t, ptype) for i, t, ptype in self.vdw if changed[i]]
+        if vdw:
+            rstar = self.rstar.copy()
+            eps = self.eps.copy()
+            for i, t, ptype in vdw:
+                if ptype == 'S':
+                    rstar[t] = values[i]
+                else:
+                    eps[t] = values[i]
+            # Lorentz-Berthelot combining rules for the pairs of nonbonded types that involve the changed types
+            t = np.unique(np.concatenate([t for i, t, ptype in vdw]))
+            rij = rstar[t][:, np.newaxis] + rstar[np.newaxis, :]
+            eij = np.sqrt(eps[t][:, np.newaxis] * eps[np.newaxis, :])
+            idx = self.nbindex[t, :]
+            sel = idx >= 0
+            setflag('LENNARD_JONES_ACOEF', idx[sel], (eij*rij**12)[sel])
+            setflag('LENNARD_JONES_BCOEF', idx[sel], (2*eij*rij**6)[sel])
+        return new
+
+    def compare(self, new, ref):
+        """
+        Check a patched prmtop against the prmtop that tleap made from the same force field files.
+
+        @param[in] new PrmtopLoader object returned by patch()
+        @param[in] ref PrmtopLoader object read from the prmtop made by tleap
+        @return True if all of the entries agree
+        """
+        if new._flags != ref._flags: return False
+        for flag in new._flags:
+            if flag == 'TITLE': continue
+            a, b = new._raw_data[flag], ref._raw_data[flag]
+            if len(a) != len(b): return False
+            if new._raw_format[flag][2].upper() == 'E':
+                if not np.allclose(np.array(a, dtype=float), np.array(b, dtype=float), rtol=1e-6, atol=1e-10): return False
+            elif a != b:
+                return False
+        return True
+
+class AmberTrajectory(object):
+    """
+    Read the frames of a trajectory for evaluating it with the AMBER engine,
+    without loading the whole trajectory into memory.
+
+    NetCDF, .mdcrd (.crd) and .dcd trajectories are read in blocks of
+    frames, and the next block is read on a background thread while the
+    current one is being used.  The size of each block is limited by mem.
+    Other formats are read through the Molecule class, as is a Molecule
+    object passed in place of the file name.
+    """
+    def __init__(self, traj, na, mem=64):
+        """
+        @param[in] traj Trajectory file name or Molecule object
+        @param[in] na Number of atoms
+        @param[in] mem Maximum size of a block of frames in MB
+        """
+        ## The trajectory file name or Molecule object
+        self.traj = traj
+        ## Number of atoms
+        self.na = na
+        ## Number of frames in each block
+        self.blocksize = max(1, int(mem*1024**2 / (24*na)))
+        if isinstance(traj, Molecule):
+            self.ftype = 'molecule'
+        else:
+            ext = os.path.splitext(traj)[1].lower()
+            if ext == '.dcd':
+                self.ftype = 'dcd'
+            elif ext in ['.mdcrd', '.crd']:
+                self.ftype = 'mdcrd'
+            else:
+                try:
+                    netcdf_file(traj, 'r', mmap=True).close()
+                    self.ftype = 'netcdf'
+                except TypeError:
+                    logger.info("%s is not a NetCDF file, trying to load as Molecule object\n" % traj)
+                    self.traj = Molecule(traj)
+                    self.ftype = 'molecule'
+
+    def blocks(self, snapshots=None):
+        """
+        Read the trajectory in blocks of frames.
+
+        @param[in] snapshots If provided, only read these frames (in increasing order)
+        @return Generator of (coordinates, boxes); coordinates is an array of
+        shape (frames, na, 3) in Angstrom, and boxes is a (frames, 6) array
+        of box lengths and angles or None if the trajectory has no boxes.
+        """
+        if self.ftype == 'netcdf':
+            nc = netcdf_file(self.traj, 'r', mmap=True)
+            crd = None
+            try:
+                crd = nc.variables['coordinates']
+                if snapshots is None:
+                    snapshots = range(crd.shape[0])
+                snapshots = np.array(snapshots, dtype=int)
+                for b in range(0, len(snapshots), self.blocksize):
+                    sel = snapshots[b:b+self.blocksize]
+                    boxes = None
+                    if 'cell_lengths' in nc.variables:
+                        boxes = np.hstack((nc.variables['cell_lengths'].data[sel], nc.variables['cell_angles'].data[sel])).astype(float)
+                    yield np.array(crd.data[sel], dtype=float), boxes
+            finally:
+                # Release the reference to the memory-mapped data before closing.
+                del crd
+                nc.close()
+        elif self.ftype == 'molecule':
+            mol = self.traj
+            if snapshots is None:
+                snapshots = range(len(mol))
+            snapshots = list(snapshots)
+            for b in range(0, len(snapshots), self.blocksize):
+                sel = snapshots[b:b+self.blocksize]
+                boxes = None
+                if 'boxes' in mol.Data:
+                    boxes = np.array([[mol.boxes[i].a, mol.boxes[i].b, mol.boxes[i].c,
+                                       mol.boxes[i].alpha, mol.boxes[i].beta, mol.boxes[i].gamma] for i in sel])
+                yield np.array([mol.xyzs[i] for i in sel]), boxes
+        else:
+            # Sequential formats: read every frame and keep the selected ones.
+            keep = set(snapshots) if snapshots is not None else None
+            xyzs = []
+            boxes = []
+            for i, (xyz, box) in enumerate(self.read_dcd() if self.ftype == 'dcd' else self.read_mdcrd()):
+                if keep is not None and i not in keep: continue
+                xyzs.append(xyz)
+                boxes.append(box)
+                if len(xyzs) == self.blocksize:
+                    yield np.array(xyzs), (np.array(boxes) if boxes[0] is not None else None)
+                    xyzs = []
+                    boxes = []
+            if len(xyzs) > 0:
+                yield np.array(xyzs), (np.array(boxes) if boxes[0] is not None else None)
+
+    def read_mdcrd(self):
+        """ Generator of (coordinates, box) for each frame in an .mdcrd file; the parsing follows Molecule.read_mdcrd.
+        The box line is written after the coordinates of its frame, so a completed frame is held until the next line is read. """
+        xyz = []
+        frame = None
+        with open(self.traj) as f:
+            next(f)
+            for line in f:
+                sline = line.split()
+                if xyz == [] and len(sline) == 3 and frame is not None:
+                    yield frame, [float(i) for i in sline] + [90.0, 90.0, 90.0]
+                    frame = None
+                else:
+                    if frame is not None:
+                        yield frame, None
+                        frame = None
+                    xyz += [float(i) for i in sline]
+                    if len(xyz) == self.na * 3:
+                        frame = np.array(xyz).reshape(-1,3)
+                        xyz = []
+        if frame is not None:
+            yield frame, None
+
+    def read_dcd(self):
+        """ Generator of (coordinates, box) for each frame in a .dcd file; the reading follows Molecule.read_dcd. """
+        from forcebalance.molecule import _dcdlib, MolfileTimestep
+        from ctypes import c_int, c_float, byref
+        if _dcdlib.vmdplugin_init() != 0:
+            logger.error("Unable to init DCD plugin\n")
+            raise IOError
+        natoms = c_int(-1)
+        dcd = _dcdlib.open_dcd_read(self.traj, "dcd", byref(natoms))
+        ts = MolfileTimestep()
+        xyzvec = (c_float * (natoms.value * 3))()
+        ts.coords = xyzvec
+        try:
+            while _dcdlib.read_next_timestep(dcd, natoms, byref(ts)) != -1:
+                yield np.array(xyzvec, dtype=float).reshape(-1, 3), [ts.A, ts.B, ts.C, 90.0, 90.0, 90.0]
+        finally:
+            _dcdlib.close_file_read(dcd)
+
+    def frames(self, snapshots=None):
+        """
+        Iterate over the frames of the trajectory, while the next block of
+        frames is read on a background thread.
+
+        @param[in] snapshots If provided, only read these frames (in increasing order)
+        @return Generator of (coordinates, box) for each frame; box is None if the trajectory has no boxes
+        """
+        if self.ftype == 'molecule':
+            for xyzs, boxes in self.blocks(snapshots):
+                for i in range(len(xyzs)):
+                    yield xyzs[i], (boxes[i] if boxes is not None else None)
+            return
+        blocks = queue.Queue(maxsize=1)
+        stop = threading.Event()
+        def put(item):
+            # Wait for room in the queue, unless the reader has stopped.
+            while not stop.is_set():
+                try:
+                    blocks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        def prefetch():
+            gen = self.blocks(snapshots)
+            try:
+                for block in gen:
+                    if not put(block): return
+                put(None)
+            except Exception as e:
+                put(e)
+            finally:
+                gen.close()
+        thread = threading.Thread(target=prefetch)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                block = blocks.get()
+                if block is None: break
+                if isinstance(block, Exception): raise block
+                xyzs, boxes = block
+                for i in range(len(xyzs)):
+                    yield xyzs[i], (boxes[i] if boxes is not None else None)
+        finally:
+            stop.set()
+            thread.join()
+
 class AMBER(Engine):
 
     """ Engine for carrying out general purpose AMBER calculations. """
@@ -1193,7 +1624,7 @@ class AMBER(Engine):
         prog = os.path.join(self.amberhome, "bin", csplit[0])
         csplit[0] = prog
         # No need to catch exceptions since failed AMBER calculations will return nonzero exit status.
-        o = _exec(' '.join(csplit), stdin=stdin, print_to_screen=print_to_screen, print_command=print_command, rbytes=1024, **kwargs)
+        o = _exec(' '.join(csplit), stdin=stdin, print_to_screen=print_to_screen, print_command=print_command, **kwargs)
         return o
 
     def prepare(self, pbc=False, **kwargs):
@@ -1248,6 +1679,16 @@ class AMBER(Engine):
         # Figure out the topology information.
         self.leap(read_prmtop=True, count_mols=True)
 
+        ## Updates the prmtop for new parameter values without calling tleap
+        self.patcher = None
+        ## Key identifying the parameters in the last prmtop written by update_prmtop
+        self.prmtop_key = None
+        if hasattr(self,'FF'):
+            try:
+                self.patcher = PrmtopPatcher(PrmtopLoader('%s.prmtop' % self.name), self.FF)
+            except RuntimeError as e:
+                logger.info("%s; tleap will be called for each new set of parameter values.\n" % e)
+
         # I also need to write the trajectory
         if 'boxes' in self.mol.Data.keys():
             logger.info("\x1b[91mWriting %s-all.crd file with no periodic box information\x1b[0m\n" % self.name)
@@ -1319,11 +1760,45 @@ class AMBER(Engine):
         self.leap(read_prmtop=True, count_mols=False)
         return np.array(self.AtomLists['Charge'])
 
+    def update_prmtop(self):
+        """
+        Write the prmtop file for the force field files in the current directory.
+
+        If possible, the prmtop that tleap made when the engine was created is
+        updated with the new parameter values (see PrmtopPatcher) instead of
+        calling tleap again.  tleap is still called the first time that each
+        parameterized field changes, and the updated prmtop is checked against it.
+
+        @return Key identifying the parameters in the prmtop, or None if tleap was called
+        """
+        prmtop = os.path.abspath('%s.prmtop' % self.name)
+        if self.patcher is None:
+            self.leap(read_prmtop=False, count_mols=False, delcheck=True)
+            return None
+        values = self.patcher.read_values()
+        key = (prmtop, tuple(values))
+        if key == self.prmtop_key and os.path.exists(prmtop):
+            return key
+        new = self.patcher.patch(values)
+        check = (values != self.patcher.values0) & ~self.patcher.checked
+        if np.any(check):
+            self.leap(read_prmtop=False, count_mols=False, name='%s-check' % self.name, delcheck=True)
+            if not self.patcher.compare(new, PrmtopLoader('%s-check.prmtop' % self.name)):
+                warn_once("The prmtop updated without tleap differs from the output of tleap; tleap will be called for each new set of parameter values.")
+                self.patcher = None
+                os.rename('%s-check.prmtop' % self.name, prmtop)
+                return None
+            self.patcher.checked |= check
+        new.write(prmtop)
+        self.prmtop_key = key
+        return key
+
     def evaluate_sander(self, leap=True, traj_fnm=None, snapshots=None):
         """ 
         Utility function for computing energy and forces using AMBER. 
-        Coordinates (and boxes, if pbc) are obtained from the 
-        Molecule object stored internally
+        Coordinates (and boxes, if pbc) are obtained from the trajectory
+        file if one is given, or from the Molecule object stored internally.
+        Trajectory files are read a block of frames at a time (see AmberTrajectory).
 
         Parameters
         ----------
@@ -1337,63 +1812,39 @@ class AMBER(Engine):
         # First priority: Passed as input to trajfnm
         # Second priority: Using self.trajectory filename attribute
         # Third priority: Using internal Molecule object
-        # 0 = using internal Molecule object
-        # 1 = using NetCDF trajectory format
-        mode = 0
         if traj_fnm is None and hasattr(self, 'trajectory'):
             traj_fnm = self.trajectory
-        if traj_fnm is not None:
-            try:
-                nc = netcdf_file(traj_fnm, 'r')
-                mode = 1
-            except TypeError:
-                print("Failed to load traj as netcdf, trying to load as Molecule object")
-                mol = Molecule(traj_fnm)
-        else:
-            mol = self.mol
+        traj = AmberTrajectory(traj_fnm if traj_fnm is not None else self.mol, self.natoms)
 
-        def get_coord_box(i):
-            box = None
-            if mode == 0:
-                coords = mol.xyzs[i]
-                if self.pbc:
-                    box = [mol.boxes[i].a, mol.boxes[i].b, mol.boxes[i].c,
-                           mol.boxes[i].alpha, mol.boxes[i].beta, mol.boxes[i].gamma]
-            elif mode == 1:
-                coords = nc.variables['coordinates'].data[i].copy()
-                if self.pbc:
-                    cl = nc.variables['cell_lengths'].data[i].copy()
-                    ca = nc.variables['cell_angles'].data[i].copy()
-                    box = [cl[0], cl[1], cl[2], ca[0], ca[1], ca[2]]
-            return coords, box
-        
-        self.leap(read_prmtop=False, count_mols=False, delcheck=True)
-        cntrl_vars = write_mdin('sp', pbc=self.pbc, mdin_orig=self.mdin)
-        if self.pbc:
-            inp = sander.pme_input()
-        else:
-            inp = sander.gas_input()
-        if 'ntc' in cntrl_vars: inp.ntc = int(cntrl_vars['ntc'])
-        if 'ntf' in cntrl_vars: inp.ntf = int(cntrl_vars['ntf'])
-        if 'cut' in cntrl_vars: inp.cut = float(cntrl_vars['cut'])
-        coord, box = get_coord_box(0)
-        sander.setup("%s.prmtop" % self.name, coord, box, inp)
+        # The sander session is kept between calls, and set up again only if the parameters change.
+        key = self.update_prmtop()
+        setup = key is None or key != _sander_session['key'] or _sander_session['owner'] is not self or not sander.is_setup()
 
         Energies = []
         Forces = []
-        if snapshots == None:
-            if mode == 0:
-                snapshots = range(len(self.mol))
-            elif mode == 1:
-                snapshots = range(nc.variables['coordinates'].shape[0])
         # Keep real atoms in mask.
         # sander API cannot handle virtual sites when igb > 0
         # so these codes are not needed.
         # atomsel = np.where(self.AtomMask)
         # coordsel = sum([i, i+1, i+2] for i in atomsel)
         
-        for i in snapshots:
-            coord, box = get_coord_box(i)
+        for coord, box in traj.frames(snapshots):
+            if not self.pbc:
+                box = None
+            if setup:
+                _sander_cleanup()
+                cntrl_vars = write_mdin('sp', pbc=self.pbc, mdin_orig=self.mdin)
+                if self.pbc:
+                    inp = sander.pme_input()
+                else:
+                    inp = sander.gas_input()
+                if 'ntc' in cntrl_vars: inp.ntc = int(cntrl_vars['ntc'])
+                if 'ntf' in cntrl_vars: inp.ntf = int(cntrl_vars['ntf'])
+                if 'cut' in cntrl_vars: inp.cut = float(cntrl_vars['cut'])
+                sander.setup("%s.prmtop" % self.name, coord, box, inp)
+                _sander_session['owner'] = self
+                _sander_session['key'] = key
+                setup = False
             if self.pbc:
                 sander.set_box(*box)
             sander.set_positions(coord)
@@ -1401,9 +1852,8 @@ class AMBER(Engine):
             Energies.append(e.tot * 4.184)
             frc = np.array(f).flatten() * 4.184 * 10
             Forces.append(frc)
-        sander.cleanup()
-        if mode == 1:
-            nc.close()
+        if key is None:
+            _sander_cleanup()
         Result = OrderedDict()
         Result["Energy"] = np.array(Energies)
         Result["Force"] = np.array(Forces)
@@ -1458,17 +1908,20 @@ class AMBER(Engine):
         # Gather the results
         Result = OrderedDict()
         if potential:
-            esander_lines = list(open('esander.txt').readlines())
-            ie = 0
-            for iw, w in enumerate(esander_lines[0].split()):
-                if w == "POTENTIAL[total]":
-                    ie = iw
-            if ie == 0:
-                raise RuntimeError("Cannot find field corresponding to total energies")
-            potentials = np.array([float(line.split()[ie]) for line in esander_lines[1:]])*4.184
+            # The output files have one line per frame, so they are read line by line.
+            with open('esander.txt') as f:
+                ie = 0
+                for iw, w in enumerate(next(f).split()):
+                    if w == "POTENTIAL[total]":
+                        ie = iw
+                if ie == 0:
+                    raise RuntimeError("Cannot find field corresponding to total energies")
+                potentials = np.array([float(line.split()[ie]) for line in f])*4.184
             Result["Potentials"] = potentials
         # Convert e*Angstrom to debye
-        dipoles = np.array([[float(w) for w in line.split()[1:4]] for line in list(open("dipoles.txt").readlines())[1:]]) / 0.20819434
+        with open("dipoles.txt") as f:
+            next(f)
+            dipoles = np.array([[float(w) for w in line.split()[1:4]] for line in f]) / 0.20819434
         Result["Dips"] = dipoles
         # Volume of simulation boxes in cubic nanometers
         # Conversion factor derived from the following:
@@ -1476,7 +1929,9 @@ class AMBER(Engine):
         # Out[22]: 1.6605387831627252
         conv = 1.6605387831627252
         if self.pbc:
-            volumes = np.array([float(line.split()[1]) for line in list(open("volumes.txt").readlines())[1:]])/1000
+            with open("volumes.txt") as f:
+                next(f)
+                volumes = np.array([float(line.split()[1]) for line in f])/1000
             densities = conv * np.sum(self.AtomLists['Mass']) / volumes
             Result["Volumes"] = volumes
             Result["Rhos"] = densities
@@ -142,17 +142,25 @@ def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=F
     GDz      = np.zeros((FF.np,length))
     if not AGrad:
         return G, GDx, GDy, GDz
-    def energy_driver(mvals_):
-        FF.make(mvals_)
-        if dipole:
-            return engine.energy_dipole()
-        else:
-            return engine.energy()
-
-    ED0      = energy_driver(mvals)
+    # Parameters that the energy depends on linearly are differentiated by the
+    # engine directly; they do not change the charges or the dipole.
+    linear   = engine.linear_parameters(mvals, pgrad)
+    EGlin    = engine.linear_derivatives(linear)
+    for i in EGlin:
+        G[i,:]   = EGlin[i]
+    pgrad    = [i for i in pgrad if i not in EGlin]
+    # Evaluate the central and displaced parameter values together,
+    # so that the engine may loop over the trajectory only once.
+    mvals_list = [mvals]
     for i in pgrad:
+        for d in [-1, 1]:
+            mvals_ = list(mvals)
+            mvals_[i] += d*h
+            mvals_list.append(mvals_)
+    EDs      = engine.energy_multi(mvals_list, dipole=dipole)
+    for n, i in enumerate(pgrad):
         logger.info("%i %s\r" % (i, (FF.plist[i] + " "*30)))
-        EDG, _   = f12d3p(fdwrap(energy_driver,mvals,i),h,f0=ED0)
+        EDG      = (EDs[2*n+2]-EDs[2*n+1])/(2*h)
         if dipole:
             G[i,:]   = EDG[:,0]
             GDx[i,:] = EDG[:,1]
@@ -312,6 +320,7 @@ def main():
         EngOpts["lipid"]["nonbonded_cutoff"] = TgtOptions["nonbonded_cutoff"]
     if "vdw_cutoff" in TgtOptions:
         EngOpts["lipid"]["vdw_cutoff"] = TgtOptions["vdw_cutoff"]
+    EngOpts["lipid"]["linear_deriv"] = TgtOptions.get("linear_deriv", False)
     GenOpts = OrderedDict([('FF', FF)])
     if engname == "openmm":
         # OpenMM-specific options
@@ -353,6 +362,10 @@ def main():
                                     ("threads", threads), ("anisotropic", anisotropic), 
                                     ("mts", mts), ("faststep", faststep), ("bilayer", True)])
 
+    # Keep the saved coordinates in a memory-mapped file for long OpenMM simulations; it is deleted at the end.
+    if engname == "openmm" and TgtOptions.get('md_spill', 0):
+        MDOpts["lipid"]["spill"] = "lipid-xyzs.npy"
+
     # Energy components analysis disabled for OpenMM MTS because it uses force groups
     if (engname == "openmm" and mts): logger.warn("OpenMM with MTS integrator; energy components analysis will be disabled.\n")
 
@@ -702,6 +715,8 @@ def main():
 
     logger.info("Writing all simulation data to disk.\n")
     lp_dump((Rhos, Volumes, Potentials, Energies, Dips, G, [GDx, GDy, GDz], Rho_err, Alpha_err, Kappa_err, Cp_err, Eps0_err, NMol, Als, Al_err, Scds, Scd_err, LKappa_err),'npt_result.p')
+    if os.path.exists("lipid-xyzs.npy"):
+        os.remove("lipid-xyzs.npy")
 
 
 if __name__ == "__main__":
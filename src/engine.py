@@ -92,3 +92,66 @@ class Engine(forcebalance.BaseClass):
 
     def prepare(self, **kwargs):
         return
+
+    def energy_multi(self, mvals_list, dipole=False):
+        """
+        Compute the energies (and optionally dipoles) of the stored
+        snapshots for several sets of parameter values, as needed
+        for finite difference derivatives of the energies.
+
+        This default implementation writes the force field and evaluates
+        the whole trajectory once for each set of parameters.  Engines
+        may override it to loop over the snapshots only once.
+
+        @param[in] mvals_list List of mathematical parameter values
+        @param[in] dipole Switch for dipoles
+        @return List of arrays returned by energy() or energy_dipole(), one per set of parameters
+        """
+        Answer = []
+        for mvals in mvals_list:
+            self.FF.make(mvals)
+            Answer.append(self.energy_dipole() if dipole else self.energy())
+        return Answer
+
+    def energy_force_multi(self, mvals_list):
+        """
+        Compute the energies and forces of the stored snapshots for
+        several sets of parameter values, as needed for finite difference
+        derivatives.  Like energy_multi(), this default implementation
+        evaluates the whole trajectory once for each set of parameters.
+
+        @param[in] mvals_list List of mathematical parameter values
+        @return List of arrays returned by energy_force(), one per set of parameters
+        """
+        Answer = []
+        for mvals in mvals_list:
+            self.FF.make(mvals)
+            Answer.append(self.energy_force())
+        return Answer
+
+    def linear_parameters(self, mvals, pids):
+        """
+        Find the parameters in pids that the energy depends on linearly,
+        so that their derivatives may be computed by linear_derivatives()
+        instead of finite differences.
+
+        The default implementation does not know of any such parameters,
+        so every derivative is computed by finite difference.
+
+        @param[in] mvals Mathematical parameter values
+        @param[in] pids Indices of the parameters to check
+        @return OrderedDict with the linear parameters as keys; the values are used by linear_derivatives()
+        """
+        return OrderedDict()
+
+    def linear_derivatives(self, linear, force=False, traj=True):
+        """
+        Compute the derivatives of the energies (and optionally forces)
+        with respect to the parameters returned by linear_parameters().
+
+        @param[in] linear Dictionary returned by linear_parameters()
+        @param[in] force Switch for the derivatives of the forces
+        @param[in] traj Loop over the stored snapshots; otherwise use the current geometry
+        @return OrderedDict of parameter index : derivatives shaped like the output of energy() or energy_force()
+        """
+        return OrderedDict()
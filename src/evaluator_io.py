@@ -195,6 +195,8 @@ class Evaluator_SMIRNOFF(Target):
         # Store a mapping between gradient keys and the force balance string representation.
         self._gradient_key_mappings = {}
         self._parameter_units = {}
+        # Store the force balance parameter field that each gradient key was built from.
+        self._gradient_key_fields = {}
 
         # Store a copy of the objective function details from the previous optimisation cycle.
         self._last_obj_details = {}
@@ -384,6 +386,12 @@ class Evaluator_SMIRNOFF(Target):
         respect to physical parameters to gradients with respect to
         force balance mathematical parameters.
 
+        The physical value of each parameter is its force balance physical
+        parameter times a constant multiplier, so the matrix is obtained
+        from the analytic `FF.pvals_jacobian`.  Finite differences are
+        only used if a parameter is evaluated from an expression in the
+        force field file.
+
         Parameters
         ----------
         mvals: np.ndarray
@@ -398,6 +406,21 @@ class Evaluator_SMIRNOFF(Target):
             A matrix of d(Physical Parameter)/d(Mathematical Parameter).
         """
 
+        if all(
+            field_list[5] is None and field_list[0] in self.FF.map
+            for field_list in self._gradient_key_fields.values()
+        ):
+
+            pvals_jacobian = self.FF.pvals_jacobian(mvals)
+            jacobian = np.zeros((len(mvals), len(self._gradient_key_mappings)))
+
+            for gradient_key, parameter_index in self._gradient_key_mappings.items():
+
+                pid, _, _, _, mult, _ = self._gradient_key_fields[gradient_key]
+                jacobian[:, parameter_index] = mult * pvals_jacobian[:, self.FF.map[pid]]
+
+            return jacobian
+
         jacobian_list = []
 
         for index in range(len(mvals)):
@@ -461,6 +484,7 @@ class Evaluator_SMIRNOFF(Target):
 
         self._gradient_key_mappings = {}
         self._parameter_units = {}
+        self._gradient_key_fields = {}
 
         if AGrad is True:
 
@@ -503,6 +527,7 @@ class Evaluator_SMIRNOFF(Target):
 
                 self._gradient_key_mappings[parameter_gradient_key] = index_counter
                 self._parameter_units[parameter_gradient_key] = parameter_unit
+                self._gradient_key_fields[parameter_gradient_key] = field_list
 
                 index_counter += 1
 
@@ -128,6 +128,20 @@ def in_fd_srch():
 
     return any([i in [j[2] for j in traceback.extract_stack()] for i in ['f1d2p','f12d3p','f1d5p','f12d7p','f1d7p','search_fun']])
 
+## Whether this process is one of the worker processes started by Target.fd_map.
+_fd_worker_process = False
+
+def set_fd_worker():
+    """ Mark the current process as a finite-difference worker; this is the initializer of the process pool in Target.fd_map. """
+    global _fd_worker_process
+    _fd_worker_process = True
+
+def in_fd_worker():
+    """ Invoking this function from anywhere will tell us whether we're running in one of the worker processes of Target.fd_map.
+    Engines use this to run their own evaluations serially, since the displacements are already being evaluated in parallel. """
+
+    return _fd_worker_process
+
 def fdwrap(func,mvals0,pidx,key=None,**kwargs):
     """
     A function wrapper for finite difference designed for
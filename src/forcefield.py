@@ -101,6 +101,8 @@ import os
 import sys
 import numpy as np
 import networkx as nx
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 from numpy import sin, cos, tan, sinh, cosh, tanh, exp, log, sqrt, pi
 from re import match, sub, split
 import forcebalance
@@ -192,6 +194,67 @@ class BackedUpDict(dict):
             logger.error('The key %s does not exist as an atom attribute or as an atom type attribute!\n' % key)
             raise KeyError
 
+def txt_format(number, precision):
+    """ Format a parameter value for printing to a text force field file. """
+    if precision == 12:
+        return "% 17.12e" % (number)
+    SciNot = "%% .%ie" % precision
+    if abs(number) < 1000 and abs(number) > 0.001:
+        Decimal = "%% .%if" % precision
+        Num = Decimal % number
+        Mum = Decimal % (-1 * number)
+        if (float(Num) == float(Mum)):
+            return Decimal % abs(number)
+        else:
+            return Decimal % number
+    else:
+        Num = SciNot % number
+        Mum = SciNot % (-1 * number)
+        if (float(Num) == float(Mum)):
+            return SciNot % abs(number)
+        else:
+            return SciNot % number
+
+class TxtLinePlan(object):
+    """ Substitution plan for the parameters on one line of a text force field.
+
+    The line is split into words and whitespace once, when the force
+    field is read.  FF.make then only formats the new values and joins
+    the lists, following the same whitespace rules as
+    FF.substitute_txt_line, which splits the line again for every field.
+    """
+    def __init__(self, sline, whites, flds):
+        ## Words of the original line
+        self.sline = sline
+        ## Whitespace in front of each word (the first entry is empty if the line starts with a word)
+        self.whites = whites
+        ## Word positions of the parameters, in the order they are substituted
+        self.flds = flds
+
+    def substitute(self, vals, precision):
+        sline = list(self.sline)
+        whites = list(self.whites)
+        for fld, wval in zip(self.flds, vals):
+            old = sline[fld]
+            # Subtract one whitespace, unless the word begins with a minus sign.
+            if old[:1] != '-' and len(whites[fld]) > 1:
+                whites[fld] = whites[fld][:-1]
+            newrd = txt_format(wval, precision)
+            Lold = len(old) if old[:1] == '-' else len(old) + 1
+            Lnew = len(newrd)
+            if Lnew > Lold:
+                Shave = Lnew - Lold
+                if Shave < (len(whites[fld+1])+2):
+                    whites[fld+1] = whites[fld+1][:-Shave]
+            # Rejoining and splitting the line turns empty separators into single spaces,
+            # drops whitespace after the last word, and moves the blanks in front of the
+            # new word into its separator.
+            word = newrd.lstrip(' ')
+            whites = [w if (len(w) > 0 or j == 0) else ' ' for j, w in enumerate(whites[:len(sline)])]
+            whites[fld] += newrd[:len(newrd)-len(word)]
+            sline[fld] = word
+        return ''.join([whites[j]+sline[j] for j in range(len(sline))])+'\n'
+
 class FF(forcebalance.BaseClass):
     """ Force field class.
 
@@ -265,12 +328,19 @@ class FF(forcebalance.BaseClass):
         self.pTree       = nx.DiGraph()
         # unit strings that might appear in offxml file
         self.offxml_unit_strs = defaultdict(str)
+        ## Force field data and values from the last call to make(), so that
+        ## only the fields and files that changed are rewritten
+        self.make_cache  = None
+        ## Substitution plans for the text force field lines that contain parameters
+        self.txt_plans   = OrderedDict()
         ## List of rescaling factors
         self.rs          = []
-        ## The transformation matrix for mathematical -> physical parameters
+        ## The transformation matrix for mathematical -> physical parameters (sparse)
         self.tm          = None
         ## The transpose of the transformation matrix
         self.tmI         = None
+        ## Pseudo-inverse of tmI, built on the first call to create_mvals
+        self.tmI_inv     = None
         ## Indices to exclude from optimization / Hessian inversion
         self.excision    = None
         ## The total number of parameters
@@ -330,6 +400,8 @@ class FF(forcebalance.BaseClass):
         self.mktransmat()
         ## Redirection dictionary (experimental).
         self.redirect = {}
+        ## Mask of parameters that are not allowed to change sign.
+        self.sign_guard = self.make_sign_guard()
         ## Destruction dictionary (experimental).
         self.linedestroy_save = []
         self.prmdestroy_save = []
@@ -346,7 +418,8 @@ class FF(forcebalance.BaseClass):
         return cls(options, verbose=False, printopt=False)
 
     def __getstate__(self):
-        state = deepcopy(self.__dict__)
+        state = deepcopy(dict([(k, v) for k, v in self.__dict__.items() if k != 'make_cache']))
+        state['make_cache'] = None
         for ffname in self.ffdata:
             if self.ffdata_isxml[ffname]:
                 temp = etree.tostring(self.ffdata[ffname])
@@ -360,6 +433,8 @@ class FF(forcebalance.BaseClass):
             if self.ffdata_isxml[ffname]:
                 temp = etree.ElementTree(etree.fromstring(self.ffdata[ffname]))
                 self.ffdata[ffname] = temp
+        if 'sign_guard' not in state:
+            self.sign_guard = self.make_sign_guard()
 
     def addff(self,ffname,xmlScript=False):
         """ Parse a force field file and add it to the class.
@@ -648,6 +723,71 @@ class FF(forcebalance.BaseClass):
                     #self.patoms[prep].append(self.Readers[ffname].molatom)
                     self.assign_field(None,pid,ffname,ln,pfld,None,evalcmd)
                     parse += 2
+        self.compile_txt_plans(ffname)
+
+    def compile_txt_plans(self, ffname):
+        """ Build the substitution plans for the lines of a text force field that contain parameters.
+
+        A plan is built when the words and the whitespace in front of each
+        word, as split by the reader, join back into the original line
+        (i.e. they give the offset and width of every field).  Other lines,
+        e.g. those with tabs between the words, are left to substitute_txt_line.
+
+        @param[in] ffname The name of the force field file
+        """
+        lines = OrderedDict()
+        for pid, fnm, ln, fld, mult, cmd in self.pfields:
+            if fnm == ffname:
+                lines.setdefault(ln, []).append(fld)
+        for ln, flds in lines.items():
+            line = self.ffdata[ffname][ln]
+            sline = self.Readers[ffname].Split(line)
+            whites = self.Readers[ffname].Whites(line)
+            if line[0] != ' ':
+                whites = [''] + whites
+            if len(whites) < len(sline) or ''.join([whites[j]+sline[j] for j in range(len(sline))]) != line.rstrip():
+                continue
+            self.txt_plans[(ffname, ln)] = TxtLinePlan(sline, whites, flds)
+
+    def substitute_txt_line(self, fnm, line, flds, vals, precision):
+        """ Substitute parameter values into a line of a text force field.
+
+        We take care to preserve whitespace in the printout so that the
+        new force field still has nicely formated columns.
+
+        @param[in] fnm The name of the force field file
+        @param[in] line The original line
+        @param[in] flds Word positions of the parameters on the line
+        @param[in] vals Values to be printed
+        @param[in] precision Number of decimal points to print out
+        @return line The new line
+        """
+        for fld, wval in zip(flds, vals):
+            # Split the string into whitespace and data fields.
+            sline       = self.Readers[fnm].Split(line)
+            whites      = self.Readers[fnm].Whites(line)
+            # Align whitespaces and fields (it should go white, field, white, field)
+            if line[0] != ' ':
+                whites = [''] + whites
+            # Subtract one whitespace, unless the line begins with a minus sign.
+            if not match('^-',sline[fld]) and len(whites[fld]) > 1:
+                whites[fld] = whites[fld][:-1]
+            # Actually replace the field with the physical parameter value.
+            newrd = txt_format(wval, precision)
+            # The new word might be longer than the old word.
+            # If this is the case, we can try to shave off some whitespace.
+            Lold = len(sline[fld])
+            if not match('^-',sline[fld]):
+                Lold += 1
+            Lnew = len(newrd)
+            if Lnew > Lold:
+                Shave = Lnew - Lold
+                if Shave < (len(whites[fld+1])+2):
+                    whites[fld+1] = whites[fld+1][:-Shave]
+            sline[fld] = newrd
+            # Replace the line in the new force field.
+            line = ''.join([(whites[j] if (len(whites[j]) > 0 or j == 0) else ' ')+sline[j] for j in range(len(sline))])+'\n'
+        return line
 
     def addff_xml(self, ffname):
         """ Parse an XML force field file and create important instance variables.
@@ -784,27 +924,26 @@ class FF(forcebalance.BaseClass):
             pvals = self.create_pvals(vals)
 
         OMMFormat = "%%.%ie" % precision
-        def TXTFormat(number, precision):
-            SciNot = "%% .%ie" % precision
-            if abs(number) < 1000 and abs(number) > 0.001:
-                Decimal = "%% .%if" % precision
-                Num = Decimal % number
-                Mum = Decimal % (-1 * number)
-                if (float(Num) == float(Mum)):
-                    return Decimal % abs(number)
-                else:
-                    return Decimal % number
-            else:
-                Num = SciNot % number
-                Mum = SciNot % (-1 * number)
-                if (float(Num) == float(Mum)):
-                    return SciNot % abs(number)
-                else:
-                    return SciNot % number
 
         pvals = list(pvals)
         # pvec1d(vals, precision=4)
-        newffdata = deepcopy(self.ffdata)
+        # The copy of the force field data from the last call is patched in place;
+        # only the fields whose values changed are regenerated.
+        if getattr(self, 'make_cache', None) is None or self.make_cache['precision'] != precision:
+            newffdata = deepcopy(self.ffdata)
+            # Text force field lines -> indices of the pfields on each line
+            txt_lines = OrderedDict()
+            for i, pfield in enumerate(self.pfields):
+                if not self.ffdata_isxml[pfield[1]]:
+                    txt_lines.setdefault((pfield[1], pfield[2]), []).append(i)
+            self.make_cache = {'precision' : precision, 'ffdata' : newffdata, 'txt_lines' : txt_lines,
+                               'xml_lines' : OrderedDict([(fnm, list(newffdata[fnm].iter())) for fnm in newffdata if self.ffdata_isxml[fnm]]),
+                               'wvals' : [None for i in range(len(self.pfields))],
+                               'version' : OrderedDict([(fnm, 0) for fnm in newffdata]), 'written' : {}}
+        newffdata = self.make_cache['ffdata']
+        xml_lines = self.make_cache['xml_lines']
+        wvals = self.make_cache['wvals']
+        version = self.make_cache['version']
 
         # The dictionary that takes parameter names to physical values.
         PRM = {i:pvals[self.map[i]] for i in self.map}
@@ -813,8 +952,8 @@ class FF(forcebalance.BaseClass):
         #     Print the new force field.       #
         #======================================#
 
-        xml_lines = OrderedDict([(fnm, list(newffdata[fnm].iter())) for fnm in self.fnms if self.ffdata_isxml[fnm]])
-
+        changed_fnms = set()
+        changed_lines = set()
         for i in range(len(self.pfields)):
             pfield = self.pfields[i]
             pid,fnm,ln,fld,mult,cmd = pfield
@@ -838,6 +977,10 @@ class FF(forcebalance.BaseClass):
                     raise RuntimeError
             else:
                 wval = mult*pvals[self.map[pid]]
+            # Nothing to do if the value is the same as last time.
+            if wval == wvals[i]: continue
+            wvals[i] = wval
+            changed_fnms.add(fnm)
             if self.ffdata_isxml[fnm]:
                 # offxml files with version higher than 0.3 may have unit strings in the field
                 xml_lines[fnm][ln].attrib[fld] = OMMFormat % (wval) + self.offxml_unit_strs[pid]
@@ -846,39 +989,36 @@ class FF(forcebalance.BaseClass):
                 if hasattr(self, 'offxml') and fnm == self.offxml:
                     assign_openff_parameter(self.openff_forcefield, wval, pid)
                 # list(newffdata[fnm].iter())[ln].attrib[fld] = OMMFormat % (wval)
-            # Text force fields are a bit harder.
-            # Our pointer is given by the line and field number.
-            # We take care to preserve whitespace in the printout
-            # so that the new force field still has nicely formated
-            # columns.
             else:
-                # Split the string into whitespace and data fields.
-                sline       = self.Readers[fnm].Split(newffdata[fnm][ln])
-                whites      = self.Readers[fnm].Whites(newffdata[fnm][ln])
-                # Align whitespaces and fields (it should go white, field, white, field)
-                if newffdata[fnm][ln][0] != ' ':
-                    whites = [''] + whites
-                # Subtract one whitespace, unless the line begins with a minus sign.
-                if not match('^-',sline[fld]) and len(whites[fld]) > 1:
-                    whites[fld] = whites[fld][:-1]
-                # Actually replace the field with the physical parameter value.
-                if precision == 12:
-                    newrd  = "% 17.12e" % (wval)
-                else:
-                    newrd  = TXTFormat(wval, precision)
-                # The new word might be longer than the old word.
-                # If this is the case, we can try to shave off some whitespace.
-                Lold = len(sline[fld])
-                if not match('^-',sline[fld]):
-                    Lold += 1
-                Lnew = len(newrd)
-                if Lnew > Lold:
-                    Shave = Lnew - Lold
-                    if Shave < (len(whites[fld+1])+2):
-                        whites[fld+1] = whites[fld+1][:-Shave]
-                sline[fld] = newrd
-                # Replace the line in the new force field.
-                newffdata[fnm][ln] = ''.join([(whites[j] if (len(whites[j]) > 0 or j == 0) else ' ')+sline[j] for j in range(len(sline))])+'\n'
+                changed_lines.add((fnm, ln))
+
+        # Text force fields are a bit harder.
+        # Our pointer is given by the line and field number.
+        # A changed line is rebuilt from the original line by
+        # substituting all of its fields in order, using the plan
+        # compiled when the file was read if there is one.
+        txt_plans = getattr(self, 'txt_plans', {})
+        for (fnm, ln) in changed_lines:
+            idx = self.make_cache['txt_lines'][(fnm, ln)]
+            vals = [wvals[i] for i in idx]
+            if (fnm, ln) in txt_plans:
+                newffdata[fnm][ln] = txt_plans[(fnm, ln)].substitute(vals, precision)
+            else:
+                newffdata[fnm][ln] = self.substitute_txt_line(fnm, self.ffdata[fnm][ln], [self.pfields[i][3] for i in idx], vals, precision)
+
+        for fnm in changed_fnms:
+            version[fnm] += 1
+            if 'Script.txt' in fnm:
+                # if the xml file contains a script, ForceBalance will generate
+                # a temporary .txt file containing the script and any updates.
+                # We copy the updates made in the .txt file into the xml file by:
+                #   First, find xml file corresponding to this .txt file
+                #   Second, copy context of the .txt file into the text attribute
+                #           of the script element (assumed to be the last element)
+                #   Third, write out the updated xml file below
+                fnmXml = fnm.split('Script')[0]+'.xml'
+                xml_lines[fnmXml][-1].text = "".join(newffdata[fnm])
+                version[fnmXml] += 1
 
         if printdir is not None:
             absprintdir = os.path.join(self.root,printdir)
@@ -889,34 +1029,34 @@ class FF(forcebalance.BaseClass):
             logger.info('Creating the directory %s to print the force field\n' % absprintdir)
             os.makedirs(absprintdir)
 
+        written = self.make_cache['written']
         for fnm in newffdata:
+            # The script is printed as part of the xml file.
+            if 'Script.txt' in fnm: continue
+            fpath = os.path.join(absprintdir,fnm)
+            # Skip files that were already printed here with the same contents and haven't been touched since.
+            if fpath in written and os.path.exists(fpath):
+                fstat = os.stat(fpath)
+                if written[fpath] == (version[fnm], fstat.st_ino, fstat.st_mtime_ns, fstat.st_size): continue
             if self.ffdata_isxml[fnm]:
-                with wopen(os.path.join(absprintdir,fnm), binary=True) as f: newffdata[fnm].write(f)
-            elif 'Script.txt' in fnm:
-                # if the xml file contains a script, ForceBalance will generate
-                # a temporary .txt file containing the script and any updates.
-                # We copy the updates made in the .txt file into the xml file by:
-                #   First, find xml file corresponding to this .txt file
-                #   Second, copy context of the .txt file into the text attribute
-                #           of the script element (assumed to be the last element)
-                #   Third. open the updated xml file as in the if statement above
-                tempText = "".join(newffdata[fnm])
-                fnmXml = fnm.split('Script')[0]+'.xml'
-                Ntemp = len(list(newffdata[fnmXml].iter()))
-                list(newffdata[fnmXml].iter())[Ntemp-1].text = tempText
-                '''
-                scriptElements = [elem for elem in fflist if elem.tag=='Script']
-                if len(scriptElements) > 1:
-                logger.error('XML file'+ffname+'contains more than one script! Consolidate your scripts into one script!\n')
-                raise RuntimeError
-                else:
-                '''
-                with wopen(os.path.join(absprintdir,fnmXml), binary=True) as f: newffdata[fnmXml].write(f)
+                with wopen(fpath, binary=True) as f: newffdata[fnm].write(f)
             else:
-                with wopen(os.path.join(absprintdir,fnm)) as f: f.writelines(newffdata[fnm])
+                with wopen(fpath) as f: f.writelines(newffdata[fnm])
+            fstat = os.stat(fpath)
+            written[fpath] = (version[fnm], fstat.st_ino, fstat.st_mtime_ns, fstat.st_size)
 
         return pvals
 
+    def forget_written(self):
+        """ Forget which force field files have been printed by make(), so the next call prints all of them.
+
+        make() skips files whose modification time and size haven't changed since it printed them,
+        but this can miss a rewrite of the same size by another process on a filesystem with coarse
+        timestamps.  This is called after forked worker processes may have printed force field files.
+        """
+        if getattr(self, 'make_cache', None) is not None:
+            self.make_cache['written'].clear()
+
     def make_redirect(self,mvals):
         Groups = defaultdict(list)
         for p, pid in enumerate(self.plist):
@@ -992,6 +1132,12 @@ class FF(forcebalance.BaseClass):
                 spacdict[gnm] = np.mean(np.array(spacs))
         return spacdict
 
+    def make_sign_guard(self):
+        """ Boolean mask of the parameters that create_pvals does not allow to change sign
+        (polarizabilities and van der Waals well depths). """
+        concern= ['polarizability','epsilon','VDWT']
+        return np.array([any([j in pid for j in concern]) for pid in self.plist], dtype=bool)
+
     def create_pvals(self,mvals):
         """Converts mathematical to physical parameters.
 
@@ -1005,8 +1151,10 @@ class FF(forcebalance.BaseClass):
         """
         if isinstance(mvals, list):
             mvals = np.array(mvals)
-        for p in self.redirect:
-            mvals[p] = 0.0
+        if self.redirect:
+            rsrc = np.array(list(self.redirect.keys()), dtype=int)
+            rdst = np.array(list(self.redirect.values()), dtype=int)
+            mvals[rsrc] = 0.0
         if self.logarithmic_map:
             try:
                 pvals = np.exp(mvals.flatten()) * self.pvals0
@@ -1015,28 +1163,58 @@ class FF(forcebalance.BaseClass):
                 logger.error('What the hell did you do?\n')
                 raise RuntimeError
         else:
-            pvals = flat(np.dot(self.tmI,col(mvals))) + self.pvals0
-        concern= ['polarizability','epsilon','VDWT']
+            pvals = flat(self.tmI.dot(flat(mvals))) + self.pvals0
         # Guard against certain types of parameters changing sign.
-
-        for i in range(self.np):
-            if any([j in self.plist[i] for j in concern]) and pvals[i] * self.pvals0[i] < 0:
-                #print "Parameter %s has changed sign but it's not allowed to! Setting to zero." % self.plist[i]
-                pvals[i] = 0.0
+        pvals[self.sign_guard & (pvals * self.pvals0 < 0)] = 0.0
         # Redirect parameters (for the fusion penalty function.)
-        for p in self.redirect:
-            pvals[p] = pvals[self.redirect[p]]
+        if self.redirect:
+            pvals[rsrc] = pvals[rdst]
         # if not in_fd():
         #     print pvals
         #print "pvals = ", pvals
 
         return pvals
 
+    def pvals_jacobian(self,mvals):
+        """Derivatives of the physical parameters with respect to the mathematical parameters.
+
+        The map in create_pvals is either affine or elementwise exponential,
+        so the Jacobian is computed in closed form instead of calling make()
+        twice per parameter.  Parameters that are zeroed by the sign guard
+        have zero derivatives, and redirected parameters take the derivatives
+        of the parameter they point to.
+
+        @param[in] mvals The mathematical parameters
+        @return J The Jacobian with J[i, j] = d(pvals[j])/d(mvals[i])
+
+        """
+        mvals = np.array(mvals, dtype=float).flatten()
+        if self.use_pvals:
+            return np.eye(self.np)
+        if self.redirect:
+            rsrc = np.array(list(self.redirect.keys()), dtype=int)
+            rdst = np.array(list(self.redirect.values()), dtype=int)
+            mvals[rsrc] = 0.0
+        if self.logarithmic_map:
+            pvals = np.exp(mvals) * self.pvals0
+            J = np.diag(pvals)
+        else:
+            pvals = flat(self.tmI.dot(mvals)) + self.pvals0
+            J = self.tmI.T.toarray() if sparse.issparse(self.tmI) else np.array(self.tmI, dtype=float).T.copy()
+        # Redirected mathematical parameters are set to zero in create_pvals.
+        if self.redirect:
+            J[rsrc, :] = 0.0
+        # Columns of parameters that are set to zero by the sign guard.
+        J[:, self.sign_guard & (pvals * self.pvals0 < 0)] = 0.0
+        if self.redirect:
+            J[:, rsrc] = J[:, rdst]
+        return J
 
     def create_mvals(self,pvals):
         """Converts physical to mathematical parameters.
 
-        We create the inverse transformation matrix using SVD.
+        We create the inverse transformation matrix using SVD of its
+        blocks; it is computed once and stored.
 
         @param[in] pvals The physical parameters
         @return mvals The mathematical parameters
@@ -1045,7 +1223,9 @@ class FF(forcebalance.BaseClass):
         if self.logarithmic_map:
             logger.error('create_mvals has not been implemented for logarithmic_map\n')
             raise RuntimeError
-        mvals = flat(np.dot(invert_svd(self.tmI), col(pvals-self.pvals0)))
+        if getattr(self, 'tmI_inv', None) is None:
+            self.tmI_inv = self.invert_transmat()
+        mvals = flat(self.tmI_inv.dot(flat(pvals)-self.pvals0))
 
         return mvals
 
@@ -1251,6 +1431,10 @@ class FF(forcebalance.BaseClass):
 
         'transmat': 'qmat2' with rows and columns scaled using self.rs
 
+        qmat2 and transmat are sparse matrices; the charge constraint blocks
+        are the only off-diagonal entries, so the memory scales with the
+        number of parameters rather than its square.
+
         'excision': Parameter indices that need to be 'cut out' because they are irrelevant and
                     mess with the matrix diagonalization
 
@@ -1263,18 +1447,13 @@ class FF(forcebalance.BaseClass):
         self.qid2   = []
         qnr    = 1
         concern= ['COUL','c0','charge']
-        qmat2 = np.eye(self.np)
+        qmat2 = sparse.identity(self.np, format='dok')
 
         def insert_mat(qtrans2, qmap):
             # Write the qtrans2 block into qmat2.
-            x = 0
-            for i in range(self.np):
-                if i in qmap:
-                    y = 0
-                    for j in qmap:
-                        qmat2[i, j] = qtrans2[x, y]
-                        y += 1
-                    x += 1
+            for x, i in enumerate(sorted(qmap)):
+                for y, j in enumerate(qmap):
+                    qmat2[i, j] = qtrans2[x, y]
 
         def build_qtrans2(tq, qid, qmap):
             """ Build the matrix that ensures the net charge does not change. """
@@ -1405,35 +1584,47 @@ class FF(forcebalance.BaseClass):
         #     print
         # print
 
-        # There is a bad bug here .. this matrix multiplication operation doesn't work!!
-        # I will proceed using loops. This is unsettling.
         # Input matrices are qmat2 and self.rs (diagonal)
-        transmat = np.dot(qmat2, np.diag(self.rs))
-        transmat1 = np.zeros((self.np, self.np))
-        for i in range(self.np):
-            for k in range(self.np):
-                transmat1[i,k] = qmat2[i,k] * self.rs[k]
-
-        # This prints out the difference between the result of matrix multiplication
-        # and the manual multiplication.
-        #print transmat1
-        #print transmat
-        if len(transmat) > 0 and np.max(np.abs(transmat1 - transmat)) > 0.0:
-            logger.warning('The difference between the numpy multiplication and the manual multiplication is \x1b[1;91m%f\x1b[0m, '
-                           'but it should be zero.\n' % np.max(np.abs(transmat1 - transmat)))
-
-            transmat = np.array(transmat1, copy=True)
-        transmatNS = np.array(transmat,copy=True)
-        self.excision = []
-        for i in range(self.np):
-            if abs(transmatNS[i, i]) < 1e-8:
-                self.excision.append(i)
-                transmatNS[i, i] += 1
-        self.excision = list(set(self.excision))
-        for i in self.excision:
-            transmat[i, :] = np.zeros(self.np)
-        self.tm = transmat
-        self.tmI = transmat.T
+        transmat = sparse.csr_matrix(qmat2) @ sparse.diags(np.array(self.rs, dtype=float), format='csr')
+        self.excision = list(set(np.flatnonzero(np.abs(transmat.diagonal()) < 1e-8)))
+        if len(self.excision) > 0:
+            keep = np.ones(self.np)
+            keep[self.excision] = 0.0
+            transmat = sparse.diags(keep, format='csr') @ transmat
+        transmat.eliminate_zeros()
+        self.tm = sparse.csr_matrix(transmat)
+        self.tmI = sparse.csr_matrix(transmat.T)
+        self.tmI_inv = None
+
+    def invert_transmat(self, thresh=1e-12):
+        """ Pseudo-inverse of the transformation matrix tmI as a sparse matrix.
+
+        tmI is block diagonal up to a permutation, with a dense block for each
+        group of coupled parameters (e.g. the charges of a molecule) and single
+        entries elsewhere, so the pseudo-inverse is built from SVDs of the
+        blocks.  This is the same as invert_svd on the full matrix.
+
+        @param[in] thresh The SVD threshold passed to invert_svd
+        @return tmI_inv The pseudo-inverse of tmI
+        """
+        tmI = sparse.csr_matrix(self.tmI)
+        if tmI.shape[0] == 0:
+            return tmI
+        nblk, labels = connected_components(abs(tmI) + abs(tmI.T), directed=False)
+        order = np.argsort(labels, kind='stable')
+        blocks = np.split(order, np.flatnonzero(np.diff(labels[order])) + 1)
+        # Parameters that are not coupled to any others are inverted elementwise.
+        single = np.array([b[0] for b in blocks if len(b) == 1], dtype=int)
+        diag = tmI.diagonal()[single]
+        nz = np.abs(diag) > thresh
+        rows, cols, vals = [single[nz]], [single[nz]], [1.0/diag[nz]]
+        for idx in [b for b in blocks if len(b) > 1]:
+            blk_inv = invert_svd(tmI[idx][:, idx].toarray(), thresh=thresh)
+            r, c = np.nonzero(blk_inv)
+            rows.append(idx[r])
+            cols.append(idx[c])
+            vals.append(blk_inv[r, c])
+        return sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=tmI.shape)
 
     def list_map(self):
         """ Create the plist, which is like a reversed version of the parameter map.  More convenient for printing. """
@@ -1450,14 +1641,14 @@ class FF(forcebalance.BaseClass):
         """Prints out the (physical or mathematical) parameter indices, IDs and values in a visually appealing way."""
         if vals is None:
             vals = self.pvals0
-        logger.info('\n'.join(["%4i [ %s ]" % (self.plist.index(i), "%% .%ie" % precision % float(vals[self.plist.index(i)]) if isfloat(str(vals[self.plist.index(i)])) else (str(vals[self.plist.index(i)]))) + " : " + "%s" % i.split()[0] for i in self.plist]))
+        logger.info('\n'.join(["%4i [ %s ]" % (n, "%% .%ie" % precision % float(vals[n]) if isfloat(str(vals[n])) else (str(vals[n]))) + " : " + "%s" % i.split()[0] for n, i in enumerate(self.plist)]))
         logger.info('\n')
 
     def sprint_map(self,vals = None,precision=4):
         """Prints out the (physical or mathematical) parameter indices, IDs and values to a string."""
         if vals is None:
             vals = self.pvals0
-        out = '\n'.join(["%4i [ %s ]" % (self.plist.index(i), "%% .%ie" % precision % float(vals[self.plist.index(i)]) if isfloat(str(vals[self.plist.index(i)])) else (str(vals[self.plist.index(i)]))) + " : " + "%s" % i.split()[0] for i in self.plist])
+        out = '\n'.join(["%4i [ %s ]" % (n, "%% .%ie" % precision % float(vals[n]) if isfloat(str(vals[n])) else (str(vals[n]))) + " : " + "%s" % i.split()[0] for n, i in enumerate(self.plist)])
         return out
 
     def assign_p0(self,idx,val):
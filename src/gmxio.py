@@ -26,6 +26,7 @@ from forcebalance.moments import Moments
 from forcebalance.vibration import Vibration
 from forcebalance.molecule import Molecule
 from forcebalance.thermo import Thermo
+from forcebalance.finite_difference import in_fd_worker
 from copy import deepcopy
 from forcebalance.qchemio import QChem_Dielectric_Energy
 import itertools
@@ -515,6 +516,169 @@ class ITP_Reader(BaseReader):
             self.suffix = ':' + '-'.join([self.mol,'.'.join(["%s" % i for i in atom])])
         self.molatom = (self.mol, atom if type(atom) is list else [atom])
 
+class XDRFile(object):
+
+    """ Sequential reader for the big-endian XDR encoding used in GROMACS binary files (.trr, .edr). """
+
+    def __init__(self, fnm):
+        with open(fnm, 'rb') as f:
+            self.buf = f.read()
+        self.pos = 0
+
+    def eof(self):
+        return self.pos >= len(self.buf)
+
+    def array(self, dtype, n):
+        """ Read n numbers of the given big-endian NumPy type ('>i4', '>i8', '>f4', '>f8'). """
+        dt = np.dtype(dtype)
+        end = self.pos + dt.itemsize * n
+        if end > len(self.buf):
+            raise RuntimeError("Unexpected end of XDR file")
+        data = np.frombuffer(self.buf, dtype=dt, count=n, offset=self.pos)
+        self.pos = end
+        return data
+
+    def int(self):
+        return int(self.array('>i4', 1)[0])
+
+    def int64(self):
+        return int(self.array('>i8', 1)[0])
+
+    def real(self, double, n=None):
+        data = self.array('>f8' if double else '>f4', 1 if n is None else n)
+        return float(data[0]) if n is None else data.astype(float)
+
+    def skip(self, nbytes):
+        self.pos += nbytes
+
+    def string(self):
+        """ Read an XDR string (length followed by the characters padded to four bytes). """
+        n = self.int()
+        txt = self.buf[self.pos:self.pos+n].decode('ascii', 'replace')
+        self.pos += 4 * ((n + 3) // 4)
+        return txt
+
+def read_trr(fnm):
+
+    """
+    Read a GROMACS .trr trajectory directly, without calling gmxdump or g_traj.
+
+    @param[in] fnm Name of the .trr file
+    @return Answer Dictionary with the frames' 'step', 'time', and (where present in every frame)
+    'box' (nframes x 3 x 3), 'x', 'v', 'f' (nframes x natoms x 3) arrays in GROMACS units (nm, ps, kJ/mol/nm)
+    """
+    xdr = XDRFile(fnm)
+    frames = []
+    while not xdr.eof():
+        if xdr.int() != 1993:
+            logger.error("%s is not a GROMACS .trr file (wrong magic number)\n" % fnm)
+            raise RuntimeError
+        xdr.int()
+        xdr.string()
+        ir_size, e_size, box_size, vir_size, pres_size, top_size, sym_size, x_size, v_size, f_size, natoms, step, nre = xdr.array('>i4', 13)
+        if ir_size or e_size or top_size or sym_size:
+            logger.error("%s contains data blocks that are not supported\n" % fnm)
+            raise RuntimeError
+        # The size of a real number is deduced from the sizes of the data blocks.
+        for size, count in [(box_size, 9), (vir_size, 9), (pres_size, 9), (x_size, 3*natoms), (v_size, 3*natoms), (f_size, 3*natoms)]:
+            if size:
+                double = (size // count == 8)
+                break
+        else:
+            double = False
+        frame = {'step' : int(step), 'time' : xdr.real(double)}
+        xdr.real(double)
+        for key, size, shape in [('box', box_size, (3, 3)), ('vir', vir_size, (3, 3)), ('pres', pres_size, (3, 3)),
+                                 ('x', x_size, (natoms, 3)), ('v', v_size, (natoms, 3)), ('f', f_size, (natoms, 3))]:
+            if size:
+                frame[key] = xdr.real(double, shape[0]*shape[1]).reshape(shape)
+        frames.append(frame)
+    Answer = OrderedDict()
+    for key in ['step', 'time', 'box', 'x', 'v', 'f']:
+        if len(frames) > 0 and all([key in frame for frame in frames]):
+            Answer[key] = np.array([frame[key] for frame in frames])
+    return Answer
+
+def read_edr(fnm):
+
+    """
+    Read the energy terms from a GROMACS .edr file directly, without calling g_energy.
+    Energy files in formats older than GROMACS 4.5 are not supported; None is returned for them.
+
+    @param[in] fnm Name of the .edr file
+    @return names List of energy term names (None if the format is not supported)
+    @return energies Array of energies, nframes x nterms (None if the format is not supported)
+    """
+    xdr = XDRFile(fnm)
+    # Header with the names and units of the energy terms
+    magic = xdr.int()
+    if magic > 0:
+        logger.info("Old energy file format in %s is not supported\n" % fnm)
+        return None, None
+    elif magic != -55555:
+        logger.error("%s is not a GROMACS .edr file (wrong magic number)\n" % fnm)
+        raise RuntimeError
+    file_version = xdr.int()
+    nterms = xdr.int()
+    names = []
+    for i in range(nterms):
+        names.append(xdr.string())
+        if file_version >= 2:
+            xdr.string()
+    # Sizes of the data types that may appear in the subblocks (int, float, double, int64, char)
+    typesize = {0 : 4, 1 : 4, 2 : 8, 3 : 8, 4 : 4}
+    double = None
+    energies = []
+    while not xdr.eof():
+        # Each frame begins with a real number that is used to find the precision.
+        if double is None:
+            pos = xdr.pos
+            for double in [False, True]:
+                xdr.pos = pos
+                if xdr.real(double) < -1e10 and xdr.int() == -7777777: break
+            else:
+                # Frames in old files begin with the time instead.
+                logger.info("Old energy frame format in %s is not supported\n" % fnm)
+                return None, None
+        else:
+            xdr.real(double)
+            if xdr.int() != -7777777:
+                logger.error("Energy frame header mismatch in %s\n" % fnm)
+                raise RuntimeError
+        version = xdr.int()
+        if version < 4:
+            logger.info("Old energy frame format in %s is not supported\n" % fnm)
+            return None, None
+        xdr.skip(16) # time (double) and step (int64)
+        nsum = xdr.int()
+        xdr.skip(8) # nsteps (int64)
+        if version >= 5: xdr.skip(8) # dt (double)
+        nre = xdr.int()
+        xdr.int()
+        nblock = xdr.int()
+        subblocks = []
+        for b in range(nblock):
+            xdr.int()
+            nsub = xdr.int()
+            for j in range(nsub):
+                subblocks.append(tuple(xdr.array('>i4', 2)))
+        xdr.skip(12) # e_size and two reserved integers
+        # Each term is followed by its average and sum if nsum > 0.
+        if nre > 0:
+            ener = xdr.real(double, nre * (3 if nsum > 0 else 1))
+            energies.append(ener[::3] if nsum > 0 else ener)
+        for sbtype, nr in subblocks:
+            if sbtype == 5:
+                for j in range(nr):
+                    xdr.int()
+                    xdr.string()
+            elif sbtype in typesize:
+                xdr.skip(typesize[sbtype]*nr)
+            else:
+                logger.error("Unknown data type in energy frame of %s\n" % fnm)
+                raise RuntimeError
+    return names, np.array(energies)
+
 def rm_gmx_baks(dir):
     # Delete the #-prepended files that GROMACS likes to make
     for root, dirs, files in os.walk(dir):
@@ -528,7 +692,7 @@ class GMX(Engine):
 
     def __init__(self, name="gmx", **kwargs):
         ## Valid GROMACS-specific keywords.
-        self.valkwd = ['gmxsuffix', 'gmxpath', 'gmx_top', 'gmx_mdp', 'gmx_ndx', 'gmx_eq_barostat', 'gmx_pme_order']
+        self.valkwd = ['gmxsuffix', 'gmxpath', 'gmx_top', 'gmx_mdp', 'gmx_ndx', 'gmx_eq_barostat', 'gmx_pme_order', 'fd_workers']
         super(GMX,self).__init__(name=name, **kwargs)
 
     def setopts(self, **kwargs):
@@ -547,6 +711,9 @@ class GMX(Engine):
             warn_once("The 'gmxsuffix' option were not provided; using default.")
             self.gmxsuffix = ''
         
+        ## Number of mdrun processes (MPI ranks) to run at once when evaluating several sets of parameter values
+        self.workers = max(1, kwargs.get('fd_workers', 1))
+
         ## Barostat keyword for equilibration
         if 'gmx_eq_barostat' in kwargs:
             self.gmx_eq_barostat = kwargs['gmx_eq_barostat']
@@ -778,9 +945,10 @@ class GMX(Engine):
         mdpfile = onefile('%s.mdp' % self.name, 'mdp', err=True)
         LinkFile(mdpfile, "%s.mdp" % self.name, nosrcok=True)
 
-    def callgmx(self, command, stdin=None, print_to_screen=False, print_command=False, **kwargs):
+    def callgmx(self, command, stdin=None, print_to_screen=False, print_command=False, mpi=0, **kwargs):
 
-        """ Call GROMACS; prepend the gmxpath to the call to the GROMACS program. """
+        """ Call GROMACS; prepend the gmxpath to the call to the GROMACS program.
+        If mpi is given, the program is launched with that many MPI processes. """
 
         ## Always, always remove backup files.
         rm_gmx_baks(os.getcwd())
@@ -797,6 +965,8 @@ class GMX(Engine):
             csplit[0] = prog + self.gmxsuffix
         else:
             raise RuntimeError('gmxversion can only be 4 or 5')
+        if mpi > 0:
+            csplit = ['mpirun', '-np', '%i' % mpi] + csplit
         return _exec(' '.join(csplit), stdin=stdin, print_to_screen=print_to_screen, print_command=print_command, **kwargs)
 
     def warngmx(self, command, warnings=[], maxwarn=1, **kwargs):
@@ -871,6 +1041,17 @@ class GMX(Engine):
                     except: pass
         return energyterms
 
+    def potential_energies(self, edrfile):
+
+        """ Read the potential energies from an .edr file; g_energy is called for formats that read_edr does not support. """
+
+        names, energies = read_edr(edrfile)
+        if names is not None:
+            return energies[:, names.index('Potential')]
+        xvgfile = os.path.splitext(edrfile)[0] + "-e.xvg"
+        self.callgmx("g_energy -xvg no -f %s -o %s" % (edrfile, xvgfile), stdin='Potential')
+        return np.array([float(line.split()[1]) for line in open(xvgfile)])
+
     def optimize(self, shot, crit=1e-4, align=True, **kwargs):
         
         """ Optimize the geometry and align the optimized geometry to the starting geometry. """
@@ -894,9 +1075,7 @@ class GMX(Engine):
         self.warngmx("grompp -c %s.gro -p %s.top -f %s-min.mdp -o %s-min.tpr" % (self.name, self.name, self.name, self.name))
         self.callgmx("mdrun -deffnm %s-min -nt 1" % self.name)
         self.callgmx("trjconv -f %s-min.trr -s %s-min.tpr -o %s-min.gro -ndec 9" % (self.name, self.name, self.name), stdin="System")
-        self.callgmx("g_energy -xvg no -f %s-min.edr -o %s-min-e.xvg" % (self.name, self.name), stdin='Potential')
-        
-        E = float(open("%s-min-e.xvg" % self.name).readlines()[-1].split()[1])
+        E = self.potential_energies("%s-min.edr" % self.name)[-1]
         M = Molecule("%s.gro" % self.name, build_topology=False) + Molecule("%s-min.gro" % self.name, build_topology=False)
         if not self.pbc:
             M.align(center=False)
@@ -927,20 +1106,24 @@ class GMX(Engine):
         ## Call grompp followed by mdrun.
         self.warngmx("grompp -c %s.gro -p %s.top -f %s-1.mdp -o %s.tpr" % (self.name, self.name, self.name, self.name))
         self.callgmx("mdrun -deffnm %s -nt 1 -rerunvsite %s" % (self.name, "-rerun %s" % traj if traj else ''))
+        return self.gather_results(force, dipole, traj)
+
+    def gather_results(self, force=False, dipole=False, traj=None):
+
+        """ Read the energies, and optionally forces and dipoles, from the output of mdrun in the current directory. """
 
-        ## Gather information
         Result = OrderedDict()
 
         ## Calculate and record energy
-        self.callgmx("g_energy -xvg no -f %s.edr -o %s-e.xvg" % (self.name, self.name), stdin='Potential')
-        Efile = open("%s-e.xvg" % self.name).readlines()
-        Result["Energy"] = np.array([float(Eline.split()[1]) for Eline in Efile])
+        Result["Energy"] = self.potential_energies("%s.edr" % self.name)
 
-        ## Calculate and record force
+        ## Calculate and record force (read directly from the .trr file)
         if force:
-            self.callgmx("g_traj -xvg no -s %s.tpr -f %s.trr -of %s-f.xvg -fp" % (self.name, self.name, self.name), stdin='System')
-            Result["Force"] = np.array([[float(j) for i, j in enumerate(line.split()[1:]) if self.AtomMask[int(i/3)]] \
-                                        for line in open("%s-f.xvg" % self.name).readlines()])
+            trr = read_trr("%s.trr" % self.name)
+            if 'f' not in trr:
+                logger.error("%s.trr does not contain forces for every frame\n" % self.name)
+                raise RuntimeError
+            Result["Force"] = trr['f'][:, np.array(self.AtomMask, dtype=bool), :].reshape(len(trr['f']), -1)
         ## Calculate and record dipole
         if dipole:
             self.callgmx("g_dipoles -s %s.tpr -f %s -o %s-d.xvg -xvg no" % (self.name, traj if traj else '%s.gro' % self.name, self.name), stdin="System\n")
@@ -968,6 +1151,103 @@ class GMX(Engine):
         self.mol[0].write("%s.gro" % self.name)
         return self.evaluate_(force, dipole, traj)
 
+    def mdrun_multidir(self):
+
+        """ Return whether mdrun was built with MPI, so that it can run several directories at once with -multidir. """
+
+        if not hasattr(self, 'multidir'):
+            self.multidir = False
+            if which('mpirun') != '':
+                o = self.callgmx("mdrun -version", copy_stderr=True, persist=True, print_error=False)
+                for line in o:
+                    if line.strip().startswith('MPI library') and 'thread_mpi' not in line and 'MPI' in line.split(':', 1)[-1]:
+                        self.multidir = True
+        return self.multidir
+
+    def evaluate_multi(self, mvals_list, force=False, dipole=False, traj=None):
+
+        """
+        Evaluate variables (energies, force and/or dipole) using GROMACS over a trajectory
+        for several sets of parameter values.
+
+        The force field files for all of the parameter sets are written at once, each
+        into its own subdirectory together with links to the other input files, and
+        grompp is called in each subdirectory.  If mdrun was built with MPI, mdrun -multidir
+        reruns the trajectory for up to fd_workers parameter sets at a time (one MPI rank each),
+        unless this is already one of the worker processes of Target.fd_map;
+        otherwise mdrun is called in each subdirectory in turn.  The subdirectories are removed
+        afterward.
+
+        @param[in] mvals_list List of mathematical parameter values
+        @param[in] force Switch for calculating the force
+        @param[in] dipole Switch for calculating the dipole
+        @param[in] traj Trajectory file name (defaults to the same as evaluate_trajectory)
+        @return List of dictionaries returned by evaluate_trajectory, one per set of parameters
+        """
+        if traj is None:
+            if hasattr(self, 'mdtraj'):
+                traj = self.mdtraj
+            else:
+                traj = "%s-all.gro" % self.name
+        traj = os.path.abspath(traj)
+        self.mol[0].write("%s.gro" % self.name)
+        shot_opts = OrderedDict([("nsteps", 0), ("nstxout", 0), ("nstxtcout", 0), ("nstenergy", 1)])
+        shot_opts["nstfout"] = 1 if force else 0
+        edit_mdp(fin="%s.mdp" % self.name, fout="%s-1.mdp" % self.name, options=shot_opts)
+        # Input files other than the force field, and links that point to force field files.
+        inputs = [f for f in os.listdir('.') if os.path.splitext(f)[1] in ['.top', '.itp', '.mdp', '.gro', '.ndx'] and f not in self.FF.fnms]
+        cwd = os.getcwd()
+        multi = os.path.abspath("%s-multi" % self.name)
+        dirs = [os.path.join(multi, "%i" % s) for s in range(len(mvals_list))]
+        try:
+            for d, mvals in zip(dirs, mvals_list):
+                self.FF.make(mvals, printdir=d)
+                os.chdir(d)
+                for f in inputs:
+                    src = os.path.join(cwd, f)
+                    if os.path.islink(src) and os.path.basename(os.readlink(src)) in self.FF.fnms:
+                        LinkFile(os.path.basename(os.readlink(src)), f)
+                    else:
+                        LinkFile(src, f)
+                self.warngmx("grompp -c %s.gro -p %s.top -f %s-1.mdp -o %s.tpr" % (self.name, self.name, self.name, self.name))
+                os.chdir(cwd)
+            # Inside an fd_map worker the other workers are already busy, so don't multiply the process count.
+            nrun = min(self.workers, len(dirs)) if self.mdrun_multidir() and not in_fd_worker() else 1
+            for b in range(0, len(dirs), nrun):
+                group = dirs[b:b+nrun]
+                if len(group) > 1:
+                    self.callgmx("mdrun -deffnm %s -ntomp 1 -rerunvsite -rerun %s -multidir %s" % (self.name, traj, ' '.join(group)), mpi=len(group))
+                else:
+                    os.chdir(group[0])
+                    self.callgmx("mdrun -deffnm %s -nt 1 -rerunvsite -rerun %s" % (self.name, traj))
+                    os.chdir(cwd)
+            Results = []
+            for d in dirs:
+                os.chdir(d)
+                Results.append(self.gather_results(force, dipole, traj))
+                os.chdir(cwd)
+        finally:
+            os.chdir(cwd)
+            # The results have been read, so the per-displacement inputs and outputs are no longer needed.
+            shutil.rmtree(multi, ignore_errors=True)
+        return Results
+
+    def energy_multi(self, mvals_list, dipole=False):
+
+        """ Compute the energies (and optionally dipoles) using GROMACS over a trajectory for several sets of parameter values. """
+
+        Results = self.evaluate_multi(mvals_list, dipole=dipole)
+        if dipole:
+            return [np.hstack((Result["Energy"].reshape(-1,1), Result["Dipole"])) for Result in Results]
+        return [Result["Energy"] for Result in Results]
+
+    def energy_force_multi(self, mvals_list):
+
+        """ Compute the energies and forces using GROMACS over a trajectory for several sets of parameter values. """
+
+        Results = self.evaluate_multi(mvals_list, force=True)
+        return [np.hstack((Result["Energy"].reshape(-1,1), Result["Force"])) for Result in Results]
+
     def make_gro_trajectory(self, fout=None):
         """ Return the MD trajectory as a Molecule object. """
         if fout is None:
@@ -112,6 +112,8 @@ class Lipid(Target):
         self.set_option(tgt_opts,'anisotropic_box',forceprint=True)
         # Whether to save trajectories (0 = never, 1 = delete after good step, 2 = keep all)
         self.set_option(tgt_opts,'save_traj')
+        # Keep the coordinates saved during OpenMM MD on disk instead of in memory
+        self.set_option(tgt_opts,'md_spill')
 
         #======================================#
         #     Variables which are set here     #
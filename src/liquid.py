@@ -25,6 +25,7 @@ try:
     from lxml import etree
 except: pass
 from pymbar import pymbar
+from scipy import sparse
 import itertools
 from forcebalance.optimizer import Counter
 from collections import defaultdict, namedtuple, OrderedDict
@@ -83,6 +84,69 @@ def weight_info(W, PT, N_k, verbose=True, PTS=None):
         logger.info("InfoContent: % .2f snapshots (%.2f %%)\n" % (I, 100*I/len(W)))
     return C
 
+def fill_weights(weights, phase_points, mbar_points, snapshots):
+    """
+    Fill in the weight matrix with MBAR weights where MBAR was run,
+    and equal weights otherwise.
+
+    The matrix is stored sparse because a phase point without MBAR
+    only has weights on the snapshots of its own trajectory.
+
+    @param[in] weights (N_mbar x K) MBAR weights of the concatenated snapshots from the MBAR points
+    @param[in] phase_points List of phase points for which data exists
+    @param[in] mbar_points List of phase points that were included in MBAR
+    @param[in] snapshots Number of snapshots per phase point
+    @return new_weights Sparse (N_total x N_points) matrix; column m holds the weights at phase point m
+    """
+    rows, cols, vals = [], [], []
+    for m, PT in enumerate(phase_points):
+        if PT in mbar_points:
+            mm = mbar_points.index(PT)
+            for kk, PT1 in enumerate(mbar_points):
+                k = phase_points.index(PT1)
+                logger.debug("Will fill W2[%i:%i,%i] with W1[%i:%i,%i]\n" % (k*snapshots,k*snapshots+snapshots,m,kk*snapshots,kk*snapshots+snapshots,mm))
+                rows.append(np.arange(k*snapshots, (k+1)*snapshots))
+                vals.append(weights[kk*snapshots:(kk+1)*snapshots,mm])
+                cols.append(np.full(snapshots, m))
+        else:
+            logger.debug("Will fill W2[%i:%i,%i] with equal weights\n" % (m*snapshots,(m+1)*snapshots,m))
+            rows.append(np.arange(m*snapshots, (m+1)*snapshots))
+            vals.append(np.ones(snapshots)/snapshots)
+            cols.append(np.full(snapshots, m))
+    return sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(len(phase_points)*snapshots, len(phase_points)))
+
+def reweight_products(W, X, G, mem=256):
+    """
+    Compute the reweighted averages of a set of observables and their
+    products with the energy derivatives at all phase points at once.
+
+    The snapshots are processed in blocks so that the intermediate
+    (snapshots x phase points x observables) array stays within the
+    memory limit; blocks without weight at a phase point are skipped.
+
+    @param[in] W Sparse (N x P) weight matrix from fill_weights
+    @param[in] X (N x Q) array of observables, one column per observable
+    @param[in] G (NP x N) array of energy derivatives for each snapshot
+    @param[in] mem Approximate memory limit for the intermediate array in MB
+    @return Avg (P x Q) array of the weighted averages of each observable
+    @return Prod (NP x P x Q) array of the weighted sums of G times each observable
+    """
+    W = sparse.csr_matrix(W)
+    N, Q = X.shape
+    P = W.shape[1]
+    Avg = np.asarray(W.T.dot(X))
+    Prod = np.zeros((G.shape[0], P, Q))
+    block = max(1, int(mem * 1024**2 / (8 * P * Q)))
+    for b0 in range(0, N, block):
+        b1 = min(N, b0 + block)
+        Wb = W[b0:b1].toarray()
+        nz = np.flatnonzero(np.any(Wb != 0, axis=0))
+        if len(nz) == 0: continue
+        WX = Wb[:, nz, np.newaxis] * X[b0:b1, np.newaxis, :]
+        Prod[:, nz, :] += np.dot(G[:, b0:b1], WX.reshape(b1-b0, -1)).reshape(-1, len(nz), Q)
+    return Avg, Prod
+
 # NPT_Trajectory = namedtuple('NPT_Trajectory', ['fnm', 'Rhos', 'pVs', 'Energies', 'Grads', 'mEnergies', 'mGrads', 'Rho_errs', 'Hvap_errs'])
 
 class Liquid(Target):
@@ -146,6 +210,8 @@ class Liquid(Target):
         self.set_option(tgt_opts,'anisotropic_box',forceprint=True)
         # Whether to save trajectories (0 = never, 1 = delete after good step, 2 = keep all)
         self.set_option(tgt_opts,'save_traj')
+        # Keep the coordinates saved during OpenMM MD on disk instead of in memory
+        self.set_option(tgt_opts,'md_spill')
         # Set the number of molecules by hand (in case ForceBalance doesn't get the right number from the structure)
         self.set_option(tgt_opts,'n_molecules')
         # Weight of surface tension
@@ -878,45 +944,24 @@ class Liquid(Target):
         BSims = len(BPoints)
         Shots = len(E[0])
         N_k = np.ones(BSims, dtype=int)*Shots
-        # Use the value of the energy for snapshot t from simulation k at potential m
-        U_kln = np.zeros([BSims,BSims,Shots])
-        for m, PT in enumerate(BPoints):
-            T = PT[0]
-            P = PT[1] / 1.01325 if PT[2] == 'bar' else PT[1]
-            beta = 1. / (kb * T)
-            for k in range(BSims):
-                # The correct Boltzmann factors include PV.
-                # Note that because the Boltzmann factors are computed from the conditions at simulation "m",
-                # the pV terms must be rescaled to the pressure at simulation "m".
-                kk = Points.index(BPoints[k])
-                U_kln[k, m, :]   = E[kk] + P*V[kk]*pvkj
-                U_kln[k, m, :]  *= beta
         W1 = None
         if len(BPoints) > 1:
+            # Reduced potentials u_kn of all concatenated snapshots n evaluated at the conditions of state k.
+            # The correct Boltzmann factors include PV.
+            # Note that because the Boltzmann factors are computed from the conditions at simulation "k",
+            # the pV terms must be rescaled to the pressure at simulation "k".
+            Bidx = [Points.index(PT) for PT in BPoints]
+            Bbeta = np.array([1. / (kb * PT[0]) for PT in BPoints])
+            BP = np.array([PT[1] / 1.01325 if PT[2] == 'bar' else PT[1] for PT in BPoints])
+            u_kn = (E[Bidx].flatten()[np.newaxis, :] + np.outer(BP*pvkj, V[Bidx].flatten())) * Bbeta[:, np.newaxis]
             logger.info("Running MBAR analysis on %i states...\n" % len(BPoints))
-            mbar = pymbar.MBAR(U_kln, N_k, verbose=mbar_verbose, relative_tolerance=5.0e-8)
+            mbar = pymbar.MBAR(u_kn, N_k, verbose=mbar_verbose, relative_tolerance=5.0e-8)
             W1 = mbar.getWeights()
             logger.info("Done\n")
         elif len(BPoints) == 1:
             W1 = np.ones((Shots,1))
             W1 /= Shots
 
-        def fill_weights(weights, phase_points, mbar_points, snapshots):
-            """ Fill in the weight matrix with MBAR weights where MBAR was run,
-            and equal weights otherwise. """
-            new_weights = np.zeros([len(phase_points)*snapshots,len(phase_points)])
-            for m, PT in enumerate(phase_points):
-                if PT in mbar_points:
-                    mm = mbar_points.index(PT)
-                    for kk, PT1 in enumerate(mbar_points):
-                        k = phase_points.index(PT1)
-                        logger.debug("Will fill W2[%i:%i,%i] with W1[%i:%i,%i]\n" % (k*snapshots,k*snapshots+snapshots,m,kk*snapshots,kk*snapshots+snapshots,mm))
-                        new_weights[k*snapshots:(k+1)*snapshots,m] = weights[kk*snapshots:(kk+1)*snapshots,mm]
-                else:
-                    logger.debug("Will fill W2[%i:%i,%i] with equal weights\n" % (m*snapshots,(m+1)*snapshots,m))
-                    new_weights[m*snapshots:(m+1)*snapshots,m] = 1.0/snapshots
-            return new_weights
-
         W2 = fill_weights(W1, Points, BPoints, Shots)
 
         if len(mPoints) > 0:
@@ -926,16 +971,11 @@ class Liquid(Target):
             if len(mBPoints) > 1:
                 mBSims = len(mBPoints)
                 mN_k = np.ones(mBSims, dtype=int)*mShots
-                mU_kln = np.zeros([mBSims,mBSims,mShots])
-                for m, PT in enumerate(mBPoints):
-                    T = PT[0]
-                    beta = 1. / (kb * T)
-                    for k in range(mBSims):
-                        mE_idx = mE_idx_dict[mBPoints[k]]
-                        mU_kln[k, m, :]  = mE[mE_idx]
-                        mU_kln[k, m, :] *= beta
+                mBidx = [mE_idx_dict[PT] for PT in mBPoints]
+                mBbeta = np.array([1. / (kb * PT[0]) for PT in mBPoints])
+                mu_kn = np.outer(mBbeta, mE[mBidx].flatten())
                 if np.abs(np.std(mE)) > 1e-6 and mBSims > 1:
-                    mmbar = pymbar.MBAR(mU_kln, mN_k, verbose=False, relative_tolerance=5.0e-8, method='self-consistent-iteration')
+                    mmbar = pymbar.MBAR(mu_kn, mN_k, verbose=False, relative_tolerance=5.0e-8, method='self-consistent-iteration')
                     mW1 = mmbar.getWeights()
             elif len(mBPoints) == 1:
                 mW1 = np.ones((mShots,1))
@@ -959,37 +999,54 @@ class Liquid(Target):
         Dz = Dz.flatten()
         if len(mPoints) > 0: mE = mE.flatten()
 
+        # Reweight all observables at all phase points in one pass over the snapshots.
+        # Only pressure-independent observables are needed; the enthalpy H = E + PV
+        # and its products at each phase point follow from these by linearity.
+        obs = OrderedDict([('1', np.ones_like(E)), ('R', R), ('E', E), ('V', V), ('V**2', V**2), ('E*V', E*V), ('E**2', E**2),
+                           ('Dx', Dx), ('Dy', Dy), ('Dz', Dz), ('Dx**2', Dx**2), ('Dy**2', Dy**2), ('Dz**2', Dz**2)])
+        Avg, Prod = reweight_products(W2, np.array(list(obs.values())).T, G)
+        # Dipole derivatives only enter as averages and products with the dipole components.
+        GDProd = [reweight_products(W2, np.array([np.ones_like(Dq), Dq]).T, GDq)[1] for Dq, GDq in ((Dx, GDx), (Dy, GDy), (Dz, GDz))]
+        if len(mPoints) > 0:
+            mAvg, mProd = reweight_products(mW2, np.array([np.ones_like(mE), mE]).T, mG)
+
         for i, PT in enumerate(Points):
             T = PT[0]
             P = PT[1] / 1.01325 if PT[2] == 'bar' else PT[1]
-            PV = P*V*pvkj
-            H = E + PV
             # The weights that we want are the last ones.
-            W = flat(W2[:,i])
+            W = flat(W2[:,i].toarray())
             C = weight_info(W, PT, np.ones(len(Points), dtype=int)*Shots, verbose=mbar_verbose)
-            Gbar = flat(np.dot(G, col(W)))
             mBeta = -1/kb/T
             Beta  = 1/kb/T
             kT    = kb*T
+            # Reweighted averages <X> and derivative products G.(W*X) at this phase point.
+            a = OrderedDict(zip(obs.keys(), Avg[i]))
+            d = OrderedDict(zip(obs.keys(), Prod[:, i, :].T))
+            c = P*pvkj
+            for ad in a, d:
+                ad['PV'] = c*ad['V']
+                ad['H'] = ad['E'] + c*ad['V']
+                ad['H*V'] = ad['E*V'] + c*ad['V**2']
+                ad['H**2'] = ad['E**2'] + 2*c*ad['E*V'] + c**2*ad['V**2']
+            Gbar = d['1']
             # Define some things to make the analytic derivatives easier.
-            def avg(vec):
-                return np.dot(W,vec)
-            def covde(vec):
-                return flat(np.dot(G, col(W*vec))) - avg(vec)*Gbar
-            def deprod(vec):
-                return flat(np.dot(G, col(W*vec)))
+            def avg(key):
+                return a[key]
+            def covde(key):
+                return d[key] - a[key]*Gbar
+            def deprod(key):
+                return d[key]
             ## Density.
-            Rho_calc[PT]   = np.dot(W,R)
-            Rho_grad[PT]   = mBeta*(flat(np.dot(G, col(W*R))) - np.dot(W,R)*Gbar)
+            Rho_calc[PT]   = avg('R')
+            Rho_grad[PT]   = mBeta*covde('R')
             ## Enthalpy of vaporization.
             if PT in mPoints:
                 ii = mPoints.index(PT)
-                mW = flat(mW2[:,ii])
-                mGbar = flat(np.dot(mG, col(mW)))
-                Hvap_calc[PT]  = np.dot(mW,mE) - np.dot(W,E)/NMol + kb*T - np.dot(W, PV)/NMol
-                Hvap_grad[PT]  = mGbar + mBeta*(flat(np.dot(mG,col(mW*mE))) - np.dot(mW,mE)*mGbar)
-                Hvap_grad[PT] -= (Gbar + mBeta*(flat(np.dot(G,col(W*E))) - np.dot(W,E)*Gbar)) / NMol
-                Hvap_grad[PT] -= (mBeta*(flat(np.dot(G,col(W*PV))) - np.dot(W,PV)*Gbar)) / NMol
+                mGbar = mProd[:, ii, 0]
+                Hvap_calc[PT]  = mAvg[ii, 1] - avg('E')/NMol + kb*T - avg('PV')/NMol
+                Hvap_grad[PT]  = mGbar + mBeta*(mProd[:, ii, 1] - mAvg[ii, 1]*mGbar)
+                Hvap_grad[PT] -= (Gbar + mBeta*covde('E')) / NMol
+                Hvap_grad[PT] -= (mBeta*covde('PV')) / NMol
                 if self.do_self_pol:
                     Hvap_calc[PT] -= EPol
                     Hvap_grad[PT] -= GEPol
@@ -1015,39 +1072,39 @@ class Liquid(Target):
                 Hvap_calc[PT]  = 0.0
                 Hvap_grad[PT]  = np.zeros(self.FF.np)
             ## Thermal expansion coefficient.
-            Alpha_calc[PT] = 1e4 * (avg(H*V)-avg(H)*avg(V))/avg(V)/(kT*T)
-            GAlpha1 = -1 * Beta * deprod(H*V) * avg(V) / avg(V)**2
-            GAlpha2 = +1 * Beta * avg(H*V) * deprod(V) / avg(V)**2
-            GAlpha3 = deprod(V)/avg(V) - Gbar
-            GAlpha4 = Beta * covde(H)
+            Alpha_calc[PT] = 1e4 * (avg('H*V')-avg('H')*avg('V'))/avg('V')/(kT*T)
+            GAlpha1 = -1 * Beta * deprod('H*V') * avg('V') / avg('V')**2
+            GAlpha2 = +1 * Beta * avg('H*V') * deprod('V') / avg('V')**2
+            GAlpha3 = deprod('V')/avg('V') - Gbar
+            GAlpha4 = Beta * covde('H')
             Alpha_grad[PT] = 1e4 * (GAlpha1 + GAlpha2 + GAlpha3 + GAlpha4)/(kT*T)
             ## Isothermal compressibility.
             bar_unit = 0.06022141793 * 1e6
-            Kappa_calc[PT] = bar_unit / kT * (avg(V**2)-avg(V)**2)/avg(V)
-            GKappa1 = +1 * Beta**2 * avg(V**2) * deprod(V) / avg(V)**2
-            GKappa2 = -1 * Beta**2 * avg(V) * deprod(V**2) / avg(V)**2
-            GKappa3 = +1 * Beta**2 * covde(V)
+            Kappa_calc[PT] = bar_unit / kT * (avg('V**2')-avg('V')**2)/avg('V')
+            GKappa1 = +1 * Beta**2 * avg('V**2') * deprod('V') / avg('V')**2
+            GKappa2 = -1 * Beta**2 * avg('V') * deprod('V**2') / avg('V')**2
+            GKappa3 = +1 * Beta**2 * covde('V')
             Kappa_grad[PT] = bar_unit*(GKappa1 + GKappa2 + GKappa3)
             ## Isobaric heat capacity.
-            Cp_calc[PT] = 1000/(4.184*NMol*kT*T) * (avg(H**2) - avg(H)**2)
+            Cp_calc[PT] = 1000/(4.184*NMol*kT*T) * (avg('H**2') - avg('H')**2)
             if hasattr(self,'use_cvib_intra') and self.use_cvib_intra:
                 logger.debug("Adding " + str(self.RefData['devib_intra'][PT]) + " to the heat capacity\n")
                 Cp_calc[PT] += self.RefData['devib_intra'][PT]
             if hasattr(self,'use_cvib_inter') and self.use_cvib_inter:
                 logger.debug("Adding " + str(self.RefData['devib_inter'][PT]) + " to the heat capacity\n")
                 Cp_calc[PT] += self.RefData['devib_inter'][PT]
-            GCp1 = 2*covde(H) * 1000 / 4.184 / (NMol*kT*T)
-            GCp2 = mBeta*covde(H**2) * 1000 / 4.184 / (NMol*kT*T)
-            GCp3 = 2*Beta*avg(H)*covde(H) * 1000 / 4.184 / (NMol*kT*T)
+            GCp1 = 2*covde('H') * 1000 / 4.184 / (NMol*kT*T)
+            GCp2 = mBeta*covde('H**2') * 1000 / 4.184 / (NMol*kT*T)
+            GCp3 = 2*Beta*avg('H')*covde('H') * 1000 / 4.184 / (NMol*kT*T)
             Cp_grad[PT] = GCp1 + GCp2 + GCp3
             ## Static dielectric constant.
             prefactor = 30.348705333964077
-            D2 = avg(Dx**2)+avg(Dy**2)+avg(Dz**2)-avg(Dx)**2-avg(Dy)**2-avg(Dz)**2
-            Eps0_calc[PT] = 1.0 + prefactor*(D2/avg(V))/T
-            GD2  = 2*(flat(np.dot(GDx,col(W*Dx))) - avg(Dx)*flat(np.dot(GDx,col(W)))) - Beta*(covde(Dx**2) - 2*avg(Dx)*covde(Dx))
-            GD2 += 2*(flat(np.dot(GDy,col(W*Dy))) - avg(Dy)*flat(np.dot(GDy,col(W)))) - Beta*(covde(Dy**2) - 2*avg(Dy)*covde(Dy))
-            GD2 += 2*(flat(np.dot(GDz,col(W*Dz))) - avg(Dz)*flat(np.dot(GDz,col(W)))) - Beta*(covde(Dz**2) - 2*avg(Dz)*covde(Dz))
-            Eps0_grad[PT] = prefactor*(GD2/avg(V) - mBeta*covde(V)*D2/avg(V)**2)/T
+            D2 = avg('Dx**2')+avg('Dy**2')+avg('Dz**2')-avg('Dx')**2-avg('Dy')**2-avg('Dz')**2
+            Eps0_calc[PT] = 1.0 + prefactor*(D2/avg('V'))/T
+            GD2  = 2*(GDProd[0][:, i, 1] - avg('Dx')*GDProd[0][:, i, 0]) - Beta*(covde('Dx**2') - 2*avg('Dx')*covde('Dx'))
+            GD2 += 2*(GDProd[1][:, i, 1] - avg('Dy')*GDProd[1][:, i, 0]) - Beta*(covde('Dy**2') - 2*avg('Dy')*covde('Dy'))
+            GD2 += 2*(GDProd[2][:, i, 1] - avg('Dz')*GDProd[2][:, i, 0]) - Beta*(covde('Dz**2') - 2*avg('Dz')*covde('Dz'))
+            Eps0_grad[PT] = prefactor*(GD2/avg('V') - mBeta*covde('V')*D2/avg('V')**2)/T
             ## Surface Tension (Already computed in nvt.py)
             if PT in stResults:
                  Surf_ten_calc[PT] = stResults[PT]["surf_ten"]
@@ -3,13 +3,20 @@ from __future__ import division
 from __future__ import print_function
 
 import copy
+import hashlib
 import itertools
 import os
 import re
 import sys
 import sysconfig
+import tempfile
 import json
+import pickle
 from collections import OrderedDict, namedtuple, Counter
+try:
+    from collections.abc import MutableSequence
+except ImportError:
+    from collections import MutableSequence
 from ctypes import *
 from datetime import date
 from warnings import warn
@@ -417,6 +424,14 @@ def isfloat(word):
     """Matches ANY number; it can be a decimal, scientific notation, integer, or what have you"""
     return re.match(r'^[-+]?[0-9]*\.?[0-9]*([eEdD][-+]?[0-9]+)?$',word)
 
+def sha1_file(fnm):
+    """ Return the SHA-1 hex digest of a file's contents, read in blocks. """
+    h = hashlib.sha1()
+    with open(fnm, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
 # Used to get the white spaces in a split line.
 splitter = re.compile(r'(\s+|\S+)')
 
@@ -596,6 +611,29 @@ def format_gro_box(box):
     else:
         return ' '.join(["% 13.9f" % (i/10) for i in [box.A[0], box.B[1], box.C[2], box.A[1], box.A[2], box.B[0], box.B[2], box.C[0], box.C[1]]])
 
+def gro_box(sline):
+    """ Build the periodic box from the words in the last line of a .gro frame
+
+    @param[in] sline The box line split into words (3 or 9 numbers in nm)
+    @return box Box NamedTuple in Angstrom, or None if the line is not recognized
+
+    """
+    box = [float(i)*10 for i in sline]
+    if len(box) == 3:
+        a = box[0]
+        b = box[1]
+        c = box[2]
+        alpha = 90.0
+        beta = 90.0
+        gamma = 90.0
+        return BuildLatticeFromLengthsAngles(a, b, c, alpha, beta, gamma)
+    elif len(box) == 9:
+        v1 = np.array([box[0], box[3], box[4]])
+        v2 = np.array([box[5], box[1], box[6]])
+        v3 = np.array([box[7], box[8], box[2]])
+        return BuildLatticeFromVectors(v1, v2, v3)
+    return None
+
 def is_gro_coord(line):
     """ Determines whether a line contains GROMACS data or not
 
@@ -1119,6 +1157,225 @@ def axis_angle(axis, angle):
     R = form_rot(q)
     return R
 
+#===================================#
+#|  Lazy access to trajectory      |#
+#|  frames that stay on disk       |#
+#===================================#
+
+class FrameIndex(object):
+    """ Byte offsets of the frames in a .xyz, .gro or TINKER .arc trajectory,
+    used to read single frames on demand instead of parsing the whole file.
+    The comment lines and periodic boxes are read while building the index,
+    because they are small. """
+
+    def __init__(self, fnm, ftype):
+        ## Absolute path of the trajectory file
+        self.fnm = os.path.abspath(fnm)
+        starts = []
+        ends = []
+        nhead = []
+        ## One comment per frame
+        self.comms = []
+        ## One periodic box per frame if the file has them
+        self.boxes = []
+        self.na = None
+        self.fd = None
+        self.pid = None
+        pos = 0
+        with open(fnm, 'rb') as f:
+            if ftype == 'xyz':
+                # Check whether this .xyz file is actually TINKER formatted, as in read_xyz0.
+                head = [l.decode().split() for l in f.readlines(1 << 16) if len(l.strip()) > 0][:2]
+                f.seek(0)
+                if len(head) > 1 and (len(head[0]) != 1 or not isint(head[0][0]) or (len(head[1]) == 6 and all([isfloat(w) for w in head[1]])) or
+                                      (len(head[1]) >= 5 and isint(head[1][0]) and all([isfloat(w) for w in head[1][2:5]]))):
+                    ftype = 'tinker'
+            ## The (possibly corrected) file type
+            self.ftype = ftype
+            while True:
+                line = f.readline()
+                if len(line) == 0: break
+                start = pos
+                pos += len(line)
+                sline = line.decode().split()
+                if len(sline) == 0: continue
+                if ftype == 'xyz':
+                    na = int(sline[0])
+                    line = f.readline()
+                    pos += len(line)
+                    self.comms.append(line.decode().strip().expandtabs())
+                    nh = 2
+                elif ftype == 'gromacs':
+                    self.comms.append(line.decode().strip())
+                    line = f.readline()
+                    pos += len(line)
+                    na = int(line.strip())
+                    nh = 2
+                elif ftype == 'tinker':
+                    na = int(sline[0])
+                    self.comms.append(' '.join(sline[1:]))
+                    # Peek at the next line to see whether it is a periodic box.
+                    mark = pos
+                    line = f.readline()
+                    bline = line.decode().split()
+                    if len(bline) == 6 and all([isfloat(w) for w in bline]):
+                        pos += len(line)
+                        self.boxes.append(BuildLatticeFromLengthsAngles(*[float(w) for w in bline]))
+                        nh = 2
+                    else:
+                        f.seek(mark)
+                        nh = 1
+                else:
+                    logger.error('Lazy loading of frames is not implemented for file type %s\n' % ftype)
+                    raise RuntimeError
+                if self.na is None:
+                    self.na = na
+                elif na != self.na:
+                    logger.error('Lazy loading of frames requires the same number of atoms in each frame (%s)\n' % fnm)
+                    raise RuntimeError
+                for i in range(na):
+                    line = f.readline()
+                    if len(line) == 0:
+                        logger.error('Trajectory file %s ends in the middle of a frame\n' % fnm)
+                        raise IOError
+                    pos += len(line)
+                if ftype == 'gromacs':
+                    line = f.readline()
+                    pos += len(line)
+                    box = gro_box(line.decode().split())
+                    if box is not None:
+                        self.boxes.append(box)
+                starts.append(start)
+                ends.append(pos)
+                nhead.append(nh)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.nhead = np.array(nhead, dtype=np.int8)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getstate__(self):
+        # The file descriptor is not carried over when pickling.
+        state = self.__dict__.copy()
+        state['fd'] = None
+        state['pid'] = None
+        return state
+
+    def __deepcopy__(self, memo):
+        # The index does not change after it is built, so copies can share it.
+        return self
+
+    def __del__(self):
+        if getattr(self, 'fd', None) is not None and self.pid == os.getpid():
+            os.close(self.fd)
+
+    def text(self, i):
+        """ Return the raw text of frame i. """
+        # Positional reads do not move a shared file offset, so this is safe after forking.
+        if self.fd is None or self.pid != os.getpid():
+            self.fd = os.open(self.fnm, os.O_RDONLY)
+            self.pid = os.getpid()
+        return os.pread(self.fd, int(self.ends[i] - self.starts[i]), int(self.starts[i])).decode()
+
+    def read(self, i):
+        """ Parse the coordinates of frame i in Angstrom, in the same way as the full file readers. """
+        nh = int(self.nhead[i])
+        lines = self.text(i).splitlines()[nh:nh+self.na]
+        if self.ftype == 'xyz':
+            xyz = [[float(w) for w in re.sub(r"([0-9])(-[0-9])", r"\1 \2", l).split()[1:4]] for l in lines]
+        elif self.ftype == 'gromacs':
+            pdeci = [j for j, x in enumerate(lines[0]) if x == '.']
+            ndeci = pdeci[1] - pdeci[0] - 5
+            xyz = []
+            for line in lines:
+                coord = []
+                for j in range(1,4):
+                    try:
+                        coord.append(float(line[(pdeci[0]-4)+(5+ndeci)*(j-1):(pdeci[0]-4)+(5+ndeci)*j].strip()))
+                    except ValueError:
+                        coord.append(float(line.split()[j+2]))
+                xyz.append(coord)
+            return np.array(xyz)*10
+        else:
+            xyz = [[float(w) for w in l.split()[2:5]] for l in lines]
+        return np.array(xyz)
+
+class LazyFrames(MutableSequence):
+    """ List-like container of per-frame arrays (e.g. xyzs) for long trajectories.
+
+    Each element is either a NumPy array or a reference (FrameIndex, frame number)
+    to a frame that is still on disk.  Indexing or iterating reads frames that are
+    on disk one at a time without keeping them, so reading or writing the whole
+    trajectory never holds more than one frame in memory.  These frames are returned
+    read-only, so modifying them in place raises an error instead of being lost;
+    code that edits a frame assigns the result back (M.xyzs[i] = M.xyzs[i] - shift),
+    which keeps that frame in memory from then on.  Slicing returns a new LazyFrames
+    that shares the references.
+    """
+
+    def __init__(self, items=()):
+        if isinstance(items, LazyFrames):
+            items = items.items
+        ## Arrays or (FrameIndex, frame number) tuples
+        self.items = list(items)
+
+    def get(self, item):
+        if isinstance(item, tuple):
+            frame = item[0].read(item[1])
+            frame.flags.writeable = False
+            return frame
+        return item
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return LazyFrames(self.items[key])
+        elif isinstance(key, (list, np.ndarray)):
+            return LazyFrames([self.items[i] for i in np.arange(len(self.items))[key]])
+        return self.get(self.items[key])
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            self.items[key] = list(LazyFrames(value).items)
+        else:
+            self.items[key] = value
+
+    def __delitem__(self, key):
+        del self.items[key]
+
+    def insert(self, index, value):
+        self.items.insert(index, value)
+
+    def __iter__(self):
+        for item in self.items:
+            yield self.get(item)
+
+    def extend(self, other):
+        self.items.extend(LazyFrames(other).items)
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __add__(self, other):
+        New = LazyFrames(self)
+        New.extend(other)
+        return New
+
+    def __radd__(self, other):
+        New = LazyFrames(other)
+        New.extend(self)
+        return New
+
+    def __deepcopy__(self, memo):
+        return LazyFrames([i if isinstance(i, tuple) else i.copy() for i in self.items])
+
+    def __repr__(self):
+        return 'LazyFrames(%i frames, %i in memory)' % (len(self.items), len([i for i in self.items if not isinstance(i, tuple)]))
+
 class Molecule(object):
     """ Lee-Ping's general file format conversion class.
 
@@ -1191,6 +1448,12 @@ class Molecule(object):
             Default value of 1.2 is reasonable, 1.4 will produce lots of bonds
         positive_resid : bool, optional
             If provided, enforce all positive resIDs.
+        cache : bool, optional
+            Keep a memory-mapped binary copy of .xyz, .gro and qdata.txt files next to the source file
+            and read from it when the source has not changed, default False
+        lazy : bool, optional
+            For .xyz, .gro and TINKER .arc trajectories, index the frames and read the
+            coordinates from disk only when they are accessed (see LazyFrames), default False
         """
         # If we passed in a "topology" file, read it in first, and then load the frames
         if top is not None:
@@ -1282,7 +1545,7 @@ class Molecule(object):
                 raise IOError
             self.Data['ftype'] = ftype
             ## Actually read the file.
-            Parsed = self.Read_Tab[self.Funnel[ftype.lower()]](fnm, **kwargs)
+            Parsed = self.read_cached(fnm, self.Funnel[ftype.lower()], **kwargs)
             ## Set member variables.
             for key, val in Parsed.items():
                 self.Data[key] = val
@@ -1379,7 +1642,9 @@ class Molecule(object):
         New.top_settings = copy.deepcopy(self.top_settings)
 
         for key in self.Data:
-            if key in ['xyzs', 'qm_grads', 'qm_hessians', 'qm_espxyzs', 'qm_espvals', 'qm_extchgs', 'qm_mulliken_charges', 'qm_mulliken_spins', 'molecules', 'qm_bondorder']:
+            if isinstance(self.Data[key], LazyFrames):
+                New.Data[key] = copy.deepcopy(self.Data[key])
+            elif key in ['xyzs', 'qm_grads', 'qm_hessians', 'qm_espxyzs', 'qm_espvals', 'qm_extchgs', 'qm_mulliken_charges', 'qm_mulliken_spins', 'molecules', 'qm_bondorder']:
                 # These variables are lists of NumPy arrays, NetworkX graph objects, or others with
                 # explicitly defined copy() methods.
                 New.Data[key] = []
@@ -1438,6 +1703,8 @@ class Molecule(object):
             for k in self.FrameKeys:
                 if k == 'boxes':
                     New.Data[k] = [j for i, j in enumerate(self.Data[k]) if i in np.arange(len(self))[key]]
+                elif isinstance(self.Data[k], LazyFrames):
+                    New.Data[k] = copy.deepcopy(self.Data[k][key])
                 else:
                     New.Data[k] = list(np.array(copy.deepcopy(self.Data[k]))[key])
             for k in self.AtomKeys | self.MetaKeys:
@@ -1493,13 +1760,15 @@ class Molecule(object):
                 Sum.Data[key] = copy.deepcopy(other.Data[key])
         for key in FrameVariableNames:
             if both(self, other, key):
-                if type(self.Data[key]) is not list:
+                if type(self.Data[key]) not in [list, LazyFrames]:
                     logger.error('Key %s in self is a FrameKey, it must be a list\n' % key)
                     raise RuntimeError
-                if type(other.Data[key]) is not list:
+                if type(other.Data[key]) not in [list, LazyFrames]:
                     logger.error('Key %s in other is a FrameKey, it must be a list\n' % key)
                     raise RuntimeError
-                if isinstance(self.Data[key][0], np.ndarray):
+                if LazyFrames in [type(self.Data[key]), type(other.Data[key])]:
+                    Sum.Data[key] = LazyFrames(copy.deepcopy(self.Data[key])) + copy.deepcopy(other.Data[key])
+                elif isinstance(self.Data[key][0], np.ndarray):
                     Sum.Data[key] = [i.copy() for i in self.Data[key]] + [i.copy() for i in other.Data[key]]
                 else:
                     Sum.Data[key] = list(self.Data[key] + other.Data[key])
@@ -1535,13 +1804,15 @@ class Molecule(object):
         # FrameKeys must be a list.
         for key in FrameVariableNames:
             if both(self, other, key):
-                if type(self.Data[key]) is not list:
+                if type(self.Data[key]) not in [list, LazyFrames]:
                     logger.error('Key %s in self is a FrameKey, it must be a list\n' % key)
                     raise RuntimeError
-                if type(other.Data[key]) is not list:
+                if type(other.Data[key]) not in [list, LazyFrames]:
                     logger.error('Key %s in other is a FrameKey, it must be a list\n' % key)
                     raise RuntimeError
-                if isinstance(self.Data[key][0], np.ndarray):
+                if type(other.Data[key]) is LazyFrames:
+                    self.Data[key] += copy.deepcopy(other.Data[key])
+                elif isinstance(self.Data[key][0], np.ndarray):
                     self.Data[key] += [i.copy() for i in other.Data[key]]
                 else:
                     self.Data[key] += other.Data[key]
@@ -1711,9 +1982,9 @@ class Molecule(object):
         """ If one atom is oxygen and the next two are hydrogen, make the water molecule rigid. """
         self.require('elem', 'xyzs')
         for i in range(len(self)):
+            flex = np.array(self.xyzs[i])
             for a in range(self.na-2):
                 if self.elem[a] == 'O' and self.elem[a+1] == 'H' and self.elem[a+2] == 'H':
-                    flex = self.xyzs[i]
                     wat = flex[a:a+3]
                     com = wat.mean(0)
                     wat -= com
@@ -1736,7 +2007,8 @@ class Molecule(object):
                     h1 = o + Bond*ex*cosx + Bond*ey*cosy
                     h2 = o + Bond*ex*cosx - Bond*ey*cosy
                     rig = np.array([o, h1, h2]) + com
-                    self.xyzs[i][a:a+3] = rig
+                    flex[a:a+3] = rig
+            self.xyzs[i] = flex
 
     def load_frames(self, fnm, ftype=None, **kwargs):
         ## Read in stuff if we passed in a file name, otherwise return an empty instance.
@@ -1748,7 +2020,7 @@ class Molecule(object):
                 logger.error('Tried to create Molecule object from a file that does not exist: %s\n' % fnm)
                 raise IOError
             ## Actually read the file.
-            Parsed = self.Read_Tab[self.Funnel[ftype.lower()]](fnm, **kwargs)
+            Parsed = self.read_cached(fnm, self.Funnel[ftype.lower()], **kwargs)
             if 'xyzs' not in Parsed:
                 logger.error('Did not get any coordinates from the new file %s\n' % fnm)
                 raise RuntimeError
@@ -1765,6 +2037,123 @@ class Molecule(object):
             else:
                 self.comms = [i.expandtabs() for i in self.comms]
 
+    def read_cached(self, fnm, ftype, **kwargs):
+        """ Parse a file with the reader for its type, going through a binary sidecar cache
+        for large trajectory / reference data files (xyz, gro and qdata.txt formats),
+        or indexing the frames for lazy loading if requested.
+
+        The sidecar is a directory named .<filename>.npcache next to the source file.
+        Rectangular per-frame data (xyzs, qm_energies, qm_grads, boxes) is stored as .npy files
+        and loaded with memory mapping, so frames are only paged in when they are used;
+        everything else that the parser returned is stored in a small pickle.
+        The cache is valid if the source file has the same size and modification time,
+        or failing that, the same SHA-1 hash as when the cache was written.
+
+        @param[in] fnm The input file name
+        @param[in] ftype The file type (after going through the Funnel)
+        @param[in] cache Use the binary cache (keyword argument, default False)
+        @return Answer Dictionary of data as returned by the file reader
+        """
+        reader = self.Read_Tab[ftype]
+        if kwargs.get('lazy', False) and ftype in ['xyz', 'gromacs', 'tinker']:
+            return self.read_lazy(fnm, ftype, **kwargs)
+        if not kwargs.get('cache', False) or ftype not in ['xyz', 'gromacs', 'qdata']:
+            return reader(fnm, **kwargs)
+        cdir = os.path.join(os.path.dirname(os.path.abspath(fnm)), '.%s.npcache' % os.path.basename(fnm))
+        st = os.stat(fnm)
+        meta = None
+        if os.path.exists(os.path.join(cdir, 'meta.pkl')):
+            try:
+                with open(os.path.join(cdir, 'meta.pkl'), 'rb') as f:
+                    meta = pickle.load(f)
+            except Exception:
+                meta = None
+        if meta is not None and meta['ftype'] == ftype:
+            if (meta['mtime_ns'], meta['size']) == (st.st_mtime_ns, st.st_size):
+                return self.load_npcache(cdir, meta)
+            elif meta['size'] == st.st_size and meta['sha1'] == sha1_file(fnm):
+                return self.load_npcache(cdir, meta)
+        Answer = reader(fnm, **kwargs)
+        try:
+            self.save_npcache(cdir, Answer, {'ftype' : ftype, 'mtime_ns' : st.st_mtime_ns,
+                                             'size' : st.st_size, 'sha1' : sha1_file(fnm)})
+        except (IOError, OSError) as e:
+            logger.warning('Unable to write binary cache for %s (%s); continuing without it\n' % (fnm, str(e)))
+        return Answer
+
+    def read_lazy(self, fnm, ftype, **kwargs):
+        """ Read a trajectory whose coordinates are loaded on access.
+
+        The file is scanned once to record where each frame starts, along with the comments
+        and periodic boxes.  The first frame is parsed by the usual reader to get the
+        per-atom data (elements, atom names, residues and so on).
+
+        @param[in] fnm The input file name
+        @param[in] ftype The file type (xyz, gromacs or tinker)
+        @return Answer Dictionary of data as returned by the file reader, with xyzs as a LazyFrames object
+        """
+        Index = FrameIndex(fnm, ftype)
+        if len(Index) == 0:
+            logger.error('No frames found in %s\n' % fnm)
+            raise IOError
+        ftype = Index.ftype
+        kwargs = dict([(k, v) for k, v in kwargs.items() if k not in ['lazy', 'cache']])
+        tmpfd, tmpfnm = tempfile.mkstemp(suffix=os.path.splitext(fnm)[1])
+        try:
+            with os.fdopen(tmpfd, 'w') as f:
+                f.write(Index.text(0))
+            Answer = self.Read_Tab[ftype](tmpfnm, **kwargs)
+        finally:
+            os.remove(tmpfnm)
+        Answer['xyzs'] = LazyFrames([(Index, i) for i in range(len(Index))])
+        Answer['comms'] = Index.comms[:]
+        if len(Index.boxes) > 0:
+            Answer['boxes'] = Index.boxes[:]
+        return Answer
+
+    def save_npcache(self, cdir, Answer, meta):
+        """ Write the output of a file reader to a binary sidecar directory (see read_cached). """
+        if not os.path.isdir(cdir):
+            os.makedirs(cdir)
+        other = {}
+        arrays = []
+        for key, val in Answer.items():
+            if key == 'boxes':
+                arr = np.array([[b.a, b.b, b.c, b.alpha, b.beta, b.gamma] + list(b.A) + list(b.B) + list(b.C) + [b.V] for b in val], dtype=float)
+            elif key == 'qm_energies':
+                arr = np.array(val, dtype=float)
+            elif key in ['xyzs', 'qm_grads'] and len(val) > 0 and len(set([v.shape for v in val])) == 1:
+                arr = np.array(val, dtype=float)
+            else:
+                other[key] = val
+                continue
+            # Write to a temporary file and rename so that concurrent readers never see partial arrays.
+            tmp = os.path.join(cdir, '%s.%i.tmp.npy' % (key, os.getpid()))
+            np.save(tmp, arr)
+            os.replace(tmp, os.path.join(cdir, '%s.npy' % key))
+            arrays.append(key)
+        meta['arrays'] = arrays
+        meta['other'] = other
+        # The metadata is written last because it contains the validation stamp.
+        tmp = os.path.join(cdir, 'meta.%i.tmp.pkl' % os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, os.path.join(cdir, 'meta.pkl'))
+
+    def load_npcache(self, cdir, meta):
+        """ Read the output of a file reader from a binary sidecar directory (see read_cached). """
+        Answer = copy.deepcopy(meta['other'])
+        for key in meta['arrays']:
+            # Copy-on-write mapping; frames are read from disk on access and may be modified in memory.
+            arr = np.load(os.path.join(cdir, '%s.npy' % key), mmap_mode='c').view(np.ndarray)
+            if key == 'boxes':
+                Answer[key] = [Box(*([float(i) for i in row[:6]] + [np.array(row[6:9]), np.array(row[9:12]), np.array(row[12:15]), float(row[15])])) for row in arr]
+            elif key == 'qm_energies':
+                Answer[key] = arr.tolist()
+            else:
+                Answer[key] = list(arr)
+        return Answer
+
     def edit_qcrems(self, in_dict, subcalc = None):
         """ Edit Q-Chem rem variables with a dictionary.  Pass a value of None to delete a rem variable. """
         if subcalc is None:
@@ -1916,11 +2305,11 @@ class Molecule(object):
         Departs from MSMBuilder convention of
         using arithmetic mean for mass. """
         coms  = self.center_of_mass()
-        xyz1  = self.xyzs[0]
-        xyz1 -= coms[0]
+        xyz1  = self.xyzs[0] - coms[0]
+        self.xyzs[0] = xyz1
         xyz1  = AlignToMoments(self.elem,xyz1)
         for index2, xyz2 in enumerate(self.xyzs):
-            xyz2 -= coms[index2]
+            xyz2 = xyz2 - coms[index2]
             xyz2 = AlignToMoments(self.elem,xyz1,xyz2)
             self.xyzs[index2] = xyz2
 
@@ -1963,12 +2352,12 @@ class Molecule(object):
         coms = self.center_of_mass()
         xyz1 = self.xyzs[0]
         if center:
-            xyz1 -= xyz1.mean(0)
+            self.xyzs[0] = xyz1 - xyz1.mean(0)
         elif center_mass:
-            xyz1 -= coms[0]
+            self.xyzs[0] = xyz1 - coms[0]
         for index2, xyz2 in enumerate(self.xyzs):
             if index2 == 0: continue
-            xyz2 -= xyz2.mean(0)
+            xyz2 = xyz2 - xyz2.mean(0)
             if smooth:
                 ref = index2-1
             else:
@@ -1985,10 +2374,10 @@ class Molecule(object):
         if center_mass:
             coms = self.center_of_mass()
             for i in range(len(self)):
-                self.xyzs[i] -= coms[i]
+                self.xyzs[i] = self.xyzs[i] - coms[i]
         else:
             for i in range(len(self)):
-                self.xyzs[i] -= self.xyzs[i].mean(0)
+                self.xyzs[i] = self.xyzs[i] - self.xyzs[i].mean(0)
 
     def build_bonds(self):
         """ Build the bond connectivity graph. """
@@ -3060,39 +3449,90 @@ class Molecule(object):
         return Answer
 
     def read_qdata(self, fnm, **kwargs):
-        xyzs     = []
+        """ Parse a qdata.txt file containing coordinates and reference QM data.
+
+        The file is read twice.  The first pass counts the frames of each quantity so the arrays
+        can be preallocated.  In the second pass the file is read in blocks of lines, the numbers
+        for each quantity in a block are converted in one call to NumPy and written straight into
+        the preallocated array, so the peak memory is the final data plus one block.  The per-frame
+        arrays are views into the preallocated array.  Quantities whose number of values varies
+        between frames (e.g. ESP points) are stored as one array per frame.
+
+        @param[in] fnm The input file name
+        @param[in] chunk Approximate number of bytes to read at a time (keyword argument)
+        @return xyzs, qm_energies, qm_interaction, qm_grads, qm_espxyzs, qm_espvals (whichever are present)
+
+        """
+        chunk = kwargs.get('chunk', 1 << 24)
+        arraykeys = ['xyzs', 'qm_grads', 'qm_espxyzs', 'qm_espvals']
+        # First pass: count the frames of each quantity from the keywords at the start of the lines.
+        # The counts only size the arrays; frames beyond them are stored as in the varying-length case.
+        with open(fnm) as f:
+            prefixes = Counter(line[:4] for line in f)
+        nrows = {'xyzs' : prefixes['COOR'], 'qm_grads' : prefixes['FORC'] + prefixes['GRAD'],
+                 'qm_espxyzs' : prefixes['ESPX'], 'qm_espvals' : prefixes['ESPV']}
+        # Preallocated arrays with one row per frame (allocated when the first block gives the row length),
+        # replaced by a list of rows if the lengths vary.
+        data = OrderedDict()
+        filled = {}
         energies = []
-        grads   = []
-        espxyzs  = []
-        espvals  = []
         interaction = []
-        for line in open(fnm):
-            line = line.strip().expandtabs()
-            if 'COORDS' in line:
-                xyzs.append(np.array([float(i) for i in line.split()[1:]]).reshape(-1,3))
-            elif 'FORCES' in line or 'GRADIENT' in line: # 'FORCES' is from an earlier version and a misnomer
-                grads.append(np.array([float(i) for i in line.split()[1:]]).reshape(-1,3))
-            elif 'ESPXYZ' in line:
-                espxyzs.append(np.array([float(i) for i in line.split()[1:]]).reshape(-1,3))
-            elif 'ESPVAL' in line:
-                espvals.append(np.array([float(i) for i in line.split()[1:]]))
-            elif 'ENERGY' in line:
-                energies.append(float(line.split()[1]))
-            elif 'INTERACTION' in line:
-                interaction.append(float(line.split()[1]))
+        with open(fnm) as f:
+            while True:
+                lines = f.readlines(chunk)
+                if len(lines) == 0: break
+                rows = dict([(key, []) for key in arraykeys])
+                for line in lines:
+                    if 'COORDS' in line:
+                        key = 'xyzs'
+                    elif 'FORCES' in line or 'GRADIENT' in line: # 'FORCES' is from an earlier version and a misnomer
+                        key = 'qm_grads'
+                    elif 'ESPXYZ' in line:
+                        key = 'qm_espxyzs'
+                    elif 'ESPVAL' in line:
+                        key = 'qm_espvals'
+                    elif 'ENERGY' in line:
+                        energies.append(float(line.split()[1]))
+                        continue
+                    elif 'INTERACTION' in line:
+                        interaction.append(float(line.split()[1]))
+                        continue
+                    else:
+                        continue
+                    sline = line.split(None, 1)
+                    rows[key].append(sline[1] if len(sline) > 1 else '')
+                del lines
+                for key in arraykeys:
+                    n = len(rows[key])
+                    if n == 0: continue
+                    if key not in data or isinstance(data[key], np.ndarray):
+                        try:
+                            # Convert the whole block at once; this fails if the rows have different lengths.
+                            block = np.loadtxt(rows[key], ndmin=2)
+                        except ValueError:
+                            block = None
+                        if key not in data:
+                            data[key] = np.empty((max(n, nrows[key]), block.shape[1] if block is not None else 0))
+                            filled[key] = 0
+                        if block is not None and block.shape == (n, data[key].shape[1]) and filled[key] + n <= data[key].shape[0]:
+                            data[key][filled[key]:filled[key]+n] = block
+                            filled[key] += n
+                            continue
+                        # The number of values varies between frames, so keep one array per frame.
+                        data[key] = [r.copy() for r in data[key][:filled[key]]]
+                    data[key] += [np.array(r.split(), dtype=float) for r in rows[key]]
         Answer = {}
-        if len(xyzs) > 0:
-            Answer['xyzs'] = xyzs
+        for key in data:
+            if isinstance(data[key], np.ndarray):
+                data[key] = data[key][:filled[key]]
+            if key == 'qm_espvals':
+                Answer[key] = list(data[key])
+            else:
+                Answer[key] = [r.reshape(-1,3) for r in data[key]]
         if len(energies) > 0:
             Answer['qm_energies'] = energies
         if len(interaction) > 0:
             Answer['qm_interaction'] = interaction
-        if len(grads) > 0:
-            Answer['qm_grads'] = grads
-        if len(espxyzs) > 0:
-            Answer['qm_espxyzs'] = espxyzs
-        if len(espvals) > 0:
-            Answer['qm_espvals'] = espvals
         return Answer
 
     def read_mol2(self, fnm, **kwargs):
@@ -3324,20 +3764,9 @@ class Molecule(object):
             elif ln == 1:
                 na = int(line.strip())
             elif ln == na + 2:
-                box = [float(i)*10 for i in sline]
-                if len(box) == 3:
-                    a = box[0]
-                    b = box[1]
-                    c = box[2]
-                    alpha = 90.0
-                    beta = 90.0
-                    gamma = 90.0
-                    boxes.append(BuildLatticeFromLengthsAngles(a, b, c, alpha, beta, gamma))
-                elif len(box) == 9:
-                    v1 = np.array([box[0], box[3], box[4]])
-                    v2 = np.array([box[5], box[1], box[6]])
-                    v3 = np.array([box[7], box[8], box[2]])
-                    boxes.append(BuildLatticeFromVectors(v1, v2, v3))
+                box = gro_box(sline)
+                if box is not None:
+                    boxes.append(box)
                 xyzs.append(np.array(xyz)*10)
                 xyz = []
                 ln = -1
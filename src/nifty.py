@@ -23,7 +23,10 @@ import distutils.dir_util
 import os
 import re
 import shutil
+import socket
 import sys
+import codecs
+import selectors
 from select import select
 
 import numpy as np
@@ -35,13 +38,15 @@ try:
 except ImportError:
     from itertools import izip_longest as zip_longest
 import threading
+import queue
 from pickle import Pickler, Unpickler
 import tarfile
+import tempfile
 import time
 import subprocess
 import math
 import six # For six.string_types
-from subprocess import PIPE
+from subprocess import PIPE, STDOUT
 from collections import OrderedDict, defaultdict
 
 #================================#
@@ -896,12 +901,280 @@ def createWorkQueue(wq_port, debug=True, name=package):
     #WORK_QUEUE.specify_keepalive_timeout(8640000)
     #WORK_QUEUE.specify_keepalive_interval(8640000)
 
+def createLocalWorkQueue(workers, gpus=0, retries=2, callback=None):
+    """
+    Create the built-in local job runner and make it the global Work
+    Queue object, so that targets submitting jobs with queue_up will
+    run them as subprocesses on this machine.
+
+    @param[in] workers (int) Number of CPU slots (tasks running at once)
+    @param[in] gpus (int) Number of GPUs available to the tasks
+    @param[in] retries (int) Number of times a failed task is rerun
+    @param[in] callback (function) Called with each completed task
+    """
+    global WORK_QUEUE
+    WORK_QUEUE = LocalWorkQueue(workers, gpus=gpus, retries=retries, callback=callback)
+
 def destroyWorkQueue():
     # Convenience function to destroy the Work Queue objects.
     global WORK_QUEUE, WQIDS
+    if isinstance(WORK_QUEUE, LocalWorkQueue):
+        WORK_QUEUE.shutdown()
     WORK_QUEUE = None
     WQIDS = defaultdict(list)
 
+class LocalTask(object):
+    """
+    A task for the local job runner.  The methods and attributes mirror
+    the parts of work_queue.Task used by queue_up and wq_wait1.
+    """
+    def __init__(self, command):
+        ## The shell command to run
+        self.command = command
+        ## Tag for identifying the task
+        self.tag = command
+        ## Task ID, assigned on submission
+        self.id = None
+        ## Lists of (local, remote) file names copied in and out of the scratch directory
+        self.input_files = []
+        self.output_files = []
+        ## Number of CPU slots and GPUs required (GPUs default to one if the queue has any)
+        self.cores = 1
+        self.gpus = None
+        ## Zero if the command ran and all of the output files were retrieved
+        self.result = None
+        ## Exit code of the command
+        self.return_status = None
+        self.status = 'waiting'
+        self.output = ''
+        self.hostname = socket.gethostname()
+        ## Execution time in microseconds
+        self.cmd_execution_time = 0
+        self.total_bytes_transferred = 0
+        ## Number of times the task has been run
+        self.attempts = 0
+
+    def specify_input_file(self, local_name, remote_name=None, cache=False):
+        self.input_files.append((local_name, remote_name if remote_name is not None else os.path.basename(local_name)))
+
+    def specify_output_file(self, local_name, remote_name=None, cache=False):
+        self.output_files.append((local_name, remote_name if remote_name is not None else os.path.basename(local_name)))
+
+    def specify_tag(self, tag):
+        self.tag = tag
+
+    def specify_cores(self, cores):
+        self.cores = cores
+
+    def specify_gpus(self, gpus):
+        self.gpus = gpus
+
+class LocalWorkQueueStats(object):
+    """ Counters with the same names as the work_queue stats fields printed in wq_wait1. """
+    def __init__(self):
+        for key in ['workers_init', 'workers_idle', 'workers_busy', 'workers_connected', 'workers_joined', 'workers_removed',
+                    'tasks_running', 'tasks_waiting', 'tasks_dispatched', 'tasks_submitted', 'tasks_done',
+                    'total_tasks_complete', 'bytes_sent', 'bytes_received']:
+            setattr(self, key, 0)
+
+class LocalWorkQueue(object):
+    """
+    Built-in local job runner that can be used in place of the Work Queue.
+
+    Tasks are run as subprocesses in their own scratch directories.  Input
+    files are copied in before the command starts and output files are copied
+    back when it finishes, as a Work Queue worker would do.  A task starts when
+    enough CPU slots and GPUs are free; GPUs are given to the task through
+    CUDA_VISIBLE_DEVICES.  Failed tasks are rerun up to a number of times
+    before being reported, and an optional callback is called with each
+    completed task when wait() returns it.
+
+    Tasks are started and polled by a background thread, so queued tasks
+    start as soon as slots are free while the calling process does other
+    work; wait() only collects the completed tasks.
+    """
+    def __init__(self, workers, gpus=0, retries=2, callback=None):
+        if workers < 1:
+            logger.error("The local job runner needs at least one worker\n")
+            raise RuntimeError
+        ## Number of CPU slots
+        self.cores = workers
+        ## GPU device numbers that are not in use
+        self.free_gpus = list(range(gpus))
+        self.ngpus = gpus
+        self.free_cores = workers
+        self.retries = retries
+        self.callback = callback
+        self.stats = LocalWorkQueueStats()
+        self.stats.workers_connected = workers
+        self.stats.workers_idle = workers
+        self.stats.workers_joined = workers
+        ## Tasks waiting to be started, in submission order
+        self.waiting = []
+        ## Mapping from task ID to (task, process, scratch directory, GPUs, start time)
+        self.running = OrderedDict()
+        ## Completed tasks that have not yet been returned by wait()
+        self.done = queue.Queue()
+        self.next_id = 1
+        ## Temporary directory holding the scratch directories of running tasks
+        self.tmpdir = tempfile.mkdtemp(prefix='fb-local-')
+        ## Lock for the task lists, slots and counters shared with the dispatcher thread
+        self.lock = threading.Lock()
+        ## Set to start waiting tasks right away (on submission) or to stop the dispatcher
+        self.wakeup = threading.Event()
+        self.stopped = False
+        ## Exception raised in the dispatcher thread, raised again by wait()
+        self.error = None
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def submit(self, task):
+        gpus = task.gpus if task.gpus is not None else min(1, self.ngpus)
+        if task.cores > self.cores or gpus > self.ngpus:
+            logger.error("Task '%s' requires %i cores and %i GPUs, but the local job runner only has %i and %i\n"
+                         % (task.tag, task.cores, gpus, self.cores, self.ngpus))
+            raise RuntimeError
+        with self.lock:
+            task.id = self.next_id
+            self.next_id += 1
+            task.attempts = 0
+            task.status = 'waiting'
+            self.waiting.append(task)
+            self.stats.tasks_submitted += 1
+            self._update_stats()
+        self.wakeup.set()
+        return task.id
+
+    def empty(self):
+        with self.lock:
+            return len(self.waiting) == 0 and len(self.running) == 0 and self.done.empty()
+
+    def wait(self, timeout=10):
+        """
+        Wait until a task is complete or the timeout (in seconds) has elapsed.
+
+        @return task The completed task, or None if no task completed.
+        """
+        t0 = time.time()
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                task = self.done.get(timeout=min(0.05, max(0, timeout - (time.time() - t0))))
+            except queue.Empty:
+                with self.lock:
+                    idle = len(self.running) == 0 and len(self.waiting) == 0
+                if time.time() - t0 >= timeout or (idle and self.done.empty()):
+                    return None
+                continue
+            if self.callback is not None:
+                self.callback(task)
+            return task
+
+    def shutdown(self):
+        """ Stop the dispatcher, terminate running tasks and remove the scratch directories. """
+        self.stopped = True
+        self.wakeup.set()
+        self.dispatcher.join()
+        for task, proc, sdir, gpus, start in self.running.values():
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        self.running.clear()
+        self.waiting = []
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _dispatch(self):
+        # Runs in the dispatcher thread: start waiting tasks and collect finished ones.
+        while not self.stopped:
+            try:
+                with self.lock:
+                    self._start()
+                    self._poll()
+            except Exception as e:
+                logger.error("The local job runner stopped because of an error: %s\n" % str(e))
+                self.error = e
+                return
+            self.wakeup.wait(0.05)
+            self.wakeup.clear()
+
+    def _start(self):
+        # Start waiting tasks in submission order as long as slots are free.
+        for task in self.waiting[:]:
+            gpus = task.gpus if task.gpus is not None else min(1, self.ngpus)
+            if task.cores > self.free_cores or gpus > len(self.free_gpus):
+                continue
+            self.waiting.remove(task)
+            sdir = os.path.join(self.tmpdir, 't%i.%i' % (task.id, task.attempts))
+            os.makedirs(sdir)
+            for lf, rf in task.input_files:
+                rpath = os.path.join(sdir, rf)
+                if not os.path.exists(os.path.dirname(rpath)):
+                    os.makedirs(os.path.dirname(rpath))
+                if os.path.isdir(lf):
+                    shutil.copytree(lf, rpath)
+                else:
+                    shutil.copy2(lf, rpath)
+                    self.stats.bytes_sent += os.path.getsize(rpath)
+            devices = self.free_gpus[:gpus]
+            del self.free_gpus[:gpus]
+            self.free_cores -= task.cores
+            env = os.environ.copy()
+            if self.ngpus > 0:
+                env['CUDA_VISIBLE_DEVICES'] = ','.join(str(d) for d in devices)
+            with open(os.path.join(sdir, '.stdout'), 'wb') as f:
+                proc = subprocess.Popen(task.command, shell=True, cwd=sdir, env=env, stdout=f, stderr=STDOUT)
+            task.status = 'running'
+            task.attempts += 1
+            self.running[task.id] = (task, proc, sdir, devices, time.time())
+            self.stats.tasks_dispatched += 1
+        self._update_stats()
+
+    def _poll(self):
+        for taskid in list(self.running.keys()):
+            task, proc, sdir, devices, start = self.running[taskid]
+            if proc.poll() is None:
+                continue
+            del self.running[taskid]
+            self.free_cores += task.cores
+            self.free_gpus = sorted(self.free_gpus + devices)
+            task.return_status = proc.returncode
+            task.cmd_execution_time = int((time.time() - start) * 1000000)
+            with open(os.path.join(sdir, '.stdout'), 'rb') as f:
+                task.output = f.read().decode('utf-8', errors='replace')
+            # As in the Work Queue, the result is nonzero if any of the output files are missing.
+            task.result = 0
+            for lf, rf in task.output_files:
+                rpath = os.path.join(sdir, rf)
+                if os.path.exists(rpath):
+                    if os.path.isdir(rpath):
+                        if os.path.exists(lf): shutil.rmtree(lf)
+                        shutil.copytree(rpath, lf)
+                    else:
+                        shutil.copy2(rpath, lf)
+                        self.stats.bytes_received += os.path.getsize(rpath)
+                else:
+                    task.result = 2
+            shutil.rmtree(sdir, ignore_errors=True)
+            if task.result != 0 and task.attempts <= self.retries:
+                logger.warning("Task '%s' (task %i) failed with exit code %i, running it again (attempt %i of %i)\n"
+                               % (task.tag, task.id, task.return_status, task.attempts+1, self.retries+1))
+                task.status = 'waiting'
+                self.waiting.append(task)
+                continue
+            task.status = 'done'
+            self.stats.tasks_done += 1
+            self.stats.total_tasks_complete += 1
+            self.done.put(task)
+        self._update_stats()
+
+    def _update_stats(self):
+        self.stats.tasks_running = len(self.running)
+        self.stats.tasks_waiting = len(self.waiting)
+        self.stats.workers_busy = min(self.cores, self.cores - self.free_cores)
+        self.stats.workers_idle = self.cores - self.stats.workers_busy
+
 def queue_up(wq, command, input_files, output_files, tag=None, tgt=None, verbose=True, print_time=60):
     """
     Submit a job to the Work Queue.
@@ -912,7 +1185,7 @@ def queue_up(wq, command, input_files, output_files, tag=None, tgt=None, verbose
     @param[in] output_files (list of files) A list of locations of the output files.
     """
     global WQIDS
-    task = work_queue.Task(command)
+    task = LocalTask(command) if isinstance(wq, LocalWorkQueue) else work_queue.Task(command)
     cwd = os.getcwd()
     for f in input_files:
         lf = os.path.join(cwd,f)
@@ -944,7 +1217,7 @@ def queue_up_src_dest(wq, command, input_files, output_files, tag=None, tgt=None
     remote locations of the output files.
     """
     global WQIDS
-    task = work_queue.Task(command)
+    task = LocalTask(command) if isinstance(wq, LocalWorkQueue) else work_queue.Task(command)
     for f in input_files:
         # print f[0], f[1]
         task.specify_input_file(f[0],f[1],cache=False)
@@ -984,7 +1257,11 @@ def wq_wait1(wq, wait_time=10, wait_intvl=1, print_time=60, verbose=False):
                 logger.info("host = " + task.hostname + '\n')
                 logger.info("execution time = " + exectime)
                 logger.info("total_bytes_transferred = " + task.total_bytes_transferred + '\n')
-            if task.result != 0:
+            if task.result != 0 and isinstance(wq, LocalWorkQueue):
+                logger.error("Task '%s' (task %i) failed %i times with exit code %i; command output:\n%s\n"
+                             % (task.tag, task.id, task.attempts, task.return_status, task.output[-4096:]))
+                raise RuntimeError("Task '%s' failed in the local job runner" % task.tag)
+            elif task.result != 0:
                 oldid = task.id
                 oldhost = task.hostname
                 tgtname = "None"
@@ -1346,28 +1623,39 @@ def copy_tree_over(src, dest):
 
 # Thanks to cesarkawakami on #python (IRC freenode) for this code.
 class LineChunker(object):
-    def __init__(self, callback):
+    def __init__(self, callback, expand_cr=False):
         self.callback = callback
         self.buf = ""
+        # Multi-byte characters may be split between reads, so the stream is decoded incrementally.
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.expand_cr = expand_cr
 
     def push(self, data):
         # Added by LPW during Py3 compatibility; ran into some trouble decoding strings such as
         # "a" with umlaut on top.  I guess we can ignore these for now.  For some reason,
         # Py2 never required decoding of data, I can simply add it to the wtring.
         # self.buf += data # Old Py2 code...
-        self.buf += data.decode('utf-8')#errors='ignore')
+        self.buf += self.decoder.decode(data)
         self.nomnom()
 
     def close(self):
+        self.buf += self.decoder.decode(b'', final=True)
+        self.nomnom(final=True)
         if self.buf:
             self.callback(self.buf + "\n")
 
-    def nomnom(self):
+    def nomnom(self, final=False):
         # Splits buffer by new line or carriage return, and passes
         # the splitted results onto processing.
-        while "\n" in self.buf or "\r" in self.buf:
-            chunk, sep, self.buf = re.split(r"(\r|\n)", self.buf, maxsplit=1)
-            self.callback(chunk + sep)
+        if self.expand_cr:
+            # A carriage return at the end may be followed by a newline in the next read.
+            if self.buf.endswith("\r") and not final: return
+            self.buf = self.buf.replace("\r\n", "\n").replace("\r", "\n")
+        # The whole buffer is split at once, and the last (incomplete) line is kept.
+        parts = re.split(r"(\r|\n)", self.buf)
+        for i in range(0, len(parts)-1, 2):
+            self.callback(parts[i] + parts[i+1])
+        self.buf = parts[-1]
 
     def __enter__(self):
         return self
@@ -1375,7 +1663,7 @@ class LineChunker(object):
     def __exit__(self, *args, **kwargs):
         self.close()
 
-def _exec(command, print_to_screen = False, outfnm = None, logfnm = None, stdin = "", print_command = True, copy_stdout = True, copy_stderr = False, persist = False, expand_cr=False, print_error=True, rbytes=1, cwd=None, **kwargs):
+def _exec(command, print_to_screen = False, outfnm = None, logfnm = None, stdin = "", print_command = True, copy_stdout = True, copy_stderr = False, persist = False, expand_cr=False, print_error=True, rbytes=65536, cwd=None, **kwargs):
     """Runs command line using subprocess, optionally returning stdout.
     Options:
     command (required) = Name of the command you want to execute
@@ -1388,11 +1676,11 @@ def _exec(command, print_to_screen = False, outfnm = None, logfnm = None, stdin
     expand_cr = Whether to expand carriage returns into newlines (useful for GROMACS mdrun).
     print_error = Whether to print error messages on a crash. Should be true most of the time.
     persist = Continue execution even if the command gives a nonzero return code.
-    rbytes = Number of bytes to read from stdout and stderr streams at a time.  GMX requires rbytes = 1 otherwise streams are interleaved.  Higher values for speed.
+    rbytes = Maximum number of bytes to read from the stdout and stderr streams at a time.
     """
 
     # Dictionary of options to be passed to the Popen object.
-    cmd_options={'shell':isinstance(command, six.string_types), 'stdin':PIPE, 'stdout':PIPE, 'stderr':PIPE, 'universal_newlines':expand_cr, 'cwd':cwd}
+    cmd_options={'shell':isinstance(command, six.string_types), 'stdin':PIPE, 'stdout':PIPE, 'stderr':PIPE, 'cwd':cwd}
 
     # If the current working directory is provided, the outputs will be written to there as well.
     if cwd is not None:
@@ -1402,17 +1690,24 @@ def _exec(command, print_to_screen = False, outfnm = None, logfnm = None, stdin
             logfnm = os.path.abspath(os.path.join(cwd, logfnm))
 
     # "write to file" : Function for writing some characters to the log and/or output files.
+    # The files are opened once (when there is something to write) and closed at the end.
     def wtf(out):
-        if logfnm is not None:
-            with open(logfnm,'ab+') as f:
-                f.write(out.encode('utf-8'))
-                f.flush()
-        if outfnm is not None:
-            with open(outfnm,'wb+' if wtf.first else 'ab+') as f:
-                f.write(out.encode('utf-8'))
-                f.flush()
-        wtf.first = False
-    wtf.first = True
+        if wtf.files is None:
+            wtf.files = []
+            if logfnm is not None:
+                wtf.files.append(open(logfnm, 'ab'))
+            if outfnm is not None:
+                wtf.files.append(open(outfnm, 'wb'))
+        for f in wtf.files:
+            f.write(out.encode('utf-8'))
+    wtf.files = None
+    def wtf_flush():
+        for f in (wtf.files or []):
+            f.flush()
+    def wtf_close():
+        for f in (wtf.files or []):
+            f.close()
+        wtf.files = None
 
     # Preserve backwards compatibility; sometimes None gets passed to stdin.
     if stdin is None: stdin = ""
@@ -1438,8 +1733,6 @@ def _exec(command, print_to_screen = False, outfnm = None, logfnm = None, stdin
     #| stdout as well as stderr streams, and also carriage returns |#
     #| along with newline characters.                              |#
     #===============================================================#
-    # stdout and stderr streams of the process.
-    streams = [p.stdout, p.stderr]
     # Are we using Python 2?
     p2 = sys.version_info.major == 2
     # These are functions that take chunks of lines (read) as inputs.
@@ -1466,69 +1759,31 @@ def _exec(command, print_to_screen = False, outfnm = None, logfnm = None, stdin
             process_out.stdout.append(read)
             wtf(read)
     process_err.stderr = []
-    # This reads the streams one byte at a time, and passes it to the LineChunker
-    # which splits it by either newline or carriage return.
-    # If the stream has ended, then it is removed from the list.
-    with LineChunker(process_out) as out_chunker, LineChunker(process_err) as err_chunker:
-        while True:
-            to_read, _, _ = select(streams, [], [])
-            for fh in to_read:
-                # We want to call fh.read below, but this can lead to a system hang when executing Tinker on mac.
-                # This hang can be avoided by running fh.read1 (with a "1" at the end), however python2.7
-                # doesn't implement ByteStream.read1. So, to enable python3 builds on mac to work, we pick the "best"
-                # fh.read function we can get
-                if hasattr(fh, 'read1'):
-                    fhread = fh.read1
-                else:
-                    fhread = fh.read
-
-                if fh is p.stdout:
-                    read_nbytes = 0
-                    read = ''.encode('utf-8')
-                    while True:
-                        if read_nbytes == 0:
-                            read += fhread(rbytes)
-                            read_nbytes += rbytes
-                        else:
-                            read += fhread(1)
-                            read_nbytes += 1
-                        if read_nbytes > 10+rbytes:
-                            raise RuntimeError("Failed to decode stdout from external process.")
-                        if not read:
-                            streams.remove(p.stdout)
-                            p.stdout.close()
-                            break
-                        else:
-                            try:
-                                out_chunker.push(read)
-                                break
-                            except UnicodeDecodeError:
-                                pass
-                elif fh is p.stderr:
-                    read_nbytes = 0
-                    read = ''.encode('utf-8')
-                    while True:
-                        if read_nbytes == 0:
-                            read += fhread(rbytes)
-                            read_nbytes += rbytes
-                        else:
-                            read += fhread(1)
-                            read_nbytes += 1
-                        if read_nbytes > 10+rbytes:
-                            raise RuntimeError("Failed to decode stderr from external process.")
-                        if not read:
-                            streams.remove(p.stderr)
-                            p.stderr.close()
-                            break
-                        else:
-                            try:
-                                err_chunker.push(read)
-                                break
-                            except UnicodeDecodeError:
-                                pass
-                else:
-                    raise RuntimeError
-            if len(streams) == 0: break
+    # The streams are read in large chunks as data becomes available, and passed
+    # to the LineChunker which splits it by either newline or carriage return.
+    # Both streams are watched by the same selector, so lines are copied in the order they arrive.
+    # If the stream has ended, then it is unregistered from the selector.
+    try:
+        with LineChunker(process_out, expand_cr) as out_chunker, LineChunker(process_err, expand_cr) as err_chunker:
+            sel = selectors.DefaultSelector()
+            sel.register(p.stdout, selectors.EVENT_READ, (out_chunker, "stdout"))
+            sel.register(p.stderr, selectors.EVENT_READ, (err_chunker, "stderr"))
+            while sel.get_map():
+                for key, _ in sel.select():
+                    chunker, name = key.data
+                    read = os.read(key.fd, rbytes)
+                    if not read:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                        continue
+                    try:
+                        chunker.push(read)
+                    except UnicodeDecodeError:
+                        raise RuntimeError("Failed to decode %s from external process." % name)
+                wtf_flush()
+            sel.close()
+    finally:
+        wtf_close()
 
     p.wait()
 
@@ -6,13 +6,18 @@ from __future__ import division
 from builtins import range
 from builtins import object
 import sys
+import time
+import pickle
+import hashlib
 import inspect
+import multiprocessing
+import multiprocessing.connection
 #from implemented import Implemented_Targets
 import numpy as np
 from collections import defaultdict, OrderedDict
 import forcebalance
 from forcebalance.finite_difference import in_fd
-from forcebalance.nifty import printcool_dictionary, createWorkQueue, getWorkQueue, wq_wait
+from forcebalance.nifty import printcool_dictionary, createWorkQueue, createLocalWorkQueue, getWorkQueue, wq_wait
 import datetime
 import traceback
 from forcebalance.output import getLogger
@@ -134,6 +139,79 @@ Implemented_Targets = {
 ## This is the canonical lettering that corresponds to : objective function, gradient, Hessian.
 Letters = ['X','G','H']
 
+class _HashWriter(object):
+    """ File-like object that hashes the bytes written to it. """
+    def __init__(self):
+        self.hash = hashlib.sha1()
+
+    def write(self, data):
+        self.hash.update(data)
+
+def _digest(value):
+    """ Return a hash of the pickled value, or None if it cannot be pickled. """
+    writer = _HashWriter()
+    try:
+        pickle.Pickler(writer, protocol=pickle.HIGHEST_PROTOCOL).dump(value)
+    except Exception:
+        return None
+    return writer.hash.digest()
+
+class _Changes(dict):
+    """ Changed attributes of an object that the target refers to (e.g. the force field or engine). """
+
+def _snapshot(obj, Tgt):
+    """
+    Return the hashes of the attributes of obj (the target), so that attributes
+    modified either by assignment or in place can be found afterward.  Attributes
+    that are ForceBalance objects (the force field, engine) are followed one level
+    down, so that their state can be updated without replacing the objects.
+    """
+    snap = {}
+    for k, v in obj.__dict__.items():
+        if v is Tgt: continue
+        if isinstance(v, forcebalance.BaseClass):
+            if obj is Tgt: snap[k] = _snapshot(v, Tgt)
+            continue
+        snap[k] = _digest(v)
+    return snap
+
+def _changes(obj, snap, Tgt):
+    """ Return the picklable attributes of obj whose hashes differ from the snapshot. """
+    changes = {}
+    for k, v in obj.__dict__.items():
+        if v is Tgt: continue
+        if isinstance(v, forcebalance.BaseClass):
+            if obj is Tgt and isinstance(snap.get(k, None), dict):
+                sub = _changes(v, snap[k], Tgt)
+                if sub: changes[k] = _Changes(sub)
+            continue
+        h = _digest(v)
+        if h is not None and h != snap.get(k, None):
+            changes[k] = v
+    return changes
+
+def _apply_changes(obj, changes):
+    """ Update the attributes of obj (in the parent process) with the changes returned by _changes. """
+    for k, v in changes.items():
+        if isinstance(v, _Changes):
+            _apply_changes(obj.__dict__[k], v)
+        else:
+            obj.__dict__[k] = v
+
+def _target_worker(Tgt, mvals, Order, customdir, conn):
+    """ Evaluate one target inside a forked process and send the result back through a pipe. """
+    try:
+        before = _snapshot(Tgt, Tgt)
+        t0 = time.time()
+        Funcs = [Tgt.get_X, Tgt.get_G, Tgt.get_H]
+        Ans = Funcs[Order](mvals, customdir=customdir)
+        elapsed = time.time() - t0
+        conn.send((True, (Ans, _changes(Tgt, before, Tgt), elapsed)))
+    except BaseException:
+        conn.send((False, traceback.format_exc()))
+    finally:
+        conn.close()
+
 class Objective(forcebalance.BaseClass):
     """ Objective function.
 
@@ -164,6 +242,11 @@ class Objective(forcebalance.BaseClass):
         self.set_option(options, 'wq_port')
         ## Asynchronous objective function evaluation (i.e. execute Work Queue and local objective concurrently.)
         self.set_option(options, 'asynchronous')
+        ## Number of local processes for evaluating targets concurrently
+        self.set_option(options, 'target_workers')
+        ## Number of concurrent jobs and GPUs for the local job runner (used when there is no Work Queue port)
+        self.set_option(options, 'local_workers')
+        self.set_option(options, 'local_gpus')
 
         ## The list of fitting targets
         self.Targets = []
@@ -200,11 +283,16 @@ class Objective(forcebalance.BaseClass):
             self.WTot = 1.0
         self.ObjDict = OrderedDict()
         self.ObjDict_Last = OrderedDict()
+        ## Wall time of the most recent evaluation of each target (used to schedule concurrent evaluations)
+        self.TargetTimes = OrderedDict()
 
         # Create the work queue here.
         if self.wq_port != 0:
             createWorkQueue(self.wq_port)
             logger.info('Work Queue is listening on %d\n' % self.wq_port)
+        elif self.local_workers > 0:
+            createLocalWorkQueue(self.local_workers, gpus=self.local_gpus)
+            logger.info('Running Work Queue jobs locally with %d workers and %d GPUs\n' % (self.local_workers, self.local_gpus))
 
         printcool_dictionary(self.PrintOptionDict, "Setup for objective function :")
 
@@ -244,15 +332,26 @@ class Objective(forcebalance.BaseClass):
                         pass
         else:
             wq = getWorkQueue()
+            Answers = None
             if wq is not None:
                 wq_wait(wq)
+            elif self.target_workers > 1 and len(self.Targets) > 1:
+                # Evaluate the targets in worker processes; contributions are added up below in the usual order.
+                for Tgt in self.Targets:
+                    Tgt.bSave = True
+                Answers = self.Target_Terms_Concurrent(mvals, Order, customdir)
             for Tgt in self.Targets:
                 # The first call is always done at the midpoint.
                 Tgt.bSave = True
-                # List of functions that I can call.
-                Funcs   = [Tgt.get_X, Tgt.get_G, Tgt.get_H]
-                # Call the appropriate function
-                Ans = Funcs[Order](mvals, customdir=customdir)
+                if Answers is not None:
+                    Ans = Answers[Tgt.name]
+                else:
+                    # List of functions that I can call.
+                    Funcs   = [Tgt.get_X, Tgt.get_G, Tgt.get_H]
+                    # Call the appropriate function
+                    t0 = time.time()
+                    Ans = Funcs[Order](mvals, customdir=customdir)
+                    self.TargetTimes[Tgt.name] = time.time() - t0
                 # Print out the qualitative indicators
                 if verbose:
                     Tgt.meta_indicate(customdir=customdir)
@@ -270,6 +369,61 @@ class Objective(forcebalance.BaseClass):
                 Objective['H'][i,i] = 1.0
         return Objective
 
+    def Target_Terms_Concurrent(self, mvals, Order=0, customdir=None):
+        """
+        Evaluate the targets concurrently, each in its own forked process
+        with at most self.target_workers running at once.  Targets that took
+        longest in the previous evaluation are started first.
+
+        Each process has its own working directory, so the os.chdir calls
+        in meta_get are isolated.  The answer is sent back to the parent
+        along with any target attributes that were reassigned during the
+        evaluation (e.g. the quantities printed by meta_indicate), found by
+        comparing hashes of the pickled attributes so that arrays, lists and
+        dicts changed in place are included.  The force field and engine are
+        updated attribute by attribute in the same way; attributes that cannot
+        be pickled (e.g. simulation objects) stay in the child process.
+
+        @param[in] mvals The mathematical parameters
+        @param[in] Order The requested order of differentiation
+        @param[in] customdir Custom directory that the targets are evaluated under
+        @return Answers Dictionary of target name -> objective function contribution
+        """
+        Queue = sorted(self.Targets, key=lambda Tgt: -self.TargetTimes.get(Tgt.name, np.inf))
+        Running = OrderedDict()
+        Answers = OrderedDict()
+        ctx = multiprocessing.get_context('fork')
+        while len(Queue) > 0 or len(Running) > 0:
+            while len(Queue) > 0 and len(Running) < self.target_workers:
+                Tgt = Queue.pop(0)
+                recv_conn, send_conn = ctx.Pipe(duplex=False)
+                proc = ctx.Process(target=_target_worker, args=(Tgt, mvals, Order, customdir, send_conn))
+                proc.start()
+                send_conn.close()
+                Running[recv_conn] = (Tgt, proc)
+            for conn in multiprocessing.connection.wait(list(Running.keys())):
+                Tgt, proc = Running.pop(conn)
+                try:
+                    status, result = conn.recv()
+                except EOFError:
+                    status, result = False, "Process evaluating target %s exited unexpectedly\n" % Tgt.name
+                conn.close()
+                proc.join()
+                if not status:
+                    for conn_, (Tgt_, proc_) in Running.items():
+                        proc_.terminate()
+                        proc_.join()
+                    logger.error(result)
+                    logger.error("Concurrent evaluation of target %s failed\n" % Tgt.name)
+                    raise RuntimeError
+                Ans, changes, elapsed = result
+                _apply_changes(Tgt, changes)
+                self.TargetTimes[Tgt.name] = elapsed
+                Answers[Tgt.name] = Ans
+        # The workers printed force fields that this process's make() doesn't know about.
+        self.FF.forget_written()
+        return Answers
+
     def Indicate(self):
         """ Print objective function contributions. """
         PrintDict = OrderedDict()
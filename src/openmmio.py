@@ -23,6 +23,7 @@ import numpy as np
 import sys
 import pickle
 import shutil
+from io import BytesIO
 from copy import deepcopy
 from forcebalance.engine import Engine
 from forcebalance.molecule import *
@@ -33,6 +34,11 @@ from collections import OrderedDict
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
 
+try:
+    from lxml import etree
+except ImportError:
+    pass
+
 # Handle simtk namespace change around 7.6 release
 try:
     try:
@@ -418,6 +424,26 @@ def UpdateSimulationParameters(src_system, dest_simulation):
                 dest_simulation.context.setParameter(pName, pValue)
 
 
+## Force types whose parameters may be set directly by OpenMM.update_parameters_fast.
+## Each entry gives the methods that return the number of terms, and get / set the parameters of one term.
+FastUpdateForces = {'HarmonicBondForce':('getNumBonds', 'getBondParameters', 'setBondParameters'),
+                    'HarmonicAngleForce':('getNumAngles', 'getAngleParameters', 'setAngleParameters'),
+                    'PeriodicTorsionForce':('getNumTorsions', 'getTorsionParameters', 'setTorsionParameters'),
+                    'RBTorsionForce':('getNumTorsions', 'getTorsionParameters', 'setTorsionParameters'),
+                    'NonbondedForce':('getNumParticles', 'getParticleParameters', 'setParticleParameters'),
+                    'GBSAOBCForce':('getNumParticles', 'getParticleParameters', 'setParticleParameters'),
+                    'CMMotionRemover':None}
+
+## Term parameters (by position in the getter output) that the energy of each force depends on linearly.
+LinearTermParameters = {'HarmonicBondForce':[3],
+                        'HarmonicAngleForce':[4],
+                        'PeriodicTorsionForce':[6],
+                        'RBTorsionForce':[4, 5, 6, 7, 8, 9]}
+
+def GetTermParameters(force, getter, i):
+    """ Return the parameters of one term in a force as plain numbers in OpenMM's (MD) unit system. """
+    return [x.value_in_unit_system(md_unit_system) if is_quantity(x) else x for x in getattr(force, getter)(i)]
+
 def SetAmoebaVirtualExclusions(system):
     if any([f.__class__.__name__ == "AmoebaMultipoleForce" for f in system.getForces()]):
         # logger.info("Cajoling AMOEBA covalent maps so they work with virtual sites.\n")
@@ -562,6 +588,80 @@ def MTSVVVRIntegrator(temperature, collision_rate, timestep, system, ninnersteps
 Bond/length/OW.HW
 The dictionary is two-layered because the same interaction type (Bond)
 could be under two different parent types (HarmonicBondForce, AmoebaHarmonicBondForce)"""
+class TrajectoryBuffer(object):
+    """ Compact storage for the frames saved during molecular dynamics.
+
+    Positions are kept in one float32 (nframes, natoms, 3) array and box vectors
+    in one (nframes, 3, 3) array, both in nanometers, optionally backed by a file
+    on disk (np.memmap) for very large trajectories.  Indexing returns the same
+    (positions, box_vectors) pair of Quantities as the list of frames that was
+    used before, so existing code that iterates over xyz_omms keeps working;
+    OpenMM.set_positions reads the arrays directly.
+    """
+
+    def __init__(self, natoms, nframes=0, pbc=True, fnm=None):
+        ## Number of frames stored so far
+        self.nframes = 0
+        ## Whether box vectors are stored
+        self.pbc = pbc
+        ## File name for the disk-backed coordinate array, if any
+        self.fnm = fnm
+        if fnm is not None:
+            self.xyzs = np.lib.format.open_memmap(fnm, mode='w+', dtype=np.float32, shape=(max(nframes, 1), natoms, 3))
+        else:
+            self.xyzs = np.zeros((max(nframes, 1), natoms, 3), dtype=np.float32)
+        self.boxes = np.zeros((max(nframes, 1), 3, 3)) if pbc else None
+
+    def __len__(self):
+        return self.nframes
+
+    def grow(self, nframes):
+        """ Make room for at least nframes frames, doubling the allocation when needed. """
+        if nframes <= self.xyzs.shape[0]: return
+        nalloc = max(nframes, 2*self.xyzs.shape[0])
+        if self.fnm is not None:
+            self.xyzs.flush()
+            xyzs = np.lib.format.open_memmap(self.fnm + '.tmp', mode='w+', dtype=np.float32, shape=(nalloc,) + self.xyzs.shape[1:])
+            xyzs[:self.nframes] = self.xyzs[:self.nframes]
+            del self.xyzs
+            os.replace(self.fnm + '.tmp', self.fnm)
+            self.xyzs = xyzs
+        else:
+            xyzs = np.zeros((nalloc,) + self.xyzs.shape[1:], dtype=np.float32)
+            xyzs[:self.nframes] = self.xyzs[:self.nframes]
+            self.xyzs = xyzs
+        if self.pbc:
+            boxes = np.zeros((nalloc, 3, 3))
+            boxes[:self.nframes] = self.boxes[:self.nframes]
+            self.boxes = boxes
+
+    def __setitem__(self, i, frame):
+        positions, box_vectors = frame
+        if i < 0: i += self.nframes
+        if isinstance(positions, Quantity):
+            positions = positions.value_in_unit(nanometer)
+        self.xyzs[i] = np.array(positions)
+        if self.pbc:
+            if isinstance(box_vectors, Quantity):
+                box_vectors = box_vectors.value_in_unit(nanometer)
+            self.boxes[i] = np.array([list(v.value_in_unit(nanometer) if isinstance(v, Quantity) else v) for v in box_vectors])
+
+    def append(self, frame):
+        self.grow(self.nframes + 1)
+        self.nframes += 1
+        self[self.nframes - 1] = frame
+
+    def __getitem__(self, i):
+        if i < 0: i += self.nframes
+        if i < 0 or i >= self.nframes:
+            raise IndexError('Frame %i is out of range for %i frames' % (i, self.nframes))
+        box_vectors = Quantity([Vec3(*v) for v in self.boxes[i].tolist()], nanometer) if self.pbc else None
+        return [self.xyzs[i] * nanometer, box_vectors]
+
+    def __iter__(self):
+        for i in range(self.nframes):
+            yield self[i]
+
 suffix_dict = { "HarmonicBondForce" : {"Bond" : ["class1","class2"]},
                 "HarmonicAngleForce" : {"Angle" : ["class1","class2","class3"],},
                 "PeriodicTorsionForce" : {"Proper" : ["class1","class2","class3","class4"], "Improper" : ["class1", "class2", "class3", "class4"],},
@@ -622,10 +722,10 @@ class OpenMM(Engine):
 
     def __init__(self, name="openmm", **kwargs):
         if not hasattr(self, 'valkwd'):
-            self.valkwd = ['ffxml', 'pdb', 'platname', 'precision', 'mmopts', 'vsite_bonds', 'implicit_solvent', 'restrain_k', 'freeze_atoms']
+            self.valkwd = ['ffxml', 'pdb', 'platname', 'precision', 'mmopts', 'vsite_bonds', 'implicit_solvent', 'restrain_k', 'freeze_atoms', 'linear_deriv']
         super(OpenMM,self).__init__(name=name, **kwargs)
 
-    def setopts(self, platname="CUDA", precision="single", **kwargs):
+    def setopts(self, platname="CUDA", precision="single", linear_deriv=False, **kwargs):
 
         """ Called by __init__ ; Set OpenMM-specific options. """
 
@@ -633,9 +733,11 @@ class OpenMM(Engine):
         if hasattr(self,'target'):
             self.platname = self.target.platname
             self.precision = self.target.precision
+            self.linear_deriv = getattr(self.target, 'linear_deriv', False)
         else:
             self.platname = platname
             self.precision = precision
+            self.linear_deriv = linear_deriv
 
         valnames = [Platform.getPlatform(i).getName() for i in range(Platform.getNumPlatforms())]
         if self.platname not in valnames:
@@ -724,7 +826,9 @@ class OpenMM(Engine):
         if hasattr(self, 'abspdb'):
             self.pdb = PDBFile(self.abspdb)
         else:
-            pdb1 = "%s-1.pdb" % os.path.splitext(os.path.basename(self.mol.fnm))[0]
+            # The process ID keeps the file name unique when engines are
+            # created concurrently (e.g. by finite difference worker processes).
+            pdb1 = "%s-%i.pdb" % (os.path.splitext(os.path.basename(self.mol.fnm))[0], os.getpid())
             self.mol[0].write(pdb1)
             self.pdb = PDBFile(pdb1)
             os.unlink(pdb1)
@@ -953,35 +1057,34 @@ class OpenMM(Engine):
         #                           for i in self.simulation.context.getPlatform().getPropertyNames()}, \
         #                          title="Platform %s has properties:" % self.simulation.context.getPlatform().getName())
 
-    def update_simulation(self, **kwargs):
-
+    def make_system(self, *ffxml):
         """
-        Create the simulation object, or update the force field
-        parameters in the existing simulation object.  This should be
-        run when we write a new force field XML file.
+        Create the OpenMM ForceField, Modeller and System objects from
+        force field XML files (file names or file objects).
+
+        @param[in] ffxml Force field XML files
+        @return forcefield, mod, system The OpenMM ForceField, Modeller and System objects
         """
-        if len(kwargs) > 0:
-            self.simkwargs = kwargs
-        self.forcefield = ForceField(*self.ffxml)
+        ff = ForceField(*ffxml)
         # OpenMM classes for force generators
         ismgens = [forcefield.AmoebaGeneralizedKirkwoodGenerator, forcefield.AmoebaWcaDispersionGenerator,
                      forcefield.CustomGBGenerator, forcefield.GBSAOBCGenerator]
         if self.ism is not None:
             if self.ism == False:
-                self.forcefield._forces = [f for f in self.forcefield._forces if not any([isinstance(f, f_) for f_ in ismgens])]
+                ff._forces = [f for f in ff._forces if not any([isinstance(f, f_) for f_ in ismgens])]
             elif self.ism == True:
-                if len([f for f in self.forcefield._forces if any([isinstance(f, f_) for f_ in ismgens])]) == 0:
+                if len([f for f in ff._forces if any([isinstance(f, f_) for f_ in ismgens])]) == 0:
                     logger.error("There is no implicit solvent model!\n")
                     raise RuntimeError
-        self.mod = Modeller(self.pdb.topology, self.pdb.positions)
-        self.mod.addExtraParticles(self.forcefield)
+        mod = Modeller(self.pdb.topology, self.pdb.positions)
+        mod.addExtraParticles(ff)
         # Add bonds for virtual sites. (Experimental)
-        if self.vbonds: AddVirtualSiteBonds(self.mod, self.forcefield)
+        if self.vbonds: AddVirtualSiteBonds(mod, ff)
         #printcool_dictionary(self.mmopts, title="Creating/updating simulation in engine %s with system settings:" % (self.name))
-        # for b in list(self.mod.topology.bonds()):
+        # for b in list(mod.topology.bonds()):
         #     print b[0].index, b[1].index
         try:
-            self.system = self.forcefield.createSystem(self.mod.topology, **self.mmopts)
+            system = ff.createSystem(mod.topology, **self.mmopts)
         # This try/except block catches a failure case introduced by the release of openmm 7.7
         # where a ValueError would be raised if createSystem was given an unused kwarg.
         # Now, when that error occurs, we remove the unused kwargs from mmopts.
@@ -991,7 +1094,23 @@ class OpenMM(Engine):
                 raise e
             self.mmopts.pop('useSwitchingFunction')
             self.mmopts.pop('switchingDistance')
-            self.system = self.forcefield.createSystem(self.mod.topology, **self.mmopts)
+            system = ff.createSystem(mod.topology, **self.mmopts)
+        return ff, mod, system
+
+    def update_simulation(self, **kwargs):
+
+        """
+        Create the simulation object, or update the force field
+        parameters in the existing simulation object.  This should be
+        run when we write a new force field XML file.
+        """
+        if len(kwargs) > 0:
+            self.simkwargs = kwargs
+        # Set the new parameters directly in the existing simulation if we can.
+        if hasattr(self, 'simulation') and getattr(self, 'fast_update', None) is not None:
+            self.update_parameters_fast()
+            return
+        self.forcefield, self.mod, self.system = self.make_system(*self.ffxml)
         self.vsinfo = PrepareVirtualSites(self.system)
         self.nbcharges = np.zeros(self.system.getNumParticles())
 
@@ -1038,6 +1157,179 @@ class OpenMM(Engine):
             UpdateSimulationParameters(self.system, self.simulation)
         else:
             self.create_simulation(**self.simkwargs)
+        if not hasattr(self, 'fast_update'):
+            self.prepare_fast_update()
+
+    def prepare_fast_update(self):
+
+        """
+        Work out where each parameter in the force field file goes in
+        the simulation's System, so that later calls to update_simulation
+        can set the new values directly instead of creating a new System.
+
+        Every parameterized attribute in the force field file is set to a
+        unique marker value and a System is created from the result.  Any
+        term parameter equal to a marker comes straight from that attribute;
+        1-4 exceptions in NonbondedForce are recomputed from the particle
+        parameters.  If anything else changes (e.g. constraints, virtual
+        sites, or forces not in FastUpdateForces), self.fast_update is set
+        to None and the System is created again on every update.
+        """
+        self.fast_update = None
+        if not hasattr(self, 'FF') or self.ffxml != [self.FF.openmmxml]: return
+        locs = sorted(set([(pf[2], pf[3]) for pf in self.FF.pfields if pf[1] == self.FF.openmmxml]))
+        if len(locs) == 0: return
+        tree = etree.parse(self.ffxml[0])
+        elements = list(tree.iter())
+        markers = OrderedDict([(1.0 + 0.001234567*(k+1), k) for k in range(len(locs))])
+        for (ln, fld), mk in zip(locs, markers):
+            elements[ln].attrib[fld] = repr(mk)
+        try:
+            mkforcefield, mod, mksystem = self.make_system(BytesIO(etree.tostring(tree)))
+        except Exception:
+            logger.debug("Fast parameter update disabled for %s: cannot create system with marker parameters\n" % self.name)
+            return
+        system = self.simulation.system
+        def disable(reason):
+            logger.debug("Fast parameter update disabled for %s: %s\n" % (self.name, reason))
+        # Things that must not depend on the force field parameters.
+        if mksystem.getNumParticles() != system.getNumParticles() or mksystem.getNumForces() > system.getNumForces():
+            return disable("different numbers of particles or forces")
+        if any([mksystem.getParticleMass(i) != system.getParticleMass(i) for i in range(system.getNumParticles()) if system.getParticleMass(i)._value != 0.0]):
+            return disable("particle masses depend on the parameters")
+        if [mksystem.getConstraintParameters(i) for i in range(mksystem.getNumConstraints())] != \
+           [system.getConstraintParameters(i) for i in range(system.getNumConstraints())]:
+            return disable("constraints depend on the parameters")
+        if not np.array_equal(GetVirtualSiteParameters(mksystem), self.vsprm):
+            return disable("virtual sites depend on the parameters")
+        # Map each term parameter to the attribute it comes from.
+        fmap = OrderedDict()
+        exceptions = OrderedDict()
+        for i in range(mksystem.getNumForces()):
+            f0 = system.getForce(i)
+            f1 = mksystem.getForce(i)
+            nm = f1.__class__.__name__
+            if nm not in FastUpdateForces or f0.__class__.__name__ != nm:
+                return disable("no fast update for %s" % nm)
+            if FastUpdateForces[nm] is None: continue
+            fnum, fget, fset = FastUpdateForces[nm]
+            if getattr(f0, fnum)() != getattr(f1, fnum)():
+                return disable("number of terms in %s depends on the parameters" % nm)
+            terms = OrderedDict()
+            for j in range(getattr(f1, fnum)()):
+                prm0 = GetTermParameters(f0, fget, j)
+                prm1 = GetTermParameters(f1, fget, j)
+                slots = []
+                for k, (x0, x1) in enumerate(zip(prm0, prm1)):
+                    if isinstance(x1, float) and x1 in markers:
+                        slots.append((k, markers[x1]))
+                    elif x0 != x1:
+                        return disable("%s parameters are not copied directly from the force field" % nm)
+                if len(slots) > 0: terms[j] = slots
+            if len(terms) > 0: fmap[i] = terms
+            if nm == 'NonbondedForce':
+                # The 1-4 interactions are combinations of particle parameters.
+                gen = [g for g in mkforcefield._forces if isinstance(g, forcefield.NonbondedGenerator)]
+                if len(gen) != 1: return disable("cannot find the NonbondedForce generator")
+                c14, l14 = gen[0].coulomb14scale, gen[0].lj14scale
+                combos = []
+                for j in range(f1.getNumExceptions()):
+                    p1, p2, qq, sig, eps = GetTermParameters(f1, 'getExceptionParameters', j)
+                    q1, s1, e1 = GetTermParameters(f1, 'getParticleParameters', p1)
+                    q2, s2, e2 = GetTermParameters(f1, 'getParticleParameters', p2)
+                    if [qq, sig, eps] == [c14*q1*q2, 0.5*(s1+s2), l14*np.sqrt(e1*e2)]:
+                        combos.append((j, p1, p2))
+                    elif [qq, sig, eps] != GetTermParameters(f0, 'getExceptionParameters', j)[2:]:
+                        return disable("NonbondedForce exceptions are not standard 1-4 interactions")
+                exceptions[i] = (c14, l14, combos)
+        # Attributes that did not turn up in the System must not be global (force-level) settings.
+        found = set([k for terms in fmap.values() for slots in terms.values() for s, k in slots])
+        for k, (ln, fld) in enumerate(locs):
+            if k not in found and elements[ln].getparent() is tree.getroot():
+                return disable("%s attribute of %s is not a per-term parameter" % (fld, elements[ln].tag))
+        # Values of the parameters currently in the simulation
+        elements = list(etree.parse(self.ffxml[0]).iter())
+        self.fast_update = {'locs':locs, 'map':fmap, 'exceptions':exceptions,
+                            'vals':np.array([float(elements[ln].attrib[fld]) for ln, fld in locs])}
+        logger.debug("Parameters of %s will be updated in place\n" % self.name)
+
+    def fast_update_values(self):
+        """ Read the values of the parameters that prepare_fast_update located from the force field file. """
+        elements = list(etree.parse(self.ffxml[0]).iter())
+        return np.array([float(elements[ln].attrib[fld]) for ln, fld in self.fast_update['locs']])
+
+    def fast_update_terms(self, vals, changed, cache=None):
+
+        """
+        Work out the term parameters in the simulation's System that
+        correspond to a set of parameter values, without setting them.
+
+        @param[in] vals Values of the parameters located by prepare_fast_update
+        @param[in] changed Boolean array marking the values that differ from the ones in the System
+        @param[in] cache Optional dictionary for keeping the current term parameters between calls
+        @return terms OrderedDict of force index -> list of (setter name, term index, parameters)
+        @return charges Nonbonded charges for these parameter values, or None if they do not change
+        """
+        fu = self.fast_update
+        system = self.simulation.system
+        terms_out = OrderedDict()
+        charges = None
+        for i, terms in fu['map'].items():
+            frc = system.getForce(i)
+            fnum, fget, fset = FastUpdateForces[frc.__class__.__name__]
+            if cache is not None and i not in cache:
+                cache[i] = [GetTermParameters(frc, fget, j) for j in range(getattr(frc, fnum)())]
+            def current(j):
+                return cache[i][j][:] if cache is not None else GetTermParameters(frc, fget, j)
+            upd = []
+            for j, slots in terms.items():
+                if not any([changed[k] for s, k in slots]): continue
+                prm = current(j)
+                for s, k in slots:
+                    prm[s] = vals[k]
+                upd.append((fset, j, prm))
+            if i in fu['exceptions'] and len(upd) > 0:
+                c14, l14, combos = fu['exceptions'][i]
+                particles = dict([(j, prm) for fs, j, prm in upd])
+                def particle(p):
+                    return particles[p] if p in particles else current(p)
+                for j, p1, p2 in combos:
+                    if p1 not in particles and p2 not in particles: continue
+                    q1, s1, e1 = particle(p1)
+                    q2, s2, e2 = particle(p2)
+                    upd.append(('setExceptionParameters', j, [p1, p2, c14*q1*q2, 0.5*(s1+s2), l14*np.sqrt(e1*e2)]))
+                charges = self.nbcharges.copy()
+                for j, prm in particles.items():
+                    charges[j] = prm[0]
+            if len(upd) > 0:
+                terms_out[i] = upd
+        return terms_out, charges
+
+    def update_parameters_fast(self):
+
+        """
+        Read the force field file and set the changed parameters directly
+        in the System and Context of the existing simulation.  Only used
+        after prepare_fast_update has found where each parameter goes.
+        """
+        fu = self.fast_update
+        vals = self.fast_update_values()
+        changed = vals != fu['vals']
+        if not np.any(changed): return
+        terms, charges = self.fast_update_terms(vals, changed)
+        self.set_terms(terms)
+        if charges is not None:
+            self.nbcharges = charges
+        fu['vals'] = vals
+
+    def set_terms(self, terms):
+        """ Set term parameters (as returned by fast_update_terms) in the System and Context. """
+        system = self.simulation.system
+        for i, upd in terms.items():
+            frc = system.getForce(i)
+            for fset, j, prm in upd:
+                getattr(frc, fset)(j, *prm)
+            frc.updateParametersInContext(self.simulation.context)
 
     def set_restraint_positions(self, shot):
         """
@@ -1073,6 +1365,13 @@ class OpenMM(Engine):
         #     simulation.context.computeVirtualSites()
         #----
         # NOTE: Periodic box vectors must be set FIRST
+        if isinstance(self.xyz_omms, TrajectoryBuffer):
+            # Frames saved from MD are passed to OpenMM directly from the arrays (in nanometers).
+            if self.pbc:
+                self.simulation.context.setPeriodicBoxVectors(*[Vec3(*v) for v in self.xyz_omms.boxes[shot].tolist()])
+            self.simulation.context.setPositions(self.xyz_omms.xyzs[shot])
+            self.simulation.context.computeVirtualSites()
+            return
         if self.pbc:
             self.simulation.context.setPeriodicBoxVectors(*self.xyz_omms[shot][1])
         # self.simulation.context.setPositions(ResetVirtualSites(self.xyz_omms[shot][0], self.system))
@@ -1131,7 +1430,7 @@ class OpenMM(Engine):
         self.update_simulation()
 
         # If trajectory flag set to False, perform a single-point calculation.
-        if not traj: return evaluate_one_(force, dipole)
+        if not traj: return self.evaluate_one_(force, dipole)
         Energies = []
         Forces = []
         Dipoles = []
@@ -1150,13 +1449,15 @@ class OpenMM(Engine):
         return Result
 
     def energy_one(self, shot):
+        self.update_simulation()
         self.set_positions(shot)
-        return self.evaluate_()["Energy"]
+        return np.array([self.evaluate_one_()["Energy"]])
 
     def energy_force_one(self, shot):
+        self.update_simulation()
         self.set_positions(shot)
-        Result = self.evaluate_(force=True)
-        return np.hstack((Result["Energy"].reshape(-1,1), Result["Force"]))
+        Result = self.evaluate_one_(force=True)
+        return np.hstack(([Result["Energy"]], Result["Force"]))
 
     def energy(self):
         return self.evaluate_(traj=True)["Energy"]
@@ -1173,6 +1474,80 @@ class OpenMM(Engine):
         Result = self.evaluate_(dipole=True, traj=True)
         return np.hstack((Result["Energy"].reshape(-1,1), Result["Dipole"]))
 
+    def energy_multi(self, mvals_list, dipole=False):
+
+        """
+        Compute the energies (and optionally dipoles) of the stored snapshots
+        for several sets of parameter values, looping over the snapshots once.
+
+        For each snapshot, the positions are set once and the energy is computed
+        with the first set of parameters.  For each other set, the changed terms
+        are set in the Context, only the force groups containing them are
+        recomputed (or the whole energy if the NonbondedForce changes), and the
+        terms are set back.  Dipoles are computed from the changed charges directly.
+
+        This requires the parameters to be updated in place (see prepare_fast_update);
+        otherwise each set of parameters is evaluated over the whole trajectory.
+
+        @param[in] mvals_list List of mathematical parameter values
+        @param[in] dipole Switch for dipoles
+        @return List of arrays returned by energy() or energy_dipole(), one per set of parameters
+        """
+        self.FF.make(mvals_list[0])
+        self.update_simulation()
+        if getattr(self, 'fast_update', None) is None:
+            return super(OpenMM, self).energy_multi(mvals_list, dipole)
+        fu = self.fast_update
+        # Term parameters to set, and to set back, for each set of parameter values.
+        # If a NonbondedForce changes, the whole energy is computed because it is the most expensive part anyway.
+        sets = []
+        cache = {}
+        for mvals in mvals_list[1:]:
+            self.FF.make(mvals)
+            vals = self.fast_update_values()
+            changed = vals != fu['vals']
+            terms, charges = self.fast_update_terms(vals, changed, cache)
+            restore, _ = self.fast_update_terms(fu['vals'], changed, cache)
+            groups = 0
+            for i in terms:
+                if isinstance(self.simulation.system.getForce(i), NonbondedForce):
+                    groups = -1
+                    break
+                groups |= 1 << self.simulation.system.getForce(i).getForceGroup()
+            sets.append((terms, restore, groups, self.nbcharges if charges is None else charges))
+        self.FF.make(mvals_list[0])
+        nframes = len(self.xyz_omms)
+        Energies = np.zeros((len(mvals_list), nframes))
+        Dipoles = np.zeros((len(mvals_list), nframes, 3))
+        for I in range(nframes):
+            self.set_positions(I)
+            state = self.simulation.context.getState(getEnergy=True, getPositions=dipole)
+            Energies[0, I] = state.getPotentialEnergy() / kilojoules_per_mole
+            if dipole:
+                positions = state.getPositions()
+                Dipoles[0, I] = get_dipole(self.simulation, q=self.nbcharges, mass=self.AtomLists['Mass'], positions=positions)
+            # Energies of groups of forces before changing the parameters
+            E0groups = {}
+            for s, (terms, restore, groups, charges) in enumerate(sets):
+                if groups == -1:
+                    self.set_terms(terms)
+                    Energies[s+1, I] = self.simulation.context.getState(getEnergy=True).getPotentialEnergy() / kilojoules_per_mole
+                    self.set_terms(restore)
+                elif len(terms) > 0:
+                    if groups not in E0groups:
+                        E0groups[groups] = self.simulation.context.getState(getEnergy=True, groups=groups).getPotentialEnergy() / kilojoules_per_mole
+                    self.set_terms(terms)
+                    E1group = self.simulation.context.getState(getEnergy=True, groups=groups).getPotentialEnergy() / kilojoules_per_mole
+                    self.set_terms(restore)
+                    Energies[s+1, I] = Energies[0, I] - E0groups[groups] + E1group
+                else:
+                    Energies[s+1, I] = Energies[0, I]
+                if dipole:
+                    Dipoles[s+1, I] = get_dipole(self.simulation, q=charges, mass=self.AtomLists['Mass'], positions=positions)
+        if dipole:
+            return [np.hstack((Energies[s].reshape(-1,1), Dipoles[s])) for s in range(len(mvals_list))]
+        return [Energies[s] for s in range(len(mvals_list))]
+
     def build_mass_weighted_hessian(self, shot=0, optimize=True, mass_weighted_hessian_only=True):
         """OpenMM single frame hessian evaluation
         Since OpenMM doesnot provide a Hessian evaluation method, we used finite difference on forces
@@ -1315,6 +1690,107 @@ class OpenMM(Engine):
             mod.addExtraParticles(self.forcefield)
             self.simulation.context.setPositions(ResetVirtualSites_fast(mod.getPositions(), self.vsinfo))
 
+    def linear_parameters(self, mvals, pids):
+
+        """
+        Find the parameters in pids that the energy depends on linearly.
+
+        This is switched on by the linear_deriv option and requires the
+        parameters to be updated in place (see prepare_fast_update).  A
+        parameter is linear if every attribute it changes in the force field
+        file only goes into term parameters in LinearTermParameters, and
+        the attribute values change by the same amount for each unit step
+        in the parameter (this excludes evaluated parameters, the
+        logarithmic map, and other parameters in the same pfields line).
+
+        @param[in] mvals Mathematical parameter values
+        @param[in] pids Indices of the parameters to check
+        @return OrderedDict of parameter index : (terms, restore, groups) for a unit step in the parameter
+        """
+        linear = OrderedDict()
+        if not self.linear_deriv: return linear
+        self.FF.make(mvals)
+        self.update_simulation()
+        fu = getattr(self, 'fast_update', None)
+        if fu is None: return linear
+        system = self.simulation.system
+        # Attributes that only go into term parameters that the energy is linear in.
+        linlocs = np.ones(len(fu['locs']), dtype=bool)
+        for i, terms in fu['map'].items():
+            nm = system.getForce(i).__class__.__name__
+            for slots in terms.values():
+                for s, k in slots:
+                    if s not in LinearTermParameters.get(nm, []):
+                        linlocs[k] = False
+        cache = {}
+        for p in pids:
+            # All of the physical parameters changed by p must be in the OpenMM force field file.
+            pidx = set(self.FF.tmI[:, p].nonzero()[0])
+            if any([self.FF.map.get(pf[0]) in pidx and pf[1] != self.FF.openmmxml for pf in self.FF.pfields]): continue
+            mvals1 = np.array(mvals, dtype=float)
+            mvals1[p] += 1.0
+            self.FF.make(mvals1)
+            vals1 = self.fast_update_values()
+            mvals1[p] += 1.0
+            self.FF.make(mvals1)
+            vals2 = self.fast_update_values()
+            changed = vals1 != fu['vals']
+            if np.any(changed & ~linlocs): continue
+            if not np.allclose(vals2 - vals1, vals1 - fu['vals'], rtol=1e-6, atol=1e-9*(1+np.abs(fu['vals']))): continue
+            terms, _ = self.fast_update_terms(vals1, changed, cache)
+            restore, _ = self.fast_update_terms(fu['vals'], changed, cache)
+            groups = 0
+            for i in terms:
+                groups |= 1 << system.getForce(i).getForceGroup()
+            linear[p] = (terms, restore, groups)
+        self.FF.make(mvals)
+        if len(linear) > 0:
+            logger.debug("Derivatives for %i parameters of %s are computed from force group energies\n" % (len(linear), self.name))
+        return linear
+
+    def linear_derivatives(self, linear, force=False, traj=True):
+
+        """
+        Compute the derivatives of the energies (and optionally forces) with
+        respect to the parameters returned by linear_parameters().
+
+        Because the energy is linear in these parameters, the derivative is
+        the change in energy of the force groups containing the changed terms
+        for a unit step in the parameter.  The energies of the groups are
+        computed once per snapshot for the current parameters.
+
+        @param[in] linear Dictionary returned by linear_parameters()
+        @param[in] force Switch for the derivatives of the forces
+        @param[in] traj Loop over the stored snapshots; otherwise use the current geometry
+        @return OrderedDict of parameter index : derivatives shaped like the output of energy() or energy_force()
+        """
+        Result = OrderedDict([(p, []) for p in linear])
+        if len(linear) == 0: return Result
+        nreal = len(self.realAtomIdxs)
+        def get_state(groups):
+            S = self.simulation.context.getState(getEnergy=True, getForces=force, groups=groups)
+            E = S.getPotentialEnergy() / kilojoules_per_mole
+            if not force: return E
+            F = S.getForces(asNumpy=True).value_in_unit(kilojoule/(nanometer*mole))[self.realAtomIdxs].flatten()
+            return np.hstack(([E], F))
+        for I in (range(len(self.xyz_omms)) if traj else [None]):
+            if I is not None: self.set_positions(I)
+            # Energies of groups of forces for the current parameters
+            S0groups = {}
+            for p, (terms, restore, groups) in linear.items():
+                if len(terms) == 0:
+                    Result[p].append(np.zeros(1+3*nreal) if force else 0.0)
+                    continue
+                if groups not in S0groups:
+                    S0groups[groups] = get_state(groups)
+                self.set_terms(terms)
+                S1 = get_state(groups)
+                self.set_terms(restore)
+                Result[p].append(S1 - S0groups[groups])
+        for p in Result:
+            Result[p] = np.array(Result[p]) if traj else Result[p][0]
+        return Result
+
     def optimize(self, shot, crit=1e-4, disable_vsite=False, align=True, include_restraint_energy=False):
 
         """
@@ -1482,7 +1958,7 @@ class OpenMM(Engine):
 
         return (D - A - B) / 4.184
 
-    def molecular_dynamics(self, nsteps, timestep, temperature=None, pressure=None, nequil=0, nsave=1000, minimize=True, anisotropic=False, save_traj=False, verbose=False, **kwargs):
+    def molecular_dynamics(self, nsteps, timestep, temperature=None, pressure=None, nequil=0, nsave=1000, minimize=True, anisotropic=False, save_traj=False, verbose=False, spill=None, **kwargs):
 
         """
         Method for running a molecular dynamics simulation.
@@ -1495,6 +1971,7 @@ class OpenMM(Engine):
         nequil      = (int)   Number of additional time steps at the beginning for equilibration
         nsave       = (int)   Step interval for saving and printing data
         minimize    = (bool)  Perform an energy minimization prior to dynamics
+        spill       = (str)   File name for keeping the saved coordinates on disk (as a memory-mapped array)
 
         Returns simulation data:
         Rhos        = (array)     Density in kilogram m^-3
@@ -1549,15 +2026,16 @@ class OpenMM(Engine):
 
         # Initialize statistics.
         edecomp = OrderedDict()
+        nframes = isteps + 1
         # Stored coordinates, box vectors
-        self.xyz_omms = []
+        self.xyz_omms = TrajectoryBuffer(self.system.getNumParticles(), nframes, pbc=self.pbc, fnm=spill)
         # Densities, potential and kinetic energies, box volumes, dipole moments
-        Rhos = []
-        Potentials = []
-        Kinetics = []
-        Volumes = []
-        Dips = []
-        Temps = []
+        Rhos = np.zeros(nframes)
+        Potentials = np.zeros(nframes)
+        Kinetics = np.zeros(nframes)
+        Volumes = np.zeros(nframes)
+        Dips = np.zeros((nframes, 3))
+        Temps = np.zeros(nframes)
         #========================#
         # Now run the simulation #
         #========================#
@@ -1617,14 +2095,12 @@ class OpenMM(Engine):
                 box_vectors = None
                 volume = 0.0 * nanometers ** 3
                 density = 0.0 * kilogram / meter ** 3
-            positions = state.getPositions(asNumpy=True).astype(np.float32) * nanometer
-            self.xyz_omms.append([positions, box_vectors])
+            self.xyz_omms.append([state.getPositions(asNumpy=True), box_vectors])
             # Perform energy decomposition.
             for comp, val in energy_components(self.simulation).items():
-                if comp in edecomp:
-                    edecomp[comp].append(val)
-                else:
-                    edecomp[comp] = [val]
+                if comp not in edecomp:
+                    edecomp[comp] = np.zeros(nframes)
+                edecomp[comp][iteration+1] = val
             if self.pbc:
                 if verbose: logger.info("%6d %9.3f %9.3f % 13.3f %10.4f %13.4f\n" % (iteration+1, state.getTime() / picoseconds,
                                                                                      kinetic_temperature / kelvin, potential / kilojoules_per_mole,
@@ -1632,18 +2108,13 @@ class OpenMM(Engine):
             else:
                 if verbose: logger.info("%6d %9.3f %9.3f % 13.3f\n" % (iteration+1, state.getTime() / picoseconds,
                                                                        kinetic_temperature / kelvin, potential / kilojoules_per_mole))
-            Temps.append(kinetic_temperature / kelvin)
-            Rhos.append(density.value_in_unit(kilogram / meter**3))
-            Potentials.append(potential / kilojoules_per_mole)
-            Kinetics.append(kinetic / kilojoules_per_mole)
-            Volumes.append(volume / nanometer**3)
-            Dips.append(get_dipole(self.simulation,positions=self.xyz_omms[-1][0]))
-        Rhos = np.array(Rhos)
-        Potentials = np.array(Potentials)
-        Kinetics = np.array(Kinetics)
-        Volumes = np.array(Volumes)
-        Dips = np.array(Dips)
-        Ecomps = OrderedDict([(key, np.array(val)) for key, val in edecomp.items()])
+            Temps[iteration+1] = kinetic_temperature / kelvin
+            Rhos[iteration+1] = density.value_in_unit(kilogram / meter**3)
+            Potentials[iteration+1] = potential / kilojoules_per_mole
+            Kinetics[iteration+1] = kinetic / kilojoules_per_mole
+            Volumes[iteration+1] = volume / nanometer**3
+            Dips[iteration+1] = get_dipole(self.simulation,positions=self.xyz_omms.xyzs[iteration+1]*nanometer)
+        Ecomps = OrderedDict(list(edecomp.items()))
         Ecomps["Potential Energy"] = Potentials
         Ecomps["Kinetic Energy"] = Kinetics
         Ecomps["Temperature"] = Temps
@@ -88,6 +88,9 @@ gen_opts_types = {
                  "criteria"   : (1, 160, 'The number of convergence criteria that must be met for main optimizer to converge', 'Main Optimizer'),
                  "rpmd_beads"       : (0, -160, 'Number of beads in ring polymer MD (zero to disable)', 'Condensed phase property targets (advanced usage)', 'liquid_openmm'),
                  "zerograd"         : (-1, 0, 'Set to a nonnegative number to turn on zero gradient skipping at that optimization step.', 'All'),
+                 "target_workers"   : (1, -100, 'Number of local processes for evaluating different targets concurrently', 'Objective function (not used together with Work Queue)'),
+                 "local_workers"    : (0, -100, 'Number of jobs to run concurrently with the built-in local job runner in place of Work Queue (zero to disable)', 'Targets that use Work Queue (advanced usage)'),
+                 "local_gpus"       : (0, -100, 'Number of GPUs for the local job runner; each job is given one through CUDA_VISIBLE_DEVICES', 'Targets that use Work Queue (advanced usage)'),
                  },
     'bools'   : {"backup"           : (1,  10,  'Write temp directories to backup before wiping them'),
                  "writechk_step"    : (1, -50,  'Write the checkpoint file at every optimization step'),
@@ -201,11 +204,16 @@ tgt_opts_types = {
                  "n_sim_chain"        : (1, 0, 'Number of simulations required to calculate quantities.', 'Thermodynamic property targets', 'thermo'),
                  "n_molecules"        : (-1, 0, 'Provide the number of molecules in the structure (defaults to auto-detect).', 'Condensed phase properties', 'Liquid'),
                  "hess_normalize_type": (0, -150, 'Specify an hessian target objective function normalization method.', 'Hessian targets', 'Hessian'),
+                 "fd_workers"         : (1, -100, 'Number of local processes for evaluating finite difference parameter displacements in parallel', 'In conjunction with fdgrad, fdhess, fdhessdiag; CPU engines only'),
+                 "jacobian_mem"       : (4096, -100, 'Memory budget in MB for energy and force parameter derivatives; larger arrays are stored on disk', 'Energy + Force Matching', 'AbInitio'),
+                 "eval_cache"         : (0, -100, 'Disk budget in MB for caching objective function evaluations by parameter values (zero to disable); least recently used entries are removed first', 'Targets whose objective function depends only on the parameters (e.g. AbInitio, TorsionProfile, Vibration)'),
                  },
     'bools'   : {"fdgrad"           : (0, -100, 'Finite difference gradient of objective function w/r.t. specified parameters', 'Use together with fd_ptypes (advanced usage)'),
                  "fdhess"           : (0, -100, 'Finite difference Hessian of objective function w/r.t. specified parameters', 'Use together with fd_ptypes (advanced usage)'),
                  "fdhessdiag"       : (0, -100, 'Finite difference Hessian diagonals w/r.t. specified parameters (costs 2np times a objective calculation)', 'Use together with fd_ptypes (advanced usage)'),
                  "all_at_once"      : (1, -50, 'Compute all energies and forces in one fell swoop where possible(as opposed to calling the simulation code once per snapshot)', 'Various QM targets and MD codes', 'AbInitio'),
+                 "read_cache"       : (0, -50, 'Keep memory-mapped binary copies of the coordinates and qdata.txt next to the source files so they are not parsed again', 'Ab initio targets with large data sets', 'AbInitio'),
+                 "linear_deriv"     : (0, -50, 'Compute derivatives with respect to parameters that the energy depends on linearly (e.g. bond, angle and torsion force constants) from force group energies instead of finite differences', 'AbInitio, TorsionProfile and condensed phase targets using OpenMM', 'OpenMM'),
                  "run_internal"     : (1, -50, 'For OpenMM or other codes with Python interface: Compute energies and forces internally', 'OpenMM interface', 'OpenMM'),
                  "energy"           : (1, 0, 'Enable the energy objective function', 'All ab initio targets', 'AbInitio'),
                  "force"            : (1, 0, 'Enable the force objective function', 'All ab initio targets', 'AbInitio'),
@@ -221,6 +229,7 @@ tgt_opts_types = {
                  "hvap_subaverage"  : (0, -150, 'Don\'t target the average enthalpy of vaporization and allow it to freely float (experimental)', 'Condensed phase property targets (advanced usage)', 'liquid'),
                  "force_cuda"       : (0, -150, 'Force the external npt.py script to crash if CUDA Platform not available', 'Condensed phase property targets (advanced usage)', 'liquid_openmm'),
                  "anisotropic_box"  : (0, -150, 'Enable anisotropic box scaling (e.g. for crystals or two-phase simulations) in external npt.py script', 'Condensed phase property targets (advanced usage)', 'liquid_openmm, liquid_tinker'),
+                 "md_spill"         : (0, -150, 'Keep the coordinates saved during condensed phase MD in a memory-mapped file instead of in memory (for very long simulations)', 'Condensed phase property targets (advanced usage)', 'liquid_openmm, lipid_openmm'),
                  "mts_integrator"   : (0, -150, 'Enable multiple-timestep integrator in external npt.py script', 'Condensed phase property targets (advanced usage)', 'liquid_openmm'),
                  "minimize_energy"  : (1, 0, 'Minimize the energy of the system prior to running dynamics', 'Condensed phase property targets (advanced usage)', 'liquid_openmm', 'liquid_tinker'),
                  "remote"           : (0, 50, 'Evaluate target as a remote work_queue task', 'All targets (optional)'),
@@ -170,7 +170,7 @@ class Recharge_SMIRNOFF(Target):
 
             residual_counter += len(self._molecule_residual_ranges[smiles_pattern])
 
-    def _compute_gradient_jacobian(self, mvals, perturbation_amount=1.0e-4):
+    def _compute_gradient_jacobian(self, mvals):
         """Build the matrix which maps the gradient w.r.t. physical parameters to
         a gradient w.r.t mathematical parameters.
 
@@ -178,31 +178,8 @@ class Recharge_SMIRNOFF(Target):
         ----------
         mvals: np.ndarray
             The current force balance mathematical parameters.
-        perturbation_amount: float
-            The amount to perturb the mathematical parameters by
-            when calculating the finite difference gradients.
         """
-
-        jacobian_list = []
-
-        for index in range(len(mvals)):
-
-            reverse_mvals = mvals.copy()
-            reverse_mvals[index] -= perturbation_amount
-            reverse_pvals = np.array(self.FF.make(reverse_mvals))
-
-            forward_mvals = mvals.copy()
-            forward_mvals[index] += perturbation_amount
-            forward_pvals = np.array(self.FF.make(forward_mvals))
-
-            gradients = (forward_pvals - reverse_pvals) / (2.0 * perturbation_amount)
-            jacobian_list.append(gradients)
-
-        # Make sure to restore the FF object back to its original state.
-        self.FF.make(mvals)
-
-        jacobian = np.array(jacobian_list)
-        return jacobian
+        return self.FF.pvals_jacobian(mvals)
 
     def wq_complete(self):
         return True
@@ -257,7 +257,7 @@ class SMIRNOFF(OpenMM):
     """ Derived from Engine object for carrying out OpenMM calculations that use the SMIRNOFF force field. """
 
     def __init__(self, name="openmm", **kwargs):
-        self.valkwd = ['ffxml', 'pdb', 'mol2', 'platname', 'precision', 'mmopts', 'vsite_bonds', 'implicit_solvent', 'restrain_k', 'freeze_atoms']
+        self.valkwd = ['ffxml', 'pdb', 'mol2', 'platname', 'precision', 'mmopts', 'vsite_bonds', 'implicit_solvent', 'restrain_k', 'freeze_atoms', 'linear_deriv']
         if not toolkit_import_success:
             warn_once("Note: Failed to import the OpenFF Toolkit - SMIRNOFF Engine will not work. ")
         super(SMIRNOFF,self).__init__(name=name, **kwargs)
@@ -369,7 +369,9 @@ class SMIRNOFF(OpenMM):
         if hasattr(self, 'abspdb'):
             self.pdb = PDBFile(self.abspdb)
         else:
-            pdb1 = "%s-1.pdb" % os.path.splitext(os.path.basename(self.mol.fnm))[0]
+            # The process ID keeps the file name unique when engines are
+            # created concurrently (e.g. by finite difference worker processes).
+            pdb1 = "%s-%i.pdb" % (os.path.splitext(os.path.basename(self.mol.fnm))[0], os.getpid())
             self.mol[0].write(pdb1)
             self.pdb = PDBFile(pdb1)
             os.unlink(pdb1)
@@ -5,6 +5,8 @@ from builtins import str
 from builtins import range
 import abc
 import os
+import hashlib
+import multiprocessing
 import subprocess
 import shutil
 import numpy as np
@@ -12,13 +14,27 @@ import time
 from collections import OrderedDict
 import tarfile
 import forcebalance
-from forcebalance.nifty import row, col, printcool_dictionary, link_dir_contents, createWorkQueue, getWorkQueue, wq_wait1, getWQIds, wopen, warn_press_key, _exec, lp_load, LinkFile
-from forcebalance.finite_difference import fdwrap_G, fdwrap_H, f1d2p, f12d3p, in_fd
+from forcebalance.nifty import row, col, printcool_dictionary, link_dir_contents, createWorkQueue, getWorkQueue, wq_wait1, getWQIds, wopen, warn_press_key, _exec, lp_dump, lp_load, LinkFile
+from forcebalance.finite_difference import fdwrap, fdwrap_G, fdwrap_H, f1d2p, f12d3p, in_fd, set_fd_worker
 from forcebalance.optimizer import Counter
 from forcebalance.output import getLogger
 from future.utils import with_metaclass
 logger = getLogger(__name__)
 
+## The target whose finite-difference displacements are being farmed out to a process pool.
+## This is set immediately before the pool is forked, so each worker inherits its own copy
+## of the target (including the force field and engine objects).
+_fd_target = None
+
+def _fd_worker(args):
+    """ Apply a finite difference stencil to one parameter inside a worker process. """
+    stencil, key, mvals, pidx, f0, customdir = args
+    # Pool workers are daemonic and cannot start their own pools, so finite differences nested
+    # inside this displacement (e.g. fdgrad within an fdhess row) are evaluated serially.
+    _fd_target.fd_workers = 1
+    func = _fd_target.get_X if key == 'X' else _fd_target.get_G
+    return stencil(fdwrap(func, mvals, pidx, key, customdir=customdir), _fd_target.h, f0 = f0)
+
 class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
 
     """
@@ -118,6 +134,12 @@ class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
         ## Parameter types that trigger FD Hessian elements
         ## Finite difference step size
         self.set_option(options, 'finite_difference_h', 'h')
+        ## Number of local worker processes for finite difference parameter displacements
+        self.set_option(tgt_opts, 'fd_workers')
+        ## Disk budget (MB) for cached objective function evaluations (zero to disable)
+        self.set_option(tgt_opts, 'eval_cache')
+        ## Analytic derivatives for parameters that the energy depends on linearly (if the engine supports it)
+        self.set_option(tgt_opts, 'linear_deriv')
         ## Whether to make backup files
         self.set_option(options, 'backup')
         ## Directory to read data from.
@@ -159,6 +181,10 @@ class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
             self.tempbase    = "temp"
         self.tempdir     = os.path.join(self.tempbase, self.name)
         ## self.tempdir     = os.path.join('temp',self.name)
+        ## Directory of cached objective function evaluations; it is kept when the temp directory is refreshed
+        self.cachedir    = os.path.join(os.path.splitext(self.tempbase)[0]+'.cache', self.name)
+        ## Cached evaluation loaded by stage(), as (cache file, answer); meta_get uses it instead of looking up the file again
+        self.staged_answer = None
         ## The directory in which the simulation is running - this can be updated.
         self.rundir      = self.tempdir
         ## Need the forcefield (here for now)
@@ -293,12 +319,13 @@ class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
 
         """
         Ans = self.meta_get(mvals,1,0,customdir=customdir)
-        for i in self.pgrad:
-            if any([j in self.FF.plist[i] for j in self.fd1_pids]) or 'ALL' in self.fd1_pids:
-                if self.fdhessdiag:
-                    Ans['G'][i], Ans['H'][i,i] = f12d3p(fdwrap_G(self,mvals,i),self.h,f0 = Ans['X'])
-                elif self.fdgrad:
-                    Ans['G'][i] = f1d2p(fdwrap_G(self,mvals,i),self.h,f0 = Ans['X'])
+        pids = [i for i in self.pgrad if any([j in self.FF.plist[i] for j in self.fd1_pids]) or 'ALL' in self.fd1_pids]
+        if self.fdhessdiag:
+            for i, (Gi, Hii) in zip(pids, self.fd_map(f12d3p, 'X', mvals, pids, Ans['X'], customdir)):
+                Ans['G'][i], Ans['H'][i,i] = Gi, Hii
+        elif self.fdgrad:
+            for i, Gi in zip(pids, self.fd_map(f1d2p, 'X', mvals, pids, Ans['X'], customdir)):
+                Ans['G'][i] = Gi
         self.gct += 1
         if Counter() == self.zerograd and self.zerograd >= 0:
             self.write_0grads(Ans)
@@ -317,24 +344,65 @@ class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
         throughout for the sake of speed.
         """
         Ans = self.meta_get(mvals,1,1,customdir=customdir)
+        pids1 = [i for i in self.pgrad if any([j in self.FF.plist[i] for j in self.fd1_pids]) or 'ALL' in self.fd1_pids]
+        pids2 = [i for i in self.pgrad if any([j in self.FF.plist[i] for j in self.fd2_pids]) or 'ALL' in self.fd2_pids]
         if self.fdhess:
-            for i in self.pgrad:
-                if any([j in self.FF.plist[i] for j in self.fd1_pids]) or 'ALL' in self.fd1_pids:
-                    Ans['G'][i] = f1d2p(fdwrap_G(self,mvals,i),self.h,f0 = Ans['X'])
-            for i in self.pgrad:
-                if any([j in self.FF.plist[i] for j in self.fd2_pids]) or 'ALL' in self.fd2_pids:
-                    FDSlice = f1d2p(fdwrap_H(self,mvals,i),self.h,f0 = Ans['G'])
-                    Ans['H'][i,:] = FDSlice
-                    Ans['H'][:,i] = FDSlice
+            for i, Gi in zip(pids1, self.fd_map(f1d2p, 'X', mvals, pids1, Ans['X'], customdir)):
+                Ans['G'][i] = Gi
+            # The Hessian rows are differentiated around the completed gradient.
+            for i, FDSlice in zip(pids2, self.fd_map(f1d2p, 'G', mvals, pids2, Ans['G'], customdir)):
+                Ans['H'][i,:] = FDSlice
+                Ans['H'][:,i] = FDSlice
         elif self.fdhessdiag:
-            for i in self.pgrad:
-                if any([j in self.FF.plist[i] for j in self.fd2_pids]) or 'ALL' in self.fd2_pids:
-                    Ans['G'][i], Ans['H'][i,i] = f12d3p(fdwrap_G(self,mvals,i),self.h, f0 = Ans['X'])
+            for i, (Gi, Hii) in zip(pids2, self.fd_map(f12d3p, 'X', mvals, pids2, Ans['X'], customdir)):
+                Ans['G'][i], Ans['H'][i,i] = Gi, Hii
         if Counter() == self.zerograd and self.zerograd >= 0:
             self.write_0grads(Ans)
         self.hct += 1
         return Ans
 
+    def fd_map(self, stencil, key, mvals, pids, f0, customdir=None):
+        """
+        Apply a finite difference stencil to each parameter index in pids
+        and return the list of results in the same order.
+
+        If fd_workers is greater than one, the displacements for different
+        parameters are evaluated concurrently in a pool of forked worker
+        processes.  Each worker owns its own copy of the force field and
+        engine, and runs in its own subdirectory (fd_XXXX) of the current
+        run directory so that the force field files written by FF.make
+        don't collide.  Engines evaluate serially inside the workers
+        (see in_fd_worker), so at most fd_workers processes run at once.  Note that engines holding GPU contexts generally
+        do not survive a fork; this mode is intended for CPU platforms and
+        for engines that call external programs.
+
+        @param[in] stencil Finite difference stencil, i.e. f1d2p or f12d3p
+        @param[in] key Either 'X' (differentiate get_X) or 'G' (differentiate get_G)
+        @param[in] mvals Mathematical parameter values at the center of the stencil
+        @param[in] pids List of parameter indices to differentiate
+        @param[in] f0 Center value that is passed to the stencil
+        @param[in] customdir Custom directory that the derivative is evaluated under
+        """
+        if self.fd_workers <= 1 or len(pids) <= 1:
+            # customdir is passed on so that nested calls inside a pool worker stay in its own directory.
+            func = self.get_X if key == 'X' else self.get_G
+            return [stencil(fdwrap(func, mvals, i, key, customdir=customdir), self.h, f0 = f0) for i in pids]
+        global _fd_target
+        args = [(stencil, key, list(mvals), i, f0, os.path.join(customdir, 'fd_%04i' % i) if customdir is not None else 'fd_%04i' % i) for i in pids]
+        _fd_target = self
+        try:
+            pool = multiprocessing.get_context('fork').Pool(min(self.fd_workers, len(pids)), initializer=set_fd_worker)
+            try:
+                result = pool.map(_fd_worker, args, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _fd_target = None
+            # The workers printed force fields that this process's make() doesn't know about.
+            self.FF.forget_written()
+        return result
+
     def link_from_tempdir(self,absdestdir):
         link_dir_contents(os.path.join(self.root,self.tempdir), absdestdir)
 
@@ -580,8 +648,17 @@ class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
             Answer = self.read(mvals, AGrad, AHess)
             os.chdir(absgetdir)
         else:
-            ## Evaluate the objective function.
-            Answer = self.get(mvals, AGrad, AHess)
+            ## Use the answer that stage() loaded from the evaluation cache, or look it up now;
+            ## otherwise evaluate the objective function.
+            fcache = self.cache_path(mvals, AGrad, AHess)
+            if self.staged_answer is not None and self.staged_answer[0] == fcache:
+                Answer = self.staged_answer[1]
+            else:
+                Answer = self.cache_load(mvals, AGrad, AHess)
+            self.staged_answer = None
+            if Answer is None:
+                Answer = self.get(mvals, AGrad, AHess)
+                self.cache_save(Answer, mvals, AGrad, AHess)
             if self.write_objective:
                 forcebalance.nifty.lp_dump(Answer, 'objective.p')
 
@@ -595,6 +672,69 @@ class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
 
         return Answer
 
+    def cache_path(self, mvals, AGrad=False, AHess=False):
+        """
+        Return the file in the evaluation cache for this target at the given
+        parameter values and derivative order, or None if the cache is disabled.
+
+        The file name is a hash of the parameter values (mathematical and
+        physical), the derivative order, the target options, the contents of
+        the force field files and the file names, sizes and modification
+        times in the target directory.
+        """
+        if self.eval_cache <= 0: return None
+        if not hasattr(self, 'cache_hash'):
+            # The parts of the key that don't change during the run.
+            h = hashlib.sha1()
+            h.update(("%s %s %s" % (self.name, self.type, self.FF.use_pvals)).encode('utf-8'))
+            for fnm in self.FF.fnms:
+                with open(os.path.join(self.root, self.FF.ffdir, fnm), 'rb') as f: h.update(f.read())
+            for dirpath, dirnames, filenames in sorted(os.walk(os.path.join(self.root, self.tgtdir))):
+                for fnm in sorted(filenames):
+                    fstat = os.stat(os.path.join(dirpath, fnm))
+                    h.update(("%s %i %i" % (os.path.join(dirpath, fnm), fstat.st_size, fstat.st_mtime_ns)).encode('utf-8'))
+            self.cache_hash = h
+        h = self.cache_hash.copy()
+        h.update(("%i %i %s" % (AGrad, AHess, sorted(self.OptionDict.items()))).encode('utf-8'))
+        mvals = np.array(mvals, dtype=float)
+        h.update(mvals.tobytes())
+        if not self.FF.use_pvals:
+            h.update(np.array(self.FF.create_pvals(mvals), dtype=float).tobytes())
+        return os.path.join(self.root, self.cachedir, h.hexdigest() + '.p')
+
+    def cache_load(self, mvals, AGrad=False, AHess=False):
+        """ Return the cached objective function evaluation at these parameter values, or None if there isn't one. """
+        fnm = self.cache_path(mvals, AGrad, AHess)
+        if fnm is None or not os.path.exists(fnm): return None
+        try:
+            Answer = lp_load(fnm)
+        except Exception:
+            logger.warning("Failed to read cached evaluation %s, recomputing\n" % fnm)
+            return None
+        # Mark as recently used.
+        os.utime(fnm, None)
+        logger.debug("Loaded cached objective function for %s from %s\n" % (self.name, fnm))
+        return Answer
+
+    def cache_save(self, Answer, mvals, AGrad=False, AHess=False):
+        """ Save an objective function evaluation to the cache, removing the least recently used entries to keep within the disk budget. """
+        fnm = self.cache_path(mvals, AGrad, AHess)
+        if fnm is None: return
+        absdir = os.path.dirname(fnm)
+        if not os.path.exists(absdir):
+            os.makedirs(absdir)
+        # Write to a temporary file first so that concurrent readers never see a partial file.
+        tmp = "%s.%i" % (fnm, os.getpid())
+        lp_dump(Answer, tmp)
+        os.replace(tmp, fnm)
+        entries = [os.path.join(absdir, f) for f in os.listdir(absdir) if f.endswith('.p')]
+        entries = sorted([(os.stat(f).st_mtime, os.stat(f).st_size, f) for f in entries])
+        total = sum([e[1] for e in entries])
+        while total > self.eval_cache*1024**2 and len(entries) > 1:
+            mtime, size, f = entries.pop(0)
+            os.remove(f)
+            total -= size
+
     def submit_jobs(self, mvals, AGrad=False, AHess=False):
         return
 
@@ -632,8 +772,13 @@ class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
         if Counter() >= self.zerograd and self.zerograd >= 0:
             self.read_0grads()
         self.rundir = absgetdir.replace(self.root+'/','')
-        ## Submit jobs to the Work Queue.
-        if self.rd is None or (not firstIteration):
+        ## Submit jobs to the Work Queue, unless the answer is in the evaluation cache; it is loaded
+        ## now and kept for meta_get, so that jobs are not skipped if the file is removed in between.
+        Answer = self.cache_load(mvals, AGrad, AHess)
+        self.staged_answer = (self.cache_path(mvals, AGrad, AHess), Answer) if Answer is not None else None
+        if Answer is not None:
+            pass
+        elif self.rd is None or (not firstIteration):
             self.submit_jobs(mvals, AGrad, AHess)
         elif customdir is not None:
             # Allows us to submit micro-iteration jobs for remote targets
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 import json
+import shutil
 from forcebalance.nifty import *
 from forcebalance.amberio import splitComment, parse_amber_namelist
 
@@ -86,3 +87,75 @@ class TestSplitComment(object):
 
 # if __name__ == '__main__':
 #     unittest.main()
+
+def test_prmtop_patcher():
+    """ Test updating the parameters in a prmtop file without tleap """
+    import tempfile
+    import forcebalance
+    from forcebalance.amberio import PrmtopLoader, PrmtopPatcher
+    datadir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'files', 'amber_water')
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(tmpdir, 'forcefield'))
+        for fnm in ['sol.frcmod', 'sol.mol2']:
+            shutil.copy(os.path.join(datadir, fnm), os.path.join(tmpdir, 'forcefield'))
+        os.chdir(tmpdir)
+        options = forcebalance.parser.gen_opts_defaults.copy()
+        options.update({'root': tmpdir, 'forcefield': ['sol.frcmod', 'sol.mol2']})
+        ff = forcebalance.forcefield.FF(options)
+        ff.make(np.zeros(ff.np))
+        prmtop = PrmtopLoader(os.path.join(datadir, 'water.prmtop'))
+        patcher = PrmtopPatcher(prmtop, ff)
+        prmtop.write('water.prmtop')
+        print(">ASSERT prmtop is unchanged when written out and read back\n")
+        assert patcher.compare(prmtop, PrmtopLoader('water.prmtop'))
+        pvals = ff.make(np.full(ff.np, 0.1))
+        new = patcher.patch(patcher.read_values())
+        new.write('new.prmtop')
+        new = PrmtopLoader('new.prmtop')
+        assert not patcher.compare(prmtop, new)
+        def prm(pid): return pvals[ff.map[pid]]
+        def data(flag): return np.array(new._raw_data[flag], dtype=float)
+        print(">ASSERT prmtop parameters match the new force field parameters\n")
+        np.testing.assert_allclose(data('BOND_FORCE_CONSTANT'), [prm('BONDSK/OW-HW')], rtol=1e-7)
+        np.testing.assert_allclose(data('ANGLE_EQUIL_VALUE'), [prm('ANGLESB/HW-OW-HW')*np.pi/180], rtol=1e-7)
+        np.testing.assert_allclose(data('CHARGE'), np.array([prm('COUL:SOL-1')] + [prm('COUL:SOL-2')]*2)*18.2223, rtol=1e-7)
+        rmin, eps = 2*prm('VDWS/OW'), prm('VDWT/OW')
+        np.testing.assert_allclose(data('LENNARD_JONES_ACOEF'), [eps*rmin**12, 0, 0], rtol=1e-7)
+        np.testing.assert_allclose(data('LENNARD_JONES_BCOEF'), [2*eps*rmin**6, 0, 0], rtol=1e-7)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+def test_amber_trajectory():
+    """ Test reading a trajectory in blocks of frames for the AMBER engine """
+    import tempfile
+    from forcebalance.amberio import AmberTrajectory
+    from forcebalance.molecule import Molecule, BuildLatticeFromLengthsAngles
+    M = Molecule(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'files', 'amber_alaglu', 'all.gro'))
+    # Give each frame a different box so that boxes attached to the wrong frame are detected
+    M.boxes = [BuildLatticeFromLengthsAngles(30.0+i, 31.0+i, 32.0+i, 90.0, 90.0, 90.0) for i in range(len(M))]
+    boxes = np.array([[30.0+i, 31.0+i, 32.0+i, 90.0, 90.0, 90.0] for i in range(len(M))])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fnm = os.path.join(tmpdir, 'all.mdcrd')
+        M.write(fnm, ftype='mdcrd')
+        # Limit the blocks to a few frames each
+        traj = AmberTrajectory(fnm, M.na, mem=5*24*M.na/1024.0**2)
+        assert traj.blocksize == 5
+        print(">ASSERT frames read in blocks match the trajectory\n")
+        xyzs, tboxes = zip(*traj.frames())
+        np.testing.assert_allclose(np.array(xyzs), np.array(M.xyzs), atol=1e-3)
+        print(">ASSERT each frame is read with its own box\n")
+        np.testing.assert_allclose(np.array(tboxes), boxes, atol=1e-3)
+        snapshots = [1, 7, 8, len(M)-1]
+        xyzs, tboxes = zip(*traj.frames(snapshots))
+        np.testing.assert_allclose(np.array(xyzs), np.array(M.xyzs)[snapshots], atol=1e-3)
+        np.testing.assert_allclose(np.array(tboxes), boxes[snapshots], atol=1e-3)
+        print(">ASSERT reading can be stopped early\n")
+        for i, (xyz, box) in enumerate(traj.frames()):
+            if i == 6: break
+        np.testing.assert_allclose(xyz, M.xyzs[6], atol=1e-3)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -4,6 +4,7 @@ from .__init__ import ForceBalanceTestCase
 import numpy
 import forcebalance
 import re, sys
+import multiprocessing
 from math import cos, sin, pi
 import pytest
 
@@ -59,3 +60,15 @@ class TestFiniteDifference(ForceBalanceTestCase):
                             assert abs(result[1]-func[2](input,p)) < 1e-3
                         else:
                             assert abs(result-func[1](input,p)) < 1e-3
+
+    def test_in_fd_worker(self):
+        """Check that only the processes of the finite difference process pool are marked as workers"""
+        fd = forcebalance.finite_difference
+        assert not fd.in_fd_worker()
+        pool = multiprocessing.get_context('fork').Pool(2, initializer=fd.set_fd_worker)
+        try:
+            assert pool.apply(fd.in_fd_worker)
+        finally:
+            pool.close()
+            pool.join()
+        assert not fd.in_fd_worker()
@@ -3,6 +3,8 @@ from builtins import str
 from builtins import object
 import os
 import shutil
+import time
+from copy import deepcopy
 import forcebalance
 import forcebalance.forcefield as forcefield
 from .__init__ import ForceBalanceTestCase
@@ -68,6 +70,83 @@ class FFTests(object):
         os.remove(self.options['ffdir']+'/test_ones.' + self.filetype)
 
 
+    def test_make_incremental(self):
+        """Check that make() only rewrites what changed and matches a full rewrite"""
+        fnm = self.ff.fnms[0]
+        self.ff.make(np.zeros(self.ff.np))
+        mtime = os.stat(fnm).st_mtime_ns
+        self.ff.make(np.zeros(self.ff.np))
+        assert os.stat(fnm).st_mtime_ns == mtime, "make() rewrote a force field file that did not change"
+        # Another process rewrites the file with the same size and timestamp, as forked workers may do.
+        with open(fnm) as f: original = f.read()
+        with open(fnm, 'w') as f: f.write(original[::-1])
+        os.utime(fnm, ns=(mtime, mtime))
+        self.ff.forget_written()
+        self.ff.make(np.zeros(self.ff.np))
+        with open(fnm) as f: assert f.read() == original, "make() did not rewrite a force field file after forget_written()"
+
+        mvals = np.zeros(self.ff.np)
+        mvals[-1] = 0.5
+        self.ff.make(mvals)
+        with open(fnm) as f: incremental = f.read()
+        self.ff.make_cache = None
+        self.ff.make(mvals)
+        with open(fnm) as f: full = f.read()
+        assert incremental == full, "make() gave a different file when only one parameter changed"
+        os.remove(fnm)
+
+    def test_pvals_jacobian(self):
+        """Check the analytic d(pvals)/d(mvals) against finite differences of create_pvals()"""
+        mvals = np.linspace(-0.1, 0.1, self.ff.np)
+        h = 1e-6
+        for logarithmic_map in [False, True]:
+            self.ff.logarithmic_map = logarithmic_map
+            J = self.ff.pvals_jacobian(mvals)
+            J_fd = np.zeros((self.ff.np, self.ff.np))
+            for i in range(self.ff.np):
+                mvals1 = mvals.copy()
+                mvals1[i] += h
+                mvals2 = mvals.copy()
+                mvals2[i] -= h
+                J_fd[i] = (self.ff.create_pvals(mvals1) - self.ff.create_pvals(mvals2)) / (2*h)
+            np.testing.assert_allclose(J, J_fd, rtol=1e-6, atol=1e-8*np.max(np.abs(J_fd)))
+        self.ff.logarithmic_map = False
+
+    def test_create_mvals(self):
+        """Check that create_mvals() with the sparse transformation matrix matches the dense pseudo-inverse"""
+        from forcebalance.nifty import invert_svd
+        mvals = np.linspace(-0.5, 0.5, self.ff.np)
+        pvals = self.ff.create_pvals(mvals.copy())
+        mvals_ref = np.dot(invert_svd(self.ff.tmI.toarray()), pvals - self.ff.pvals0)
+        np.testing.assert_allclose(self.ff.create_mvals(pvals), mvals_ref, atol=1e-10)
+
+    def test_make_txt_plans(self):
+        """Check that make() with compiled substitution plans writes the same text force field files"""
+        if all(self.ff.ffdata_isxml.values()): return
+        assert len(self.ff.txt_plans) > 0, "No substitution plans were compiled for the text force field"
+        np.random.seed(0)
+        for precision in [12, 6]:
+            mvals = np.random.randn(self.ff.np)
+            self.ff.make(mvals, printdir='make_fast', precision=precision)
+            txt_plans = self.ff.txt_plans
+            self.ff.txt_plans = {}
+            self.ff.make_cache = None
+            self.ff.make(mvals, printdir='make_slow', precision=precision)
+            self.ff.txt_plans = txt_plans
+            self.ff.make_cache = None
+            for fnm in os.listdir('make_fast'):
+                with open(os.path.join('make_fast', fnm)) as f1, open(os.path.join('make_slow', fnm)) as f2:
+                    assert f1.read() == f2.read(), "Substitution plans gave a different %s" % fnm
+        shutil.rmtree('make_fast')
+        shutil.rmtree('make_slow')
+        # Values of different signs and magnitudes, including ones that are wider than the original fields.
+        for (fnm, ln), plan in self.ff.txt_plans.items():
+            line = self.ff.ffdata[fnm][ln]
+            for val, precision in [(1.0, 12), (-123.456, 12), (2.5e-120, 12), (0.5, 4), (-0.0004, 4), (-1234567.8, 4)]:
+                vals = [val*(-1)**k for k in range(len(plan.flds))]
+                assert plan.substitute(vals, precision) == self.ff.substitute_txt_line(fnm, line, plan.flds, vals, precision), \
+                    "Substitution plan for line %i of %s does not match substitute_txt_line" % (ln, fnm)
+
 class TestWaterFF(ForceBalanceTestCase, FFTests):
     """Test FF class using water options and forcefield (text forcefield input)
     This test case also acts as a base class for other forcefield test cases.
@@ -91,6 +170,32 @@ class TestWaterFF(ForceBalanceTestCase, FFTests):
         self.filetype = self.options['forcefield'][0][-3:]
         self.logger.debug("ok\n")
 
+    def test_create_pvals_throughput(self):
+        """Micro-benchmark of create_pvals() for a large parameter set, checked against the sign guard"""
+        ff = deepcopy(self.ff)
+        ff.np = 2000
+        ff.plist = ['%s/%i' % (['NonbondedForce/Atom/epsilon', 'HarmonicBondForce/Bond/k', 'AmoebaMultipoleForce/Multipole/polarizability'][i % 3], i)
+                    for i in range(ff.np)]
+        ff.pvals0 = np.linspace(0.5, 1.5, ff.np)
+        ff.tmI = np.eye(ff.np)
+        ff.sign_guard = ff.make_sign_guard()
+        mvals = np.zeros(ff.np)
+        mvals[::2] = -2.0
+        pvals = ff.create_pvals(mvals)
+        # Parameters that changed sign are zeroed, except for the bond force constants.
+        pvals_ref = ff.pvals0 + mvals
+        for i in range(ff.np):
+            if i % 3 != 1 and pvals_ref[i] < 0:
+                pvals_ref[i] = 0.0
+        np.testing.assert_array_equal(pvals, pvals_ref)
+        ncalls = 200
+        t0 = time.time()
+        for i in range(ncalls):
+            ff.create_pvals(mvals)
+        dt = (time.time() - t0) / ncalls
+        self.logger.info("create_pvals for %i parameters: %.3f ms per call\n" % (ff.np, dt*1000))
+        assert dt < 0.05, "create_pvals took %.3f ms per call for %i parameters" % (dt*1000, ff.np)
+
 class TestXmlFF(ForceBalanceTestCase, FFTests):
     """Test FF class using dms.xml forcefield input"""
     def setup_method(self, method):
@@ -1,12 +1,18 @@
 from __future__ import absolute_import
 import forcebalance
+import os
 import shutil
-from .test_target import TargetTests # general targets tests defined in test_target.py
+import numpy as np
+import pytest
+from forcebalance.nifty import which
+from .test_target import TargetTests, check_all_at_once # general targets tests defined in test_target.py
 """
 The testing functions for this class are located in test_target.py.
 """
 class TestAbInitio_GMX(TargetTests):
     def setup_method(self, method):
+        if which('gmx') == '' and which('mdrun') == '':
+            pytest.skip("GROMACS programs are not in the PATH.")
         super(TestAbInitio_GMX, self).setup_method(method)
         self.options.update({
                 'penalty_additive': 0.01,
@@ -25,7 +31,49 @@ class TestAbInitio_GMX(TargetTests):
         self.logger.debug("Setting up AbInitio_GMX target\n")
         self.target = forcebalance.gmxio.AbInitio_GMX(self.options, self.tgt_opt, self.ff)
 
+    def test_all_at_once(self):
+        """Check that evaluating all snapshots at once matches the per-snapshot evaluation"""
+        os.chdir(os.path.join('temp', self.tgt_opt['name']))
+        check_all_at_once(self.target, self.mvals)
+        os.chdir('../..')
+
+    def test_energy_force_multi(self):
+        """Check that evaluating several parameter sets at once matches evaluating them one at a time"""
+        os.chdir(os.path.join('temp', self.tgt_opt['name']))
+        engine = self.target.engine
+        mvals_list = [list(self.mvals)]
+        for k in range(self.ff.np):
+            for d in [-1, 1]:
+                mvals_ = list(self.mvals)
+                mvals_[k] += d*self.target.h
+                mvals_list.append(mvals_)
+        # With MPI, mdrun -multidir runs two parameter sets at a time.
+        engine.workers = 2
+        Ms = engine.energy_force_multi(mvals_list)
+        print(">ASSERT per-displacement directories are removed\n")
+        assert not os.path.exists("%s-multi" % engine.name)
+        print(">ASSERT energies and forces match energy_force for each set of parameters\n")
+        for mvals, M in zip(mvals_list, Ms):
+            self.ff.make(mvals)
+            np.testing.assert_allclose(M, engine.energy_force(), rtol=1e-6, atol=1e-6)
+        os.chdir('../..')
+
     def teardown_method(self):
         shutil.rmtree('temp')
         super(TestAbInitio_GMX, self).teardown_method()
 
+def test_read_edr_trr():
+    """Check that .edr and .trr files are read without the GROMACS tools"""
+    from forcebalance.gmxio import read_edr, read_trr
+    from forcebalance.molecule import Molecule
+    datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'studies', '009_voelz_nspe', 'analysis')
+    if not os.path.exists(os.path.join(datadir, 'ener.edr')): pytest.skip("Example GROMACS output files not found.")
+    names, energies = read_edr(os.path.join(datadir, 'ener.edr'))
+    # energy.xvg was written by g_energy from ener.edr
+    xvg = np.loadtxt([line for line in open(os.path.join(datadir, 'energy.xvg')) if line[0] not in '#@'])
+    print(">ASSERT potential energies match the g_energy output\n")
+    np.testing.assert_allclose(energies[:, names.index('Potential')], xvg[:, 1], atol=1e-5)
+    trr = read_trr(os.path.join(datadir, 'traj.trr'))
+    M = Molecule(os.path.join(datadir, 'all.gro'))
+    print(">ASSERT coordinates match the .gro trajectory\n")
+    np.testing.assert_allclose(trr['x'], np.array(M.xyzs) / 10, atol=1e-6)
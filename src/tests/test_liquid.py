@@ -3,10 +3,12 @@ import os
 import sys
 import shutil
 import pytest
+import numpy as np
 from forcebalance.parser import parse_inputs
 from forcebalance.forcefield import FF
 from forcebalance.objective import Objective
 from forcebalance.optimizer import Optimizer
+from forcebalance.liquid import fill_weights, reweight_products
 from .__init__ import ForceBalanceTestCase, check_for_openmm
 
 class TestWaterTutorial(ForceBalanceTestCase):
@@ -60,3 +62,26 @@ class TestWaterTutorial(ForceBalanceTestCase):
         liquid_obj_value = optimizer.Objective.ObjDict['Liquid']['x']
         assert liquid_obj_value < 20, "Liquid objective function should give < 20 (about 17.23) total value."
 
+
+def test_reweight_products():
+    """Check that batched reweighting matches weighted averages computed one phase point at a time"""
+    np.random.seed(0)
+    shots = 50
+    points = ['A', 'B', 'C', 'D']
+    mbar_points = ['A', 'C', 'D']
+    W1 = np.random.rand(len(mbar_points)*shots, len(mbar_points))
+    W1 /= np.sum(W1, axis=0)
+    W2 = fill_weights(W1, points, mbar_points, shots)
+    X = np.random.randn(len(points)*shots, 3)
+    G = np.random.randn(5, len(points)*shots)
+    W = W2.toarray()
+    print(">ASSERT phase points without MBAR are weighted equally over their own trajectory\n")
+    np.testing.assert_allclose(W[shots:2*shots, 1], 1.0/shots)
+    assert np.count_nonzero(W[:, 1]) == shots
+    # A small memory limit forces the snapshots to be processed in several blocks.
+    Avg, Prod = reweight_products(W2, X, G, mem=0.002)
+    print(">ASSERT reweighted averages and derivative products match the per-point results\n")
+    for i in range(len(points)):
+        np.testing.assert_allclose(Avg[i], np.dot(W[:, i], X))
+        for q in range(X.shape[1]):
+            np.testing.assert_allclose(Prod[:, i, q], np.dot(G, W[:, i]*X[:, q]))
@@ -1,4 +1,5 @@
 from __future__ import absolute_import
+from __future__ import print_function
 from builtins import str
 import pytest
 import os
@@ -23,7 +24,7 @@ class TestPDBMolecule(ForceBalanceTestCase):
             self.fail("\nUnable to open pdb file")
 
     def teardown_method(self):
-        os.system('rm -rf {name}.xyz {name}.gro {name}.arc'.format(name=self.source[:-4]))
+        os.system('rm -rf {name}.xyz {name}.gro {name}.arc .{name}.gro.npcache {name}-lazy.gro'.format(name=self.source[:-4]))
         super(TestPDBMolecule, self).teardown_method()
 
     def test_xyz_conversion(self):
@@ -89,6 +90,67 @@ class TestPDBMolecule(ForceBalanceTestCase):
         np.testing.assert_allclose(self.molecule.Data['xyzs'][0],  molecule1.Data['xyzs'][0], rtol=0, atol=0.001,
                                    err_msg=msg)
 
+    def test_binary_cache(self):
+        """Check that reading a gro file through the binary cache gives the same data"""
+        fnm = self.source[:-3] + 'gro'
+        self.molecule.write(fnm)
+        molecule1 = forcebalance.molecule.Molecule(fnm, build_topology=False, cache=True)
+        assert os.path.exists(os.path.join('.%s.npcache' % fnm, 'meta.pkl'))
+        molecule2 = forcebalance.molecule.Molecule(fnm, build_topology=False, cache=True)
+        self.logger.debug("Checking that the cached molecule matches the parsed one\n")
+        assert molecule1.Data['atomname'] == molecule2.Data['atomname']
+        np.testing.assert_array_equal(molecule1.Data['xyzs'][0], molecule2.Data['xyzs'][0])
+        np.testing.assert_array_equal(molecule1.Data['boxes'][0].A, molecule2.Data['boxes'][0].A)
+        assert molecule1.Data['boxes'][0].V == molecule2.Data['boxes'][0].V
+
+    def test_lazy_frames(self):
+        """Check that frames loaded lazily from a gro file match the ones read at once"""
+        fnm = self.source[:-3] + 'gro'
+        self.molecule.xyzs = [self.molecule.xyzs[0] + 0.1*i for i in range(4)]
+        self.molecule.comms = ['Frame %i' % i for i in range(4)]
+        self.molecule.write(fnm)
+        molecule1 = forcebalance.molecule.Molecule(fnm, build_topology=False)
+        molecule2 = forcebalance.molecule.Molecule(fnm, build_topology=False, lazy=True)
+        assert isinstance(molecule2.Data['xyzs'], forcebalance.molecule.LazyFrames)
+        assert len(molecule2) == 4
+        assert molecule1.Data['comms'] == molecule2.Data['comms']
+        for xyz1, xyz2 in zip(molecule1.xyzs, molecule2.xyzs):
+            np.testing.assert_array_equal(xyz1, xyz2)
+        self.logger.debug("Checking that writing lazily loaded frames does not keep them in memory\n")
+        molecule2.write(self.source[:-4] + '-lazy.gro')
+        assert all([isinstance(i, tuple) for i in molecule2.Data['xyzs'].items])
+        for xyz1, xyz2 in zip(molecule1.xyzs, forcebalance.molecule.Molecule(self.source[:-4] + '-lazy.gro', build_topology=False).xyzs):
+            np.testing.assert_array_equal(xyz1, xyz2)
+        self.logger.debug("Checking slicing and copying of lazily loaded frames\n")
+        molecule3 = molecule2[1:3]
+        assert isinstance(molecule3.Data['xyzs'], forcebalance.molecule.LazyFrames)
+        np.testing.assert_array_equal(molecule3.xyzs[1], molecule1.xyzs[2])
+        with pytest.raises(ValueError):
+            molecule3.xyzs[0] += 1.0
+        molecule3.xyzs[0] = molecule3.xyzs[0] + 1.0
+        np.testing.assert_array_equal(molecule3.xyzs[0], molecule1.xyzs[1] + 1.0)
+        np.testing.assert_array_equal(molecule2.xyzs[1], molecule1.xyzs[1])
+
+    def test_lazy_align(self):
+        """Check that aligning lazily loaded frames gives the same result as aligning frames read at once"""
+        fnm = self.source[:-3] + 'gro'
+        np.random.seed(0)
+        self.molecule.xyzs = [self.molecule.xyzs[0] + np.random.randn(self.molecule.na, 3) + i for i in range(4)]
+        self.molecule.comms = ['Frame %i' % i for i in range(4)]
+        self.molecule.write(fnm)
+        molecule1 = forcebalance.molecule.Molecule(fnm, build_topology=False)
+        molecule2 = forcebalance.molecule.Molecule(fnm, build_topology=False, lazy=True)
+        molecule1.align()
+        molecule2.align()
+        self.logger.debug("Checking that aligned frames are the same\n")
+        for xyz1, xyz2 in zip(molecule1.xyzs, molecule2.xyzs):
+            np.testing.assert_allclose(xyz1, xyz2, atol=1e-12)
+        self.logger.debug("Checking that in-place changes to frames read by iteration raise an error\n")
+        molecule3 = forcebalance.molecule.Molecule(fnm, build_topology=False, lazy=True)
+        with pytest.raises(ValueError):
+            for xyz in molecule3.xyzs:
+                xyz += 1.0
+
 
     def test_arc_conversion(self):
         """Check molecule conversion from pdb to arc format"""
@@ -218,3 +280,54 @@ class TestGalbPNPMol2(ForceBalanceTestCase):
                                       'O', 'C', 'H', 'C', 'H', 'H', 'O', 'H', 'C', 'H', 'O', 'H', 'C', 'H', 'O', 'H',
                                       'C', 'H', 'O', 'H'], "Incorrect atomic symbols"
         assert len(self.molecule.bonds) == 37, "Incorrect number of bonds for pNP-0LB structure"
+
+def read_qdata_reference(fnm):
+    """ Line-by-line qdata.txt parser that read_qdata replaced, used as the reference. """
+    Answer = {}
+    keys = [('COORDS', 'xyzs'), ('FORCES', 'qm_grads'), ('GRADIENT', 'qm_grads'), ('ESPXYZ', 'qm_espxyzs'), ('ESPVAL', 'qm_espvals'),
+            ('ENERGY', 'qm_energies'), ('INTERACTION', 'qm_interaction')]
+    for line in open(fnm):
+        for word, key in keys:
+            if word in line:
+                if key in ['qm_energies', 'qm_interaction']:
+                    Answer.setdefault(key, []).append(float(line.split()[1]))
+                elif key == 'qm_espvals':
+                    Answer.setdefault(key, []).append(np.array([float(i) for i in line.split()[1:]]))
+                else:
+                    Answer.setdefault(key, []).append(np.array([float(i) for i in line.split()[1:]]).reshape(-1,3))
+                break
+    return Answer
+
+def test_read_qdata():
+    """Check that qdata.txt files read in blocks match the line-by-line parser, for regular and ragged data"""
+    import tempfile, shutil
+    from forcebalance.molecule import Molecule
+    tmpdir = tempfile.mkdtemp()
+    try:
+        regular = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'files', 'targets', 'cluster-02', 'qdata.txt')
+        # ESP data with a different number of points in each frame, starting after the first few blocks.
+        ragged = os.path.join(tmpdir, 'qdata.txt')
+        np.random.seed(0)
+        with open(ragged, 'w') as f:
+            for i in range(50):
+                nesp = 4 if i < 20 else 3 + i % 5
+                print("JOB %i" % i, file=f)
+                print("COORDS " + ' '.join(["% .10e" % x for x in np.random.randn(9)]), file=f)
+                print("ENERGY % .12e" % np.random.randn(), file=f)
+                print("ESPXYZ " + ' '.join(["% .10e" % x for x in np.random.randn(3*nesp)]), file=f)
+                print("ESPVAL " + ' '.join(["% .10e" % x for x in np.random.randn(nesp)]), file=f)
+                print("", file=f)
+        for fnm in [regular, ragged]:
+            ref = read_qdata_reference(fnm)
+            M = Molecule()
+            # A small chunk size makes the file be read in many blocks.
+            for chunk in [1 << 24, 1000]:
+                Answer = M.read_qdata(fnm, chunk=chunk)
+                print(">ASSERT qdata read in blocks of %i bytes matches the line-by-line parser\n" % chunk)
+                assert sorted(Answer.keys()) == sorted(ref.keys())
+                for key in ref:
+                    assert len(Answer[key]) == len(ref[key])
+                    for a, r in zip(Answer[key], ref[key]):
+                        np.testing.assert_array_equal(a, r)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -91,6 +91,26 @@ class TestNifty(ForceBalanceTestCase):
         assert not(os.path.isfile(".test"))
         with pytest.raises(Exception) as excinfo:
             _exec("exit 255")
+        # Interleaved stdout and stderr keep the order they are printed in, and the output file has the same lines
+        cmd = "for i in 1 2 3; do echo out$i; sleep 0.05; echo err$i >&2; sleep 0.05; done"
+        assert _exec(cmd, copy_stderr=True, outfnm=".test.out", print_command=False) == ['out1', 'err1', 'out2', 'err2', 'out3', 'err3']
+        with open(".test.out") as f:
+            assert f.read().split() == ['out1', 'err1', 'out2', 'err2', 'out3', 'err3']
+        os.remove(".test.out")
+        assert _exec(cmd, copy_stdout=False, copy_stderr=True, print_command=False) == ['err1', 'err2', 'err3']
+        assert len(_exec("seq 1 100000", print_command=False)) == 100000
+        # The error message printed on a crash is only the stderr stream
+        from io import StringIO
+        from forcebalance.output import RawStreamHandler
+        stream = StringIO()
+        handler = RawStreamHandler(stream)
+        forcebalance.nifty.logger.addHandler(handler)
+        try:
+            assert _exec(cmd + "; exit 1", copy_stderr=True, persist=True, print_command=False) == ['out1', 'err1', 'out2', 'err2', 'out3', 'err3']
+        finally:
+            forcebalance.nifty.logger.removeHandler(handler)
+        assert 'err2' in stream.getvalue()
+        assert 'out2' not in stream.getvalue()
 
     def test_work_queue_functions(self):
         """Check work_queue functions behave as expected"""
@@ -137,3 +157,44 @@ class TestNifty(ForceBalanceTestCase):
         
         # Destroy the Work Queue object so it doesn't interfere with the rest of the tests.
         destroyWorkQueue()
+
+    def test_local_job_runner(self):
+        """Check that the built-in local job runner works through queue_up and wq_wait"""
+        cwd = os.getcwd()
+        tmpdir = tempfile.mkdtemp()
+        completed = []
+        try:
+            os.chdir(tmpdir)
+            with open("in.txt", "w") as f:
+                f.write("input\n")
+            createLocalWorkQueue(2, gpus=1, retries=1, callback=lambda task: completed.append(task.tag))
+            wq = getWorkQueue()
+            queue_up(wq, "cat in.txt > out1.txt; echo $CUDA_VISIBLE_DEVICES >> out1.txt", ["in.txt"], ["out1.txt"], tag="copy", verbose=False)
+            # This task fails the first time it runs and succeeds when it is retried.
+            queue_up(wq, "test -f %s || { touch %s; exit 1; }; echo retried > out2.txt" % ((os.path.join(tmpdir, "flag"),)*2),
+                     [], ["out2.txt"], tag="retry", verbose=False)
+            wq_wait(wq, wait_time=1, wait_intvl=0.1)
+            print(">ASSERT output files are copied back and failed tasks are retried\n")
+            assert sorted(completed) == ["copy", "retry"]
+            assert getWQIds()["None"] == []
+            with open("out1.txt") as f:
+                assert f.read().split() == ["input", "0"]
+            with open("out2.txt") as f:
+                assert f.read().strip() == "retried"
+            print(">ASSERT queued tasks start in freed slots while the caller does not wait\n")
+            for i in range(3):
+                queue_up(wq, "sleep 0.2; echo %i > out%i.txt" % (i, i+4), [], ["out%i.txt" % (i+4)], verbose=False)
+            t0 = time.time()
+            while not os.path.exists("out6.txt") and time.time() - t0 < 10:
+                time.sleep(0.1)
+            assert all([os.path.exists("out%i.txt" % (i+4)) for i in range(3)])
+            wq_wait(wq, wait_time=1, wait_intvl=0.1)
+            assert len(completed) == 5
+            print(">ASSERT a task that keeps failing raises an error\n")
+            queue_up(wq, "exit 3", [], ["out3.txt"], verbose=False)
+            with pytest.raises(RuntimeError):
+                wq_wait(wq, wait_time=1, wait_intvl=0.1)
+        finally:
+            destroyWorkQueue()
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
@@ -6,7 +6,9 @@ import forcebalance
 import numpy
 import inspect
 import pytest
-from .__init__ import ForceBalanceTestCase
+import shutil
+import tempfile
+from .__init__ import ForceBalanceTestCase, check_for_openmm
 
 class TestImplemented(ForceBalanceTestCase):
     def test_implemented_targets_derived_from_target(self):
@@ -167,3 +169,62 @@ class TestBromineObjective(ForceBalanceTestCase, ObjectiveTests):
         self.ff = forcebalance.forcefield.FF(self.options)
 
         self.objective = forcebalance.objective.Objective(self.options, self.tgt_opts,self.ff)
+
+class TestConcurrentObjective(ForceBalanceTestCase):
+    def setup_method(self, method):
+        if not check_for_openmm(): pytest.skip("No OpenMM modules found.")
+        super(TestConcurrentObjective, self).setup_method(method)
+        self.cwd = os.path.dirname(os.path.realpath(__file__))
+        # Two cheap targets that read the same data, one fitting forces and one energies only.
+        self.root = tempfile.mkdtemp()
+        os.symlink(os.path.join(self.cwd, 'files', 'forcefield'), os.path.join(self.root, 'forcefield'))
+        os.mkdir(os.path.join(self.root, 'targets'))
+        self.tgt_opts = []
+        for name, force in [('dms-gas-force', True), ('dms-gas-energy', False)]:
+            os.symlink(os.path.join(self.cwd, 'files', 'targets', 'dms-gas'), os.path.join(self.root, 'targets', name))
+            tgt_opt = forcebalance.parser.tgt_opts_defaults.copy()
+            tgt_opt.update({'type':'ABINITIO_OPENMM', 'name':name, 'coords':'all.pdb', 'pdb':'conf.pdb',
+                            'openmm_platform':'Reference', 'force':force})
+            self.tgt_opts.append(tgt_opt)
+        self.options=forcebalance.parser.gen_opts_defaults.copy()
+        self.options.update({
+                'root': self.root,
+                'penalty_additive': 0.01,
+                'jobtype': 'NEWTON',
+                'forcefield': ['dms.xml']})
+        os.chdir(self.root)
+
+    def teardown_method(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+        super(TestConcurrentObjective, self).teardown_method()
+
+    def test_target_workers(self):
+        """Check that evaluating targets concurrently matches evaluating them one at a time"""
+        Objs = []
+        Tgts = []
+        for workers in [1, 2]:
+            self.options['target_workers'] = workers
+            ff = forcebalance.forcefield.FF(self.options)
+            objective = forcebalance.objective.Objective(self.options, self.tgt_opts, ff)
+            for Tgt in objective.Targets:
+                # Record the calls to get() in a list that is only modified in place.
+                Tgt.get_calls = []
+                def get(mvals, AGrad=False, AHess=False, Tgt=Tgt, get=Tgt.get):
+                    Tgt.get_calls.append(list(mvals))
+                    return get(mvals, AGrad, AHess)
+                Tgt.get = get
+            mvals = numpy.array([.2]*ff.np)
+            Objs.append(objective.Full(mvals, Order=2))
+            Tgts.append(objective.Targets)
+        print(">ASSERT objective function, gradient and Hessian match the serial evaluation\n")
+        for key in ['X', 'G', 'H']:
+            numpy.testing.assert_allclose(Objs[1][key], Objs[0][key], rtol=1e-10, atol=1e-12)
+        print(">ASSERT target state set during the evaluation matches the serial evaluation\n")
+        for Tgt0, Tgt1 in zip(*Tgts):
+            assert Tgt1.name == Tgt0.name
+            assert Tgt1.evaluated
+            assert Tgt1.get_calls == Tgt0.get_calls
+            for attr in ['objective', 'e_err', 'e_ref', 'e_err_pct', 'f_err', 'f_err_pct']:
+                numpy.testing.assert_allclose(getattr(Tgt1, attr), getattr(Tgt0, attr), rtol=1e-10, err_msg=attr)
+            assert hasattr(Tgt1, 'engine')
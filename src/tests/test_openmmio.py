@@ -23,7 +23,8 @@ except ImportError:
 
 import os
 import shutil
-from .test_target import TargetTests # general targets tests defined in test_target.py
+import tempfile
+from .test_target import TargetTests, check_all_at_once # general targets tests defined in test_target.py
 import pytest
 """
 The testing functions for this class are located in test_target.py.
@@ -56,6 +57,62 @@ class TestLiquid_OpenMM(TargetTests):
         shutil.rmtree('temp')
         super(TestLiquid_OpenMM, self).teardown_method()
 
+class TestAbInitio_OpenMM(TargetTests):
+    def setup_method(self, method):
+        if no_openmm: pytest.skip("No OpenMM modules found.")
+        super(TestAbInitio_OpenMM, self).setup_method(method)
+        # settings specific to this target
+        self.options.update({
+                'jobtype': 'NEWTON',
+                'forcefield': ['dms.xml']})
+
+        self.tgt_opt.update({'type':'ABINITIO_OPENMM',
+                             'name':'dms-gas',
+                             'coords':'all.pdb',
+                             'pdb':'conf.pdb',
+                             'openmm_platform':'Reference',
+                             'force':True})
+
+        self.ff = forcebalance.forcefield.FF(self.options)
+
+        self.ffname = self.options['forcefield'][0][:-3]
+        self.filetype = self.options['forcefield'][0][-3:]
+        self.mvals = [.5]*self.ff.np
+
+        self.target = forcebalance.openmmio.AbInitio_OpenMM(self.options, self.tgt_opt, self.ff)
+
+    def test_all_at_once(self):
+        """Check that evaluating all snapshots at once matches the per-snapshot evaluation"""
+        os.chdir(os.path.join('temp', self.tgt_opt['name']))
+        check_all_at_once(self.target, self.mvals)
+        os.chdir('../..')
+
+    def test_jacobian_memmap(self):
+        """Check that the energy and force Jacobian stored on disk matches the one kept in memory"""
+        os.chdir(os.path.join('temp', self.tgt_opt['name']))
+        self.ff.make(self.mvals)
+        M_all = self.target.energy_force_transform()
+        dM_mem = self.target.energy_force_jacobian(self.mvals, M_all)
+        print(">ASSERT the Jacobian is kept in memory within jacobian_mem\n")
+        assert not isinstance(dM_mem, np.memmap)
+        assert dM_mem.shape == (M_all.shape[0], len(self.target.pgrad), M_all.shape[1])
+        files = sorted(os.listdir('.'))
+        # A limit smaller than the Jacobian puts it on disk and evaluates one displacement pair at a time.
+        self.target.jacobian_mem = 0.1 * dM_mem.nbytes / 1024**2
+        dM_disk = self.target.energy_force_jacobian(self.mvals, M_all)
+        print(">ASSERT the Jacobian is stored on disk above jacobian_mem\n")
+        assert isinstance(dM_disk, np.memmap)
+        print(">ASSERT the Jacobian stored on disk matches the one in memory\n")
+        np.testing.assert_array_equal(np.array(dM_disk), dM_mem)
+        del dM_disk
+        print(">ASSERT no files are left behind by the disk-backed Jacobian\n")
+        assert sorted(os.listdir('.')) == files
+        os.chdir('../..')
+
+    def teardown_method(self):
+        shutil.rmtree('temp')
+        super(TestAbInitio_OpenMM, self).teardown_method()
+
 class TestInteraction_OpenMM(TargetTests):
 
     def setup_method(self, method):
@@ -80,6 +137,63 @@ class TestInteraction_OpenMM(TargetTests):
 
         self.target = forcebalance.openmmio.Interaction_OpenMM(self.options, self.tgt_opt, self.ff)
 
+    def test_fd_workers(self):
+        """Check that finite difference gradients from a process pool match the serial ones"""
+        self.target.fdgrad = True
+        self.target.fd1_pids = ['ALL']
+        G_serial = self.target.get_G(self.mvals)['G']
+        self.target.fd_workers = 2
+        G_pool = self.target.get_G(self.mvals)['G']
+        print(">ASSERT finite difference gradient is the same with fd_workers = 2\n")
+        np.testing.assert_allclose(G_pool, G_serial, rtol=1e-8, atol=1e-10)
+
+    def test_fd_workers_hessian(self):
+        """Check that finite difference Hessians with nested finite difference gradients work in a process pool"""
+        self.target.fdgrad = True
+        self.target.fdhess = True
+        self.target.fd1_pids = ['ALL']
+        self.target.fd2_pids = ['ALL']
+        Ans_serial = self.target.get_H(self.mvals)
+        self.target.fd_workers = 2
+        Ans_pool = self.target.get_H(self.mvals)
+        print(">ASSERT finite difference gradient and Hessian are the same with fd_workers = 2\n")
+        np.testing.assert_allclose(Ans_pool['G'], Ans_serial['G'], rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(Ans_pool['H'], Ans_serial['H'], rtol=1e-8, atol=1e-10)
+
+    def test_eval_cache(self):
+        """Check that cached objective function evaluations are reused without calling get()"""
+        self.target.eval_cache = 16
+        Ans = self.target.get_G(self.mvals)
+        def no_get(*args, **kwargs):
+            raise RuntimeError("get() called for cached parameter values")
+        self.target.get = no_get
+        Ans_cached = self.target.get_G(self.mvals)
+        print(">ASSERT cached objective function and gradient are returned\n")
+        assert Ans_cached['X'] == Ans['X']
+        np.testing.assert_array_equal(Ans_cached['G'], Ans['G'])
+        cwd = os.getcwd()
+        with pytest.raises(RuntimeError):
+            self.target.get_X([.4]*self.ff.np)
+        os.chdir(cwd)
+        print(">ASSERT evaluation loaded from the cache in stage() is used after the cache file is removed\n")
+        self.target.stage(self.mvals, AGrad=True)
+        shutil.rmtree(os.path.join(self.target.root, self.target.cachedir))
+        Ans_staged = self.target.get_G(self.mvals)
+        assert Ans_staged['X'] == Ans['X']
+        np.testing.assert_array_equal(Ans_staged['G'], Ans['G'])
+
+    def test_fast_update(self):
+        """Check that setting parameters in the existing simulation matches rebuilding the system"""
+        self.target.get(self.mvals)
+        print(">ASSERT parameters of the OpenMM engine are updated in place\n")
+        assert self.target.engine.fast_update is not None
+        mvals = [.3]*self.ff.np
+        X_fast = self.target.get(mvals)['X']
+        self.target.engine.fast_update = None
+        X_slow = self.target.get(mvals)['X']
+        print(">ASSERT objective function is the same when the system is rebuilt\n")
+        np.testing.assert_allclose(X_fast, X_slow, rtol=1e-10)
+
     def teardown_method(self):
         shutil.rmtree('temp')
         super(TestInteraction_OpenMM, self).teardown_method()
@@ -106,3 +220,127 @@ def test_local_coord_sites():
     vsinfo = PrepareVirtualSites(system=system)
     new_pos = ResetVirtualSites_fast(positions=modeller.positions, vsinfo=vsinfo)[-1]
     assert np.allclose(vs_pos._value, np.array([new_pos.x, new_pos.y, new_pos.z]))
+
+def test_linear_derivatives():
+    """Check that derivatives for parameters that the energy depends on linearly match finite differences."""
+    if no_openmm: pytest.skip("No OpenMM modules found.")
+    from forcebalance.openmmio import OpenMM
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # Make the bonded parameters of the test force field adjustable.
+        os.makedirs(os.path.join(tmpdir, 'forcefield'))
+        with open(os.path.join("files", "forcefield", "dms.xml")) as f:
+            ffdata = f.read()
+        ffdata = ffdata.replace('k="188949.44000"/>', 'k="188949.44000" parameterize="k,length"/>')
+        ffdata = ffdata.replace('k="449.02688"/>', 'k="449.02688" parameterize="k"/>')
+        ffdata = ffdata.replace('k1="1.3932720000"/>', 'k1="1.3932720000" parameterize="k1"/>')
+        with open(os.path.join(tmpdir, 'forcefield', 'dms.xml'), 'w') as f:
+            f.write(ffdata)
+        shutil.copy(os.path.join("files", "targets", "dms-liquid", "gas.pdb"), tmpdir)
+        os.chdir(tmpdir)
+        options = forcebalance.parser.gen_opts_defaults.copy()
+        options.update({'root': tmpdir, 'forcefield': ['dms.xml']})
+        ff = forcebalance.forcefield.FF(options)
+        engine = OpenMM(ffxml='dms.xml', coords='gas.pdb', FF=ff, platname='Reference', precision='double', linear_deriv=True)
+        mvals = np.full(ff.np, 0.1)
+        linear = engine.linear_parameters(mvals, list(range(ff.np)))
+        print(">ASSERT only the bonded force constants are linear parameters\n")
+        assert sorted([ff.plist[p] for p in linear]) == ['Angle/k/h1.c3.ss', 'Bond/k/c3.ss', 'Proper/k1/h1.c3.ss.c3']
+        dM = engine.linear_derivatives(linear, force=True)
+        h = 1e-3
+        for p in linear:
+            mvals1 = mvals.copy()
+            mvals1[p] += h
+            ff.make(mvals1)
+            M1 = engine.energy_force()
+            mvals1[p] -= 2*h
+            ff.make(mvals1)
+            M2 = engine.energy_force()
+            print(">ASSERT derivatives of energies and forces for %s match finite difference\n" % ff.plist[p])
+            np.testing.assert_allclose(dM[p], (M1-M2)/(2*h), rtol=1e-5, atol=1e-5*np.max(np.abs(dM[p])))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+def test_energy_multi():
+    """Check that energies for several parameter displacements from one trajectory pass match evaluating each one separately."""
+    if no_openmm: pytest.skip("No OpenMM modules found.")
+    from forcebalance.openmmio import OpenMM
+    from forcebalance.molecule import Molecule
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # Make some bonded parameters adjustable in addition to the nonbonded ones.
+        os.makedirs(os.path.join(tmpdir, 'forcefield'))
+        with open(os.path.join("files", "forcefield", "dms.xml")) as f:
+            ffdata = f.read()
+        ffdata = ffdata.replace('k="188949.44000"/>', 'k="188949.44000" parameterize="k,length"/>')
+        ffdata = ffdata.replace('k1="1.3932720000"/>', 'k1="1.3932720000" parameterize="k1"/>')
+        with open(os.path.join(tmpdir, 'forcefield', 'dms.xml'), 'w') as f:
+            f.write(ffdata)
+        # A few distorted copies of the gas phase structure as the trajectory.
+        M = Molecule(os.path.join("files", "targets", "dms-liquid", "gas.pdb"))
+        np.random.seed(0)
+        M.xyzs = [M.xyzs[0] + 0.02*np.random.randn(M.na, 3) for i in range(3)]
+        M.write(os.path.join(tmpdir, 'gas.pdb'))
+        os.chdir(tmpdir)
+        options = forcebalance.parser.gen_opts_defaults.copy()
+        options.update({'root': tmpdir, 'forcefield': ['dms.xml']})
+        ff = forcebalance.forcefield.FF(options)
+        engine = OpenMM(ffxml='dms.xml', coords='gas.pdb', FF=ff, platname='Reference', precision='double')
+        kinds = set([ff.plist[p].split('/')[0] for p in range(ff.np)])
+        print(">ASSERT both nonbonded and bonded parameters are displaced\n")
+        assert 'Atom' in kinds and 'Bond' in kinds
+        mvals0 = np.full(ff.np, 0.1)
+        h = 1e-2
+        mvals_list = [mvals0]
+        for p in range(ff.np):
+            mvals1 = mvals0.copy()
+            mvals1[p] += h
+            mvals_list.append(mvals1)
+        for dipole in [False, True]:
+            multi = engine.energy_multi(mvals_list, dipole=dipole)
+            print(">ASSERT parameters are updated in place in a single pass\n")
+            assert engine.fast_update is not None
+            for mvals, E_multi in zip(mvals_list, multi):
+                ff.make(mvals)
+                E_ref = engine.energy_dipole() if dipole else engine.energy()
+                print(">ASSERT energies%s match separate evaluations\n" % (" and dipoles" if dipole else ""))
+                np.testing.assert_allclose(E_multi, E_ref, rtol=1e-8, atol=1e-8)
+            changed = set([ff.plist[p].split('/')[0] for p in range(ff.np) if np.max(np.abs(multi[p+1] - multi[0])) > 1e-6])
+            print(">ASSERT displacements of nonbonded and bonded parameters change the energies\n")
+            assert 'Atom' in changed and 'Bond' in changed
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+def test_trajectory_buffer():
+    """Check that TrajectoryBuffer returns the positions and box vectors it was given, in memory and on disk."""
+    if no_openmm: pytest.skip("No OpenMM modules found.")
+    from forcebalance.openmmio import TrajectoryBuffer
+    np.random.seed(0)
+    natoms, nframes = 5, 7
+    xyzs = np.random.random((nframes, natoms, 3)).astype(np.float32)
+    boxes = [np.diag([2.0+i, 2.5+i, 3.0+i]) + np.tril(np.random.random((3, 3)), -1) for i in range(nframes)]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for fnm in [None, os.path.join(tmpdir, 'xyzs.npy')]:
+            # Start with room for two frames so that the arrays have to grow.
+            buf = TrajectoryBuffer(natoms, 2, pbc=True, fnm=fnm)
+            for xyz, box in zip(xyzs, boxes):
+                buf.append([xyz * unit.nanometer, [mm.Vec3(*v) for v in box] * unit.nanometer])
+            print(">ASSERT positions and box vectors round-trip (%s)\n" % ('in memory' if fnm is None else 'on disk'))
+            assert len(buf) == nframes
+            for i, (positions, box_vectors) in enumerate(buf):
+                np.testing.assert_array_equal(positions.value_in_unit(unit.nanometer), xyzs[i])
+                np.testing.assert_allclose(np.array([list(v) for v in box_vectors.value_in_unit(unit.nanometer)]), boxes[i])
+            np.testing.assert_array_equal(buf[-1][0].value_in_unit(unit.nanometer), xyzs[-1])
+            if fnm is not None:
+                assert isinstance(buf.xyzs, np.memmap)
+                buf.xyzs.flush()
+                np.testing.assert_array_equal(np.load(fnm, mmap_mode='r')[:nframes], xyzs)
+                assert not os.path.exists(fnm + '.tmp')
+            del buf
+    finally:
+        shutil.rmtree(tmpdir)
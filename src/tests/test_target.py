@@ -90,3 +90,15 @@ class TargetTests(ForceBalanceTestCase):
                 assert abs(g[p]-G[p]) < X*.01 +1e-7
     
         os.chdir('../..')
+
+def check_all_at_once(target, mvals):
+    """ Check that the AbInitio objective function evaluated for all snapshots at once
+    matches the one accumulated one snapshot at a time. """
+    target.all_at_once = False
+    Ans_loop = target.get(mvals, AGrad=True, AHess=True)
+    target.all_at_once = True
+    Ans = target.get(mvals, AGrad=True, AHess=True)
+    print(">ASSERT objective function, gradient and Hessian match the per-snapshot evaluation\n")
+    numpy.testing.assert_allclose(Ans['X'], Ans_loop['X'], rtol=1e-12, atol=0)
+    numpy.testing.assert_allclose(Ans['G'], Ans_loop['G'], rtol=1e-12, atol=1e-12*numpy.max(numpy.abs(Ans_loop['G'])))
+    numpy.testing.assert_allclose(Ans['H'], Ans_loop['H'], rtol=1e-12, atol=1e-12*numpy.max(numpy.abs(Ans_loop['H'])))
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 import forcebalance
+import pytest
 from forcebalance.nifty import *
 from .test_target import TargetTests # general targets tests defined in test_target.py
 """
@@ -8,6 +9,8 @@ The testing functions for this class are located in test_target.py.
 class TestInteraction_TINKER(TargetTests):
 
     def setup_method(self, method):
+        if (which('testgrad') == ''):
+            pytest.skip("TINKER programs are not in the PATH.")
         super(TestInteraction_TINKER, self).setup_method(method)
         self.options.update({
                 'penalty_additive': 0.01,
@@ -29,12 +32,47 @@ class TestInteraction_TINKER(TargetTests):
         self.filetype = self.options['forcefield'][0][-3:]
         self.mvals = [.5]*self.ff.np
 
-        if (which('testgrad') == ''):
-            self.skipTest("TINKER programs are not in the PATH.")
-
         self.logger.debug("Setting up Interaction_TINKER target\n")
         self.target = forcebalance.tinkerio.Interaction_TINKER(self.options, self.tgt_opt, self.ff)
 
+    def test_energy_force_multi(self):
+        """Check that evaluating several parameter sets at once matches evaluating them one at a time"""
+        os.chdir(os.path.join('temp', self.tgt_opt['name']))
+        engine = self.target.engine
+        mvals_list = [list(self.mvals)]
+        for k in range(self.ff.np):
+            for d in [-1, 1]:
+                mvals_ = list(self.mvals)
+                mvals_[k] += d*self.target.h
+                mvals_list.append(mvals_)
+        Ms = engine.energy_force_multi(mvals_list)
+        print(">ASSERT per-displacement directories are removed\n")
+        assert not os.path.exists("%s-multi" % engine.name)
+        print(">ASSERT energies and forces match energy_force for each set of parameters\n")
+        for mvals, M in zip(mvals_list, Ms):
+            self.ff.make(mvals)
+            np.testing.assert_allclose(M, engine.energy_force(), rtol=1e-6, atol=1e-6)
+        os.chdir('../..')
+
     def teardown_method(self):
         shutil.rmtree('temp')
         super(TestInteraction_TINKER, self).teardown_method()
+
+def test_read_testgrad():
+    """Check that energies and forces are read from TINKER testgrad output"""
+    from forcebalance.tinkerio import read_testgrad
+    grads = [[[-1.2345, 2.3456, -3.4567], [0.1, 0.2, 0.3], [5.0, -6.0, 7.0]],
+             [[0.5, 0.25, -0.125], [1.0, 0.0, -1.0], [-2.0, 3.0, 4.0]]]
+    lines = []
+    for E, grad in zip([-45.1234, -44.5], grads):
+        lines += ["", " Total Potential Energy :              %.4f Kcal/mole" % E, "",
+                  " Cartesian Gradient Breakdown over Individual Atoms :",
+                  " ------------------------------------------------------", "",
+                  "  Type      Atom              dE/dX       dE/dY       dE/dZ          Norm", ""]
+        lines += [" Anlyt %9i %13.4f %11.4f %11.4f %12.4f" % (i+1, g[0], g[1], g[2], np.linalg.norm(g)) for i, g in enumerate(grad)]
+        lines += ["", " Total Gradient Norm Value :      12.3456"]
+    E, F = read_testgrad(lines, [True, False, True])
+    print(">ASSERT energies are converted to kJ/mol\n")
+    np.testing.assert_allclose(E, np.array([-45.1234, -44.5]) * 4.184)
+    print(">ASSERT forces on the selected atoms are converted to kJ/mol/nm\n")
+    np.testing.assert_allclose(F, -41.84 * np.array(grads)[:, [0, 2], :].reshape(2, -1))
@@ -44,21 +44,30 @@ def energy_derivatives(engine, FF, mvals, h, pgrad, dipole=False):
     @return GDz First derivative of the box dipole moment z-component in a N_param x N_coord array
 
     """
-    def single_point(mvals_):
-        FF.make(mvals_)
-        if dipole:
-            return engine.energy_dipole()
-        else:
-            return engine.energy()
-
-    ED0 = single_point(mvals)
+    # Parameters that the energy depends on linearly are differentiated by the
+    # engine directly; they do not change the charges or the dipole.
+    linear = engine.linear_parameters(mvals, pgrad)
+    EGlin  = engine.linear_derivatives(linear)
+    pgrad  = [i for i in pgrad if i not in EGlin]
+    # Evaluate the central and displaced parameter values together,
+    # so that the engine may loop over the trajectory only once.
+    mvals_list = [mvals]
+    for i in pgrad:
+        for d in [-1, 1]:
+            mvals_ = list(mvals)
+            mvals_[i] += d*h
+            mvals_list.append(mvals_)
+    EDs = engine.energy_multi(mvals_list, dipole=dipole)
+    ED0 = EDs[0]
     G   = OrderedDict()
     G['potential'] = np.zeros((FF.np, ED0.shape[0]))
     if dipole:
         G['dipole'] = np.zeros((FF.np, ED0.shape[0], 3))
-    for i in pgrad:
+    for i in EGlin:
+        G['potential'][i] = EGlin[i]
+    for n, i in enumerate(pgrad):
         logger.info("%i %s\r" % (i, (FF.plist[i] + " "*30)))
-        edg, _ = f12d3p(fdwrap(single_point,mvals,i),h,f0=ED0)
+        edg = (EDs[2*n+2]-EDs[2*n+1])/(2*h)
         if dipole:
             G['potential'][i] = edg[:,0]
             G['dipole'][i]    = edg[:,1:]
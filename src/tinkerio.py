@@ -22,6 +22,7 @@ import networkx as nx
 from copy import deepcopy
 from forcebalance import BaseReader
 from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
 from forcebalance.engine import Engine
 from forcebalance.abinitio import AbInitio
 from forcebalance.vibration import Vibration
@@ -30,7 +31,7 @@ from forcebalance.liquid import Liquid
 from forcebalance.molecule import Molecule, BuildLatticeFromLengthsAngles
 from forcebalance.binding import BindingEnergy
 from forcebalance.interaction import Interaction
-from forcebalance.finite_difference import in_fd
+from forcebalance.finite_difference import in_fd, in_fd_worker
 from collections import OrderedDict
 
 # All TINKER force field parameter types, which should eventually go into pdict
@@ -304,13 +305,46 @@ def write_key(fout, options, fin=None, defaults={}, verbose=False, prmfnm=None,
         printcool_dictionary(options, title="%s -> %s with options:" % (fin, fout))
     file_out.close()
 
+def read_testgrad(lines, mask):
+
+    """
+    Read the energies and analytic gradients from the output of TINKER testgrad.
+
+    The 'Anlyt' lines following each 'Cartesian Gradient Breakdown over
+    Individual Atoms' header are collected and converted to a NumPy array
+    in one step, instead of checking every token.
+
+    @param[in] lines Output of testgrad, as a list of lines
+    @param[in] mask Boolean list that is True for the atoms whose forces are returned
+    @return E Potential energies in kJ/mol
+    @return F Forces on the atoms in mask in kJ/mol/nm, one row per structure
+    """
+    mask = np.array(mask, dtype=bool)
+    E = []
+    F = []
+    block = None
+    for line in lines:
+        if block is not None:
+            if line.lstrip().startswith('Anlyt'):
+                block.append(line)
+                continue
+            elif len(block) > 0:
+                grad = np.array(' '.join(block).split()).reshape(-1, 6)[:, 2:5].astype(float)
+                F.append((-1 * grad[mask] * 4.184 * 10).flatten())
+                block = None
+        if "Total Potential Energy" in line:
+            E.append(float(line.split()[4]) * 4.184)
+        elif "Cartesian Gradient Breakdown over Individual Atoms" in line:
+            block = []
+    return np.array(E), np.array(F)
+
 class TINKER(Engine):
 
     """ Engine for carrying out general purpose TINKER calculations. """
 
     def __init__(self, name="tinker", **kwargs):
         ## Keyword args that aren't in this list are filtered out.
-        self.valkwd = ['tinker_key', 'tinkerpath', 'tinker_prm']
+        self.valkwd = ['tinker_key', 'tinkerpath', 'tinker_prm', 'fd_workers']
         self.warn_vn = False
         super(TINKER,self).__init__(name=name, **kwargs)
 
@@ -330,6 +364,9 @@ class TINKER(Engine):
                 warn_press_key("Please add TINKER executables to the PATH or specify tinkerpath.")
             self.tinkerpath = which('dynamic')
 
+        ## Number of TINKER processes to run at once when evaluating several sets of parameter values
+        self.workers = max(1, kwargs.get('fd_workers', 1))
+
     def readsrc(self, **kwargs):
 
         """ Called by __init__ ; read files from the source directory. """
@@ -352,7 +389,7 @@ class TINKER(Engine):
             LinkFile(self.abskey, "%s.key" % self.name)
         prog = os.path.join(self.tinkerpath, csplit[0])
         csplit[0] = prog
-        o = _exec(' '.join(csplit), stdin=stdin, print_to_screen=print_to_screen, print_command=print_command, rbytes=1024, **kwargs)
+        o = _exec(' '.join(csplit), stdin=stdin, print_to_screen=print_to_screen, print_command=print_command, **kwargs)
         # Determine the TINKER version number.
         for line in o[:10]:
             if "Version" in line:
@@ -494,7 +531,7 @@ class TINKER(Engine):
             # tk_opts['remove-inertia'] = '0'
 
         write_key("%s.key" % self.name, tk_opts, os.path.join(self.srcdir, self.key) if self.key else None, tk_defs, verbose=False, prmfnm=prmfnm)
-        self.abskey = os.path.abspath("%s.key")
+        self.abskey = os.path.abspath("%s.key" % self.name)
 
         self.mol[0].write(os.path.join("%s.xyz" % self.name), ftype="tinker")
 
@@ -626,7 +663,7 @@ class TINKER(Engine):
             logger.info("The minimization did not converge in the geometry optimization - printout is above.\n")
         return E, rmsd, M12[1]
 
-    def evaluate_(self, xyzin, force=False, dipole=False):
+    def evaluate_(self, xyzin, force=False, dipole=False, cwd=None):
 
         """ 
         Utility function for computing energy, and (optionally) forces and dipoles using TINKER. 
@@ -635,6 +672,7 @@ class TINKER(Engine):
         xyzin: TINKER .xyz file name.
         force: Switch for calculating the force.
         dipole: Switch for calculating the dipole.
+        cwd: Directory to run TINKER in (defaults to the current directory).
 
         Outputs:
         Result: Dictionary containing energies, forces and/or dipoles.
@@ -643,47 +681,86 @@ class TINKER(Engine):
         Result = OrderedDict()
         # If we want the dipoles (or just energies), analyze is the way to go.
         if dipole or (not force):
-            oanl = self.calltinker("analyze %s -k %s" % (xyzin, self.name), stdin="G,E,M", print_to_screen=False)
+            oanl = self.calltinker("analyze %s -k %s" % (xyzin, self.name), stdin="G,E,M", print_to_screen=False, cwd=cwd)
             # Read potential energy and dipole from file.
             eanl = []
             dip = []
             for line in oanl:
-                s = line.split()
                 if 'Total Potential Energy : ' in line:
-                    eanl.append(float(s[4]) * 4.184)
-                if dipole:
-                    if 'Dipole X,Y,Z-Components :' in line:
-                        dip.append([float(s[i]) for i in range(-3,0)])
+                    eanl.append(float(line.split()[4]) * 4.184)
+                elif dipole and 'Dipole X,Y,Z-Components :' in line:
+                    dip.append([float(i) for i in line.split()[-3:]])
             Result["Energy"] = np.array(eanl)
             Result["Dipole"] = np.array(dip)
         # If we want forces, then we need to call testgrad.
         if force:
-            E = []
-            F = []
-            Fi = []
-            o = self.calltinker("testgrad %s -k %s y n n" % (xyzin, self.name))
-            i = 0
-            ReadFrc = 0
-            for line in o:
-                s = line.split()
-                if "Total Potential Energy" in line:
-                    E.append(float(s[4]) * 4.184)
-                if "Cartesian Gradient Breakdown over Individual Atoms" in line:
-                    ReadFrc = 1
-                if ReadFrc and len(s) == 6 and all([s[0] == 'Anlyt',isint(s[1]),isfloat(s[2]),isfloat(s[3]),isfloat(s[4]),isfloat(s[5])]):
-                    ReadFrc = 2
-                    if self.AtomMask[i]:
-                        Fi += [-1 * float(j) * 4.184 * 10 for j in s[2:5]]
-                    i += 1
-                if ReadFrc == 2 and len(s) < 6:
-                    ReadFrc = 0
-                    F.append(Fi)
-                    Fi = []
-                    i = 0
-            Result["Energy"] = np.array(E)
-            Result["Force"] = np.array(F)
+            o = self.calltinker("testgrad %s -k %s y n n" % (xyzin, self.name), cwd=cwd)
+            Result["Energy"], Result["Force"] = read_testgrad(o, self.AtomMask)
         return Result
 
+    def evaluate_multi(self, mvals_list, force=False, dipole=False):
+
+        """
+        Evaluate variables (energies, force and/or dipole) using TINKER over a trajectory
+        for several sets of parameter values.
+
+        The trajectory is written once as a multi-frame .arc file.  The force field files
+        for each parameter set are written into their own subdirectory together with a
+        link to the .key file, and TINKER is called in each subdirectory; up to fd_workers
+        of these calls run at the same time, unless this is already one of the worker
+        processes of Target.fd_map.  The subdirectories are removed afterward.
+
+        @param[in] mvals_list List of mathematical parameter values
+        @param[in] force Switch for calculating the force
+        @param[in] dipole Switch for calculating the dipole
+        @return List of dictionaries returned by evaluate_, one per set of parameters
+        """
+        if hasattr(self, 'md_trajectory'):
+            x = os.path.abspath(self.md_trajectory)
+        else:
+            x = os.path.abspath("%s-all.arc" % self.name)
+            self.mol.write(x, ftype="tinker")
+        multi = os.path.abspath("%s-multi" % self.name)
+        dirs = [os.path.join(multi, "%i" % s) for s in range(len(mvals_list))]
+        def evaluate_dir(d):
+            return self.evaluate_(x, force=force, dipole=dipole, cwd=d)
+        try:
+            for d, mvals in zip(dirs, mvals_list):
+                self.FF.make(mvals, printdir=d)
+                LinkFile(self.abskey, os.path.join(d, "%s.key" % self.name))
+            # Inside an fd_map worker the other workers are already busy, so don't multiply the process count.
+            nrun = 1 if in_fd_worker() else min(self.workers, len(dirs))
+            if nrun > 1:
+                # Each TINKER call is a separate process, so threads are enough to keep them running concurrently.
+                pool = ThreadPool(nrun)
+                try:
+                    Results = pool.map(evaluate_dir, dirs, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                Results = [evaluate_dir(d) for d in dirs]
+        finally:
+            # The results have been read, so the per-displacement force fields are no longer needed.
+            shutil.rmtree(multi, ignore_errors=True)
+        return Results
+
+    def energy_multi(self, mvals_list, dipole=False):
+
+        """ Compute the energies (and optionally dipoles) using TINKER over a trajectory for several sets of parameter values. """
+
+        Results = self.evaluate_multi(mvals_list, dipole=dipole)
+        if dipole:
+            return [np.hstack((Result["Energy"].reshape(-1,1), Result["Dipole"])) for Result in Results]
+        return [Result["Energy"] for Result in Results]
+
+    def energy_force_multi(self, mvals_list):
+
+        """ Compute the energies and forces using TINKER over a trajectory for several sets of parameter values. """
+
+        Results = self.evaluate_multi(mvals_list, force=True)
+        return [np.hstack((Result["Energy"].reshape(-1,1), Result["Force"])) for Result in Results]
+
     def get_charges(self):
         logger.error('TINKER engine does not have get_charges (should be easy to implement however.)')
         raise NotImplementedError
@@ -121,11 +121,15 @@ class TorsionProfileTarget(Target):
             M_opts = None
             compute.emm = []
             compute.rmsd = []
+            compute.demm = OrderedDict([(p, []) for p in compute.linear])
             for i in range(self.ns):
                 energy, rmsd, M_opt = self.engine.optimize(shot=i, align=False)
                 # Create a molecule object to hold the MM-optimized structures
                 compute.emm.append(energy)
                 compute.rmsd.append(rmsd)
+                # Derivatives of the minimized energies for linear parameters, evaluated at the minimized geometry
+                for p, dE in self.engine.linear_derivatives(compute.linear, traj=False).items():
+                    compute.demm[p].append(dE / 4.184)
                 if M_opts is None:
                     M_opts = deepcopy(M_opt)
                 else:
@@ -167,8 +171,15 @@ class TorsionProfileTarget(Target):
             return (np.sqrt(self.wts)/self.energy_denom) * (compute.emm - self.eqm)
         compute.emm = None
         compute.rmsd = None
+        # Without restraints, the derivative of a minimized energy is the partial derivative at the minimum,
+        # so the derivatives for linear parameters are computed by the engine.
+        compute.linear = OrderedDict()
+        if (AGrad or AHess) and getattr(self.engine, 'restraint_frc_index', None) is None:
+            compute.linear = self.engine.linear_parameters(mvals, self.pgrad)
 
         V = compute(mvals, indicate=True)
+        demm = compute.demm
+        compute.linear = OrderedDict()
 
         Answer['X'] = np.dot(V,V)
 
@@ -183,7 +194,10 @@ class TorsionProfileTarget(Target):
         dV = np.zeros((self.FF.np,len(V)))
         if AGrad or AHess:
             for p in self.pgrad:
-                dV[p,:], _ = f12d3p(fdwrap(compute, mvals, p), h = self.h, f0 = V)
+                if p in demm:
+                    dV[p,:] = (np.sqrt(self.wts)/self.energy_denom) * (np.array(demm[p]) - demm[p][self.smin])
+                else:
+                    dV[p,:], _ = f12d3p(fdwrap(compute, mvals, p), h = self.h, f0 = V)
 
         for p in self.pgrad:
             Answer['G'][p] = 2*np.dot(V, dV[p,:])